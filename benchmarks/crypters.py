@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""
+Compare the encrypt/decrypt throughput of the built-in crypters on the
+bundled test keyset.
+
+    $ python benchmarks/crypters.py [--count=N] [--sizes=16,256,4096] [--json]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from encrypted_fields.aead import (  # noqa: E402
+    FORMATS,
+    AESGCMWrapper,
+    ChaCha20Poly1305Wrapper,
+)
+from encrypted_fields.fields import KeyczarWrapper  # noqa: E402
+
+
+KEYDIR = os.path.join(ROOT, 'testkey')
+
+
+def crypter_classes():
+    classes = [KeyczarWrapper]
+    if FORMATS:
+        classes += [AESGCMWrapper, ChaCha20Poly1305Wrapper]
+    return classes
+
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return time.time() - start, result
+
+
+def bench(klass, count, size):
+    crypter = klass(KEYDIR)
+    cleartexts = [os.urandom(size // 2).encode('hex') for i in range(count)]
+
+    encrypt_time, ciphertexts = timed(crypter.encrypt_many, cleartexts)
+    decrypt_time, _ = timed(crypter.decrypt_many, ciphertexts)
+    return {
+        'crypter': klass.__name__,
+        'size': size,
+        'count': count,
+        'encrypt_per_sec': count / max(encrypt_time, 1e-9),
+        'decrypt_per_sec': count / max(decrypt_time, 1e-9),
+        'ciphertext_len': len(ciphertexts[0]),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--count', type=int, default=2000)
+    parser.add_argument('--sizes', default='16,256,4096')
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args(argv)
+
+    results = []
+    for size in [int(size) for size in args.sizes.split(',')]:
+        for klass in crypter_classes():
+            results.append(bench(klass, args.count, size))
+
+    if args.json:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+        return
+
+    row = '{0:<24} {1:>6} {2:>12} {3:>12} {4:>8}'
+    print(row.format('crypter', 'size', 'encrypt/s', 'decrypt/s', 'length'))
+    for result in results:
+        print(row.format(
+            result['crypter'], result['size'],
+            '{0:.0f}'.format(result['encrypt_per_sec']),
+            '{0:.0f}'.format(result['decrypt_per_sec']),
+            result['ciphertext_len'],
+        ))
+
+
+if __name__ == '__main__':
+    main()
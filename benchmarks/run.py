@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+"""
+Measure the cost of encrypted fields on in-memory SQLite with the bundled
+test keyset.
+
+    $ python benchmarks/run.py [--only=fields,orm,load,memory,crypters]
+                               [--rows=2000] [--repeat=500] [--json=out.json]
+
+Sections:
+  fields    get_prep_value/to_python throughput and latency percentiles for
+            each Encrypted*Field over a range of payload sizes
+  orm       bulk_create and iteration of --rows rows, encrypted vs plain
+  load      time to construct each crypter from its key directory
+  memory    memory held per loaded instance, encrypted vs plain
+  crypters  encrypt_many/decrypt_many throughput of each crypter class
+
+--json writes every result (plus the environment) to a file, or to stdout
+with --json=-, so runs can be diffed to spot regressions.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'testsettings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.db import connection, models  # noqa: E402
+from keyczar import keyczar  # noqa: E402
+
+import encrypted_fields  # noqa: E402
+from benchmarks import crypters as crypter_bench  # noqa: E402
+from encrypted_fields.fields import (  # noqa: E402
+    EncryptedBooleanField,
+    EncryptedCharField,
+    EncryptedDateField,
+    EncryptedDateTimeField,
+    EncryptedEmailField,
+    EncryptedFloatField,
+    EncryptedIntegerField,
+    EncryptedTextField,
+    KeyczarWrapper,
+)
+from encrypted_fields.query import EncryptedManager  # noqa: E402
+
+
+SECTIONS = ('fields', 'orm', 'load', 'memory', 'crypters')
+PAYLOAD_SIZES = (16, 256, 4096)
+NOW = datetime.datetime(2016, 10, 17, 12, 30, 15)
+
+
+class EncryptedRow(models.Model):
+    char = EncryptedCharField(max_length=255)
+    text = EncryptedTextField()
+    integer = EncryptedIntegerField()
+    datetime = EncryptedDateTimeField()
+
+    objects = EncryptedManager()
+
+    class Meta:
+        app_label = 'encrypted_fields'
+
+
+class PlainRow(models.Model):
+    char = models.CharField(max_length=255)
+    text = models.TextField()
+    integer = models.IntegerField()
+    datetime = models.DateTimeField()
+
+    class Meta:
+        app_label = 'encrypted_fields'
+
+
+def field_cases():
+    """
+    (label, field, payload size, value) for every field type and size.
+    """
+    for size in PAYLOAD_SIZES:
+        yield 'EncryptedTextField', EncryptedTextField(), size, 'x' * size
+        if size <= 255:
+            yield ('EncryptedCharField', EncryptedCharField(max_length=255),
+                   size, 'x' * size)
+    yield ('EncryptedEmailField', EncryptedEmailField(), None,
+           'aron@example.com')
+    yield 'EncryptedIntegerField', EncryptedIntegerField(), None, 65535
+    yield 'EncryptedFloatField', EncryptedFloatField(), None, 3.14159
+    yield 'EncryptedBooleanField', EncryptedBooleanField(), None, True
+    yield ('EncryptedDateField', EncryptedDateField(), None, NOW.date())
+    yield 'EncryptedDateTimeField', EncryptedDateTimeField(), None, NOW
+
+
+def percentile(sorted_samples, fraction):
+    index = int(round(fraction * (len(sorted_samples) - 1)))
+    return sorted_samples[index]
+
+
+def latencies(func, args, repeat):
+    """
+    Call func(*args) `repeat` times; returns ops/s and latency percentiles
+    in microseconds.
+    """
+    timer = timeit.default_timer
+    samples = []
+    for i in range(repeat):
+        start = timer()
+        func(*args)
+        samples.append(timer() - start)
+    samples.sort()
+    return {
+        'ops_per_sec': repeat / max(sum(samples), 1e-9),
+        'p50_us': percentile(samples, 0.50) * 1e6,
+        'p90_us': percentile(samples, 0.90) * 1e6,
+        'p99_us': percentile(samples, 0.99) * 1e6,
+    }
+
+
+def bench_fields(args):
+    results = []
+    for label, field, size, value in field_cases():
+        # Load the keyset before timing.
+        ciphertext = field.get_prep_value(value)
+        for operation, func, arg in (
+            ('get_prep_value', field.get_prep_value, value),
+            ('to_python', field.to_python, ciphertext),
+        ):
+            result = latencies(func, (arg,), args.repeat)
+            result.update(field=label, operation=operation, size=size)
+            results.append(result)
+    return results
+
+
+def timed(func, *args):
+    start = timeit.default_timer()
+    func(*args)
+    return timeit.default_timer() - start
+
+
+def make_rows(model, count):
+    return [
+        model(char='x' * 32, text='y' * 256, integer=i, datetime=NOW)
+        for i in range(count)
+    ]
+
+
+def bench_orm(args):
+    results = []
+    for model in (PlainRow, EncryptedRow):
+        model.objects.all().delete()
+        rows = make_rows(model, args.rows)
+        operations = [
+            ('bulk_create', lambda: model.objects.bulk_create(rows)),
+            ('iterate', lambda: list(model.objects.all().iterator())),
+        ]
+        if model is EncryptedRow:
+            operations.append((
+                'decrypting_iterator',
+                lambda: list(model.objects.all().decrypting_iterator()),
+            ))
+        for operation, func in operations:
+            seconds = timed(func)
+            results.append({
+                'model': model.__name__,
+                'operation': operation,
+                'rows': args.rows,
+                'seconds': seconds,
+                'rows_per_sec': args.rows / max(seconds, 1e-9),
+            })
+    return results
+
+
+def bench_load(args):
+    results = []
+    keydir = crypter_bench.KEYDIR
+    for klass in crypter_bench.crypter_classes():
+        samples = sorted(
+            timed(klass, keydir) for i in range(max(args.repeat // 10, 5))
+        )
+        results.append({
+            'crypter': klass.__name__,
+            'p50_ms': percentile(samples, 0.50) * 1e3,
+            'max_ms': samples[-1] * 1e3,
+        })
+    return results
+
+
+def deep_size(obj, seen=None):
+    """
+    sys.getsizeof of `obj` and everything reachable from it through
+    instance dicts and containers, counting shared objects once.
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += deep_size(key, seen) + deep_size(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += deep_size(item, seen)
+    elif isinstance(obj, models.Model):
+        size += deep_size(obj.__dict__, seen)
+    return size
+
+
+def bench_memory(args):
+    results = []
+    for model in (PlainRow, EncryptedRow):
+        if not model.objects.exists():
+            model.objects.bulk_create(make_rows(model, args.rows))
+        instances = list(model.objects.all())
+        seen = set()
+        total = sum(deep_size(instance, seen) for instance in instances)
+        results.append({
+            'model': model.__name__,
+            'rows': len(instances),
+            'bytes_per_instance': total / float(len(instances)),
+        })
+    return results
+
+
+def bench_crypters(args):
+    return [
+        crypter_bench.bench(klass, args.repeat, size)
+        for size in PAYLOAD_SIZES
+        for klass in crypter_bench.crypter_classes()
+    ]
+
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'encrypted_fields': encrypted_fields.__version__,
+        'keyczar': getattr(keyczar, '__version__', None),
+        'machine': platform.machine(),
+        'default_crypter': KeyczarWrapper.__name__,
+    }
+
+
+def print_results(section, results):
+    print('\n== {0}'.format(section))
+    if not results:
+        return
+    keys = sorted(results[0])
+    print('  '.join('{0:>14}'.format(key[:14]) for key in keys))
+    for result in results:
+        cells = []
+        for key in keys:
+            value = result[key]
+            if isinstance(value, float):
+                value = '{0:.4g}'.format(value)
+            cells.append('{0:>14}'.format(value if value is not None else '-'))
+        print('  '.join(cells))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip(),
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('--only', default=','.join(SECTIONS))
+    parser.add_argument('--rows', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=500)
+    parser.add_argument('--json', default=None)
+    args = parser.parse_args(argv)
+
+    sections = args.only.split(',')
+    unknown = set(sections) - set(SECTIONS)
+    if unknown:
+        parser.error('unknown sections: {0}'.format(', '.join(unknown)))
+
+    with connection.schema_editor() as schema_editor:
+        schema_editor.create_model(EncryptedRow)
+        schema_editor.create_model(PlainRow)
+
+    benches = {
+        'fields': bench_fields,
+        'orm': bench_orm,
+        'load': bench_load,
+        'memory': bench_memory,
+        'crypters': bench_crypters,
+    }
+    report = {'environment': environment()}
+    for section in sections:
+        report[section] = benches[section](args)
+        if args.json != '-':
+            print_results(section, report[section])
+
+    if args.json == '-':
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    elif args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(report, json_file, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,10 @@
 __version__ = '1.1.2'
 
 from .fields import *
+from .query import (
+    EncryptedManager,
+    EncryptedQuerySet,
+    decrypt_async,
+    decrypting_iterator,
+    in_range,
+)
@@ -0,0 +1,60 @@
+"""
+Coarse buckets of dates and numbers, for the range indexes of encrypted
+fields declared with `range_index`.
+
+A date or datetime falls in a 'year', 'month', 'week' or 'day' bucket;
+datetimes are bucketed by their date in UTC. A number falls in a bucket of
+`range_index` consecutive values.
+"""
+import datetime
+
+from django.utils import timezone
+
+
+DATE_BUCKETS = {
+    'year': lambda date: date.year,
+    'month': lambda date: date.year * 12 + date.month - 1,
+    'week': lambda date: date.toordinal() // 7,
+    'day': lambda date: date.toordinal(),
+}
+
+DEFAULT_DATE_BUCKET = 'month'
+
+# Most buckets a single range lookup may cover.
+MAX_BUCKETS = 1000
+
+
+def bucket(value, size):
+    """
+    The number of the bucket of `size` that `value` falls in.
+    """
+    if size in DATE_BUCKETS:
+        if isinstance(value, datetime.datetime) and timezone.is_aware(value):
+            value = timezone.make_naive(value, timezone.utc)
+        return DATE_BUCKETS[size](value)
+    return int(value // size)
+
+
+def buckets(low, high, size, bounds=None):
+    """
+    The numbers of the buckets of `size` holding values from `low` to
+    `high`. Either end may be None to run to the matching end of `bounds`.
+    """
+    if bounds is not None:
+        low = bounds[0] if low is None else max(low, bounds[0])
+        high = bounds[1] if high is None else min(high, bounds[1])
+    if low is None or high is None:
+        raise ValueError(
+            'Open ended range lookups on a range index need '
+            'range_index_bounds.'
+        )
+
+    first, last = bucket(low, size), bucket(high, size)
+    if last - first >= MAX_BUCKETS:
+        raise ValueError(
+            'The range covers {0} buckets, more than the {1} a lookup may '
+            'use; use a narrower range or a coarser range_index.'.format(
+                last - first + 1, MAX_BUCKETS
+            )
+        )
+    return range(first, last + 1)
@@ -0,0 +1,143 @@
+"""
+Bounded in-process cache of decrypted values, for fields declared with
+`cache=True`.
+"""
+import collections
+import hashlib
+import threading
+import time
+import types
+
+from django.conf import settings
+
+
+# Returned by PlaintextCache.get when there is no usable entry.
+MISSING = object()
+
+DEFAULT_MAX_ENTRIES = 1000
+DEFAULT_TTL = 300
+DEFAULT_MAX_VALUE_LENGTH = 4096
+
+
+def cache_key(field, ciphertext):
+    """
+    The cache key of `ciphertext` as read by `field`. Only a digest of the
+    ciphertext is kept, not the ciphertext itself.
+    """
+    return (
+        field._crypter_klass,
+        field.keydir,
+        hashlib.sha256(ciphertext).digest(),
+    )
+
+
+class PlaintextCache(object):
+    """
+    Thread-safe LRU mapping of ciphertext digests to decrypted values.
+
+    At most `max_entries` values are kept, each for at most `ttl` seconds,
+    and values longer than `max_value_length` are not cached at all, which
+    bounds the memory the cache can hold. Limits left as None are read from
+    the settings ENCRYPTED_FIELDS_CACHE_MAX_ENTRIES, ENCRYPTED_FIELDS_CACHE_TTL
+    and ENCRYPTED_FIELDS_CACHE_MAX_VALUE_LENGTH (or the same names after
+    another `settings_prefix`) on first use.
+
+    The cache is cleared whenever the crypter registry drops or reloads
+    key material.
+    """
+
+    def __init__(self, max_entries=None, ttl=None, max_value_length=None,
+                 settings_prefix='ENCRYPTED_FIELDS_CACHE'):
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._limits = (max_entries, ttl, max_value_length)
+        self.settings_prefix = settings_prefix
+        self.configured = False
+        self.reset_stats()
+
+    def setting(self, name, default):
+        return getattr(
+            settings, '{0}_{1}'.format(self.settings_prefix, name), default
+        )
+
+    def configure(self):
+        max_entries, ttl, max_value_length = self._limits
+        if max_entries is None:
+            max_entries = self.setting('MAX_ENTRIES', DEFAULT_MAX_ENTRIES)
+        if ttl is None:
+            ttl = self.setting('TTL', DEFAULT_TTL)
+        if max_value_length is None:
+            max_value_length = self.setting(
+                'MAX_VALUE_LENGTH', DEFAULT_MAX_VALUE_LENGTH
+            )
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_value_length = max_value_length
+        self.configured = True
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return MISSING
+
+            value, expires = entry
+            if expires < time.time():
+                self.expirations += 1
+                self.misses += 1
+                return MISSING
+
+            # Re-insert to mark it most recently used.
+            self._entries[key] = entry
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if not self.configured:
+            self.configure()
+        if self.max_entries <= 0:
+            return
+        if (
+            isinstance(value, types.StringTypes) and
+            len(value) > self.max_value_length
+        ):
+            return
+
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.time() + self.ttl)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'size': len(self._entries),
+            }
+
+    def __len__(self):
+        return len(self._entries)
+
+
+plaintext_cache = PlaintextCache()
+
+# Unwrapped envelope data keys, see encrypted_fields.envelope.
+data_key_cache = PlaintextCache(
+    settings_prefix='ENCRYPTED_FIELDS_DATA_KEY_CACHE'
+)
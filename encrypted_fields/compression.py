@@ -0,0 +1,68 @@
+"""
+Optional compression of cleartext before encryption.
+
+Cleartext handed to the crypter starts with an ASCII character or with a
+serializer tag (0x90 and up, see serializers), so a compressed value is
+marked by a leading byte from 0x80 naming the compressor. Values without a
+marker are used as they are, so compressed and uncompressed rows can live
+side by side.
+"""
+import bz2
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+
+# name -> (marker byte, compress, decompress)
+COMPRESSORS = {
+    'zlib': ('\x80', zlib.compress, zlib.decompress),
+    'bz2': ('\x81', bz2.compress, bz2.decompress),
+}
+if lzma is not None:
+    COMPRESSORS['lzma'] = ('\x82', lzma.compress, lzma.decompress)
+
+# What the decompressors raise for data that is not what its marker says.
+COMPRESSION_ERRORS = (zlib.error, IOError, EOFError, ValueError)
+if lzma is not None:
+    COMPRESSION_ERRORS += (lzma.LZMAError,)
+
+DECOMPRESSORS = dict(
+    (marker, decompress)
+    for marker, compress, decompress in COMPRESSORS.values()
+)
+
+DEFAULT_COMPRESSOR = 'zlib'
+
+
+def compress(data, method, min_length=0):
+    """
+    `data` compressed with `method` behind its marker byte, or `data` as it
+    is when shorter than `min_length` or when compressing does not help.
+    """
+    if len(data) < min_length:
+        return data
+    marker, compress_func = COMPRESSORS[method][:2]
+    compressed = marker + compress_func(data)
+    if len(compressed) >= len(data):
+        return data
+    return compressed
+
+
+def decompress(data):
+    """
+    The cleartext behind `data`, which may or may not be compressed.
+    """
+    decompress_func = DECOMPRESSORS.get(data[:1])
+    if decompress_func is None:
+        return data
+    try:
+        return decompress_func(data[1:])
+    except COMPRESSION_ERRORS:
+        # Not written by us, e.g. a decrypt_only value encrypted elsewhere.
+        return data
@@ -0,0 +1,123 @@
+"""
+Base for crypters whose keys are derived from a Keyczar AES keyset, such
+as the AEAD and deterministic crypters.
+
+Each key version of the keyset gives one or more keys, found by the header
+(format byte and Keyczar key hash) of the values they write. Stored values
+are the web-safe base64 of
+
+    format byte | key hash (4 bytes) | what the subclass seals
+
+Values Keyczar wrote with the same keyset start with its 0x00 version byte
+and are handed to it, so they stay readable until they are re-encrypted.
+"""
+import hashlib
+import hmac
+
+from keyczar import keyczar, util
+
+from .fields import (
+    DECRYPT_ERRORS,
+    KeyczarWrapper,
+    base64_length,
+    encoded_headers,
+)
+
+
+HEADER_SIZE = keyczar.HEADER_SIZE
+DERIVED_KEY_SIZE = 32
+
+
+def derive_key(key, info):
+    """
+    A 256 bit key for `info` derived from a Keyczar AES key version, with
+    HKDF-SHA256 (RFC 5869) and no salt.
+    """
+    secret = key.key_bytes + key.hmac_key.key_bytes
+    prk = hmac.new(b'\x00' * DERIVED_KEY_SIZE, secret, hashlib.sha256)
+    return hmac.new(prk.digest(), info + b'\x01', hashlib.sha256).digest()
+
+
+class DerivedKeyWrapper(object):
+    """
+    Subclasses set `format_byte` (the format values are written in) and
+    `overhead` (the bytes sealing adds after the header), and implement:
+
+    * version_keys(key, key_hash): {header: key} for a Keyczar key version
+    * seal(header, cleartext): the value after the header
+    * unseal(header, data): the cleartext of the whole value `data`
+    """
+    format_byte = None
+    overhead = 0
+
+    def __init__(self, keyname, *args, **kwargs):
+        self.legacy = KeyczarWrapper(keyname)
+        keyset = self.legacy.crypter
+
+        # header -> derived key(s), for every key version.
+        self.keys = {}
+        for version in keyset.versions:
+            key = keyset.GetKey(version)
+            self.keys.update(self.version_keys(key, key.Header()[1:]))
+        self.formats = frozenset(header[:1] for header in self.keys)
+
+        self.headers = self.legacy.headers | frozenset(self.keys)
+        self.encoded_headers = encoded_headers(self.headers)
+
+        self.primary_header = None
+        if keyset.primary_key is not None:
+            self.primary_header = (
+                self.format_byte + keyset.primary_key.Header()[1:]
+            )
+
+    def encrypt(self, cleartext):
+        return self.encrypt_many([cleartext])[0]
+
+    def decrypt(self, ciphertext):
+        return self.decrypt_many([ciphertext])[0]
+
+    def encrypt_many(self, cleartexts):
+        return [
+            util.Base64WSEncode(c) for c in self.encrypt_raw_many(cleartexts)
+        ]
+
+    def decrypt_many(self, ciphertexts):
+        return self.decrypt_raw_many(
+            [util.Base64WSDecode(c) for c in ciphertexts]
+        )
+
+    def ciphertext_length(self, cleartext_length, binary=False):
+        length = HEADER_SIZE + self.overhead + cleartext_length
+        return length if binary else base64_length(length)
+
+    def encrypt_raw_many(self, cleartexts):
+        header = self.primary_header
+        if header is None:
+            raise keyczar.errors.NoPrimaryKeyError()
+        return [header + self.seal(header, c) for c in cleartexts]
+
+    def decrypt_raw_many(self, ciphertexts):
+        cleartexts = []
+        for data in ciphertexts:
+            if data[:1] == keyczar.VERSION_BYTE:
+                cleartexts.append(self.legacy.crypter.Decrypt(data, None))
+                continue
+
+            if len(data) < HEADER_SIZE + self.overhead:
+                raise keyczar.errors.ShortCiphertextError(len(data))
+            header = data[:HEADER_SIZE]
+            if header not in self.keys:
+                if data[:1] not in self.formats:
+                    raise keyczar.errors.BadVersionError(ord(data[0]))
+                raise keyczar.errors.KeyNotFoundError(
+                    util.Base64WSEncode(header[1:])
+                )
+            cleartexts.append(self.unseal(header, data))
+        return cleartexts
+
+    def encrypted_with_primary(self, ciphertext):
+        try:
+            header = util.Base64WSDecode(ciphertext[:8])[:HEADER_SIZE]
+        except DECRYPT_ERRORS:
+            return False
+        return header == self.primary_header
@@ -0,0 +1,87 @@
+"""
+Deterministic encryption, for fields that need equality in the database:
+unique constraints, get_or_create, distinct() and joins.
+
+Stored values are the web-safe base64 of
+
+    format byte | key hash (4 bytes) | SIV (16 bytes) | AES-CTR ciphertext
+
+where the SIV ("synthetic IV") is HMAC-SHA256 of the header and the
+cleartext, truncated, and also the initial counter block the cleartext is
+encrypted from. This is the SIV construction of RFC 5297 with HMAC-SHA256
+in place of S2V: equal cleartexts encrypted with the same key version give
+equal ciphertexts, and decrypting checks the SIV, so values are still
+authenticated.
+
+Keys are derived with HKDF from a Keyczar AES keyset, which should be
+dedicated to deterministic fields. Values written by KeyczarWrapper with
+the same keyset stay readable until they are re-encrypted.
+"""
+import binascii
+import hashlib
+import hmac
+
+from Crypto.Cipher import AES
+from Crypto.Util import Counter
+from keyczar import keyczar
+
+from .derived import HEADER_SIZE, DerivedKeyWrapper, derive_key
+
+
+DETERMINISTIC_FORMAT = '\x04'
+
+SIV_SIZE = 16
+
+
+class DeterministicWrapper(DerivedKeyWrapper):
+    format_byte = DETERMINISTIC_FORMAT
+    overhead = SIV_SIZE
+
+    def version_keys(self, key, key_hash):
+        # (encryption key, SIV key)
+        return {
+            DETERMINISTIC_FORMAT + key_hash: (
+                derive_key(key, b'encrypted_fields deterministic AES-CTR'),
+                derive_key(key, b'encrypted_fields deterministic SIV'),
+            ),
+        }
+
+    def seal(self, header, cleartext):
+        encryption_key, siv_key = self.keys[header]
+        siv = self.siv(siv_key, header, cleartext)
+        return siv + self.ctr(encryption_key, siv).encrypt(cleartext)
+
+    def unseal(self, header, data):
+        encryption_key, siv_key = self.keys[header]
+        siv = data[HEADER_SIZE:HEADER_SIZE + SIV_SIZE]
+        cleartext = self.ctr(encryption_key, siv).decrypt(
+            data[HEADER_SIZE + SIV_SIZE:]
+        )
+        if not hmac.compare_digest(
+            siv, self.siv(siv_key, header, cleartext)
+        ):
+            raise keyczar.errors.InvalidSignatureError()
+        return cleartext
+
+    def siv(self, siv_key, header, cleartext):
+        return hmac.new(
+            siv_key, header + cleartext, hashlib.sha256
+        ).digest()[:SIV_SIZE]
+
+    def ctr(self, encryption_key, siv):
+        counter = Counter.new(
+            SIV_SIZE * 8,
+            initial_value=int(binascii.hexlify(siv), 16),
+            allow_wraparound=True,
+        )
+        return AES.new(encryption_key, AES.MODE_CTR, counter=counter)
+
+    def encrypt_raw_all_versions(self, cleartext):
+        """
+        `cleartext` encrypted with every key version, e.g. to look up rows
+        written before the latest key rotation.
+        """
+        return [
+            header + self.seal(header, cleartext)
+            for header in sorted(self.keys)
+        ]
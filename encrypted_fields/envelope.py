@@ -0,0 +1,250 @@
+"""
+Envelope encryption: values are encrypted with data keys, which are in
+turn encrypted ("wrapped") with the field's master keyset and kept in the
+DataKey table.
+
+Each tenant gets its own data key, picked with the `tenant` context
+manager; values written outside of one use the '' tenant. Stored values
+are the web-safe base64 of
+
+    format byte | data key id (8 bytes) | Keyczar AES ciphertext
+
+so reading a value does not need to know the tenant: its data key is
+looked up by id, unwrapped once and then served from `data_key_cache`.
+Rotating the master keyset only means rewrapping the key table (see the
+rewrap_data_keys command), not re-encrypting every row. Values in
+Keyczar's own format, e.g. written before a field switched to
+EnvelopeWrapper, stay readable with the master keyset.
+"""
+import contextlib
+import functools
+import operator
+import os
+import struct
+import threading
+
+from django.db import models, router, transaction
+from keyczar import keyczar, keys, util
+
+from .cache import MISSING, data_key_cache
+from .fields import DECRYPT_ERRORS, KeyczarWrapper, base64_length
+from .models import DataKey
+
+
+ENVELOPE_FORMAT = '\x03'
+KEY_ID = struct.Struct('>Q')
+HEADER_SIZE = 1 + KEY_ID.size
+DATA_KEY_SIZE = 256
+
+_local = threading.local()
+
+
+@contextlib.contextmanager
+def tenant(name):
+    """
+    Encrypt the values written by this thread inside the block with the
+    data key of tenant `name`.
+    """
+    previous = current_tenant()
+    _local.tenant = name
+    try:
+        yield
+    finally:
+        _local.tenant = previous
+
+
+def current_tenant():
+    return getattr(_local, 'tenant', '')
+
+
+def new_key_id():
+    # Random rather than sequential, so the id of a key row that is rolled
+    # back is never given to another key.
+    return KEY_ID.unpack(os.urandom(KEY_ID.size))[0] >> 1 or 1
+
+
+class EnvelopeWrapper(object):
+    """
+    Crypter encrypting values with per-tenant data keys wrapped by the
+    Keyczar keyset in `keyname`. Key rows are stored under the name of that
+    key directory, and only rows wrapped with a key version of the master
+    keyset are used, so master keysets in directories of the same name do
+    not share data keys.
+    """
+
+    def __init__(self, keyname, *args, **kwargs):
+        self.master = KeyczarWrapper(keyname)
+        self.keydir = keyname
+        self.keyname = os.path.basename(os.path.normpath(keyname))
+
+    def key_rows(self, using=None):
+        """
+        The DataKey rows of this master keyset, going by the key hash in
+        the header of their wrapped key.
+        """
+        return DataKey.objects.using(using).filter(
+            functools.reduce(operator.or_, [
+                models.Q(wrapped_key__startswith=header)
+                for header in sorted(self.master.encoded_headers)
+            ]),
+            keyname=self.keyname,
+        )
+
+    def wrap(self, key):
+        return self.master.encrypt(str(key))
+
+    def unwrap(self, wrapped_key):
+        return keys.AesKey.Read(self.master.decrypt(wrapped_key))
+
+    def create_data_key(self, tenant='', using=None):
+        """
+        Create a new data key for `tenant`, which is used for values written
+        from then on. Returns its (id, key).
+        """
+        # Key rows go wherever the router sends DataKey, whichever database
+        # the value being encrypted is saved to.
+        using = using or router.db_for_write(DataKey)
+        key = keys.AesKey.Generate(DATA_KEY_SIZE)
+        with transaction.atomic(using=using):
+            row = DataKey.objects.using(using).create(
+                id=new_key_id(),
+                keyname=self.keyname,
+                tenant=tenant,
+                wrapped_key=self.wrap(key),
+            )
+        data_key_cache.set((self.keydir, row.pk), key)
+        return row.pk, key
+
+    def current_data_key(self, tenant):
+        """
+        The (id, key) of the newest data key of `tenant`, created if there
+        is none yet.
+        """
+        cache_key = (self.keydir, 'tenant', tenant)
+        entry = data_key_cache.get(cache_key)
+        if entry is not MISSING:
+            return entry
+
+        # Look on the database new keys are written to, so that a replica
+        # lagging behind does not make us create another one.
+        using = router.db_for_write(DataKey)
+        row = self.key_rows(using).filter(
+            tenant=tenant
+        ).order_by('-created', '-pk').first()
+        if row is not None:
+            entry = row.pk, self.data_keys([row.pk], rows=[row])[row.pk]
+            data_key_cache.set(cache_key, entry)
+            return entry
+
+        entry = self.create_data_key(tenant, using=using)
+        # Only remember a new key as the tenant's once its row is committed;
+        # values encrypted with it in a rolled back transaction are gone too.
+        transaction.on_commit(
+            lambda: data_key_cache.set(cache_key, entry), using=using
+        )
+        return entry
+
+    def data_keys(self, key_ids, rows=None):
+        """
+        The unwrapped data keys for `key_ids`, as a dict. Keys that are not
+        cached are read from `rows` or else with one query.
+        """
+        found = {}
+        missing = []
+        for key_id in key_ids:
+            key = data_key_cache.get((self.keydir, key_id))
+            if key is MISSING:
+                missing.append(key_id)
+            else:
+                found[key_id] = key
+
+        if missing:
+            if rows is None:
+                rows = self.key_rows().filter(pk__in=missing)
+            for row in rows:
+                key = found[row.pk] = self.unwrap(row.wrapped_key)
+                data_key_cache.set((self.keydir, row.pk), key)
+            for key_id in missing:
+                if key_id not in found:
+                    raise keyczar.errors.KeyNotFoundError(key_id)
+        return found
+
+    def encrypt(self, cleartext):
+        return self.encrypt_many([cleartext])[0]
+
+    def decrypt(self, ciphertext):
+        return self.decrypt_many([ciphertext])[0]
+
+    def encrypt_many(self, cleartexts):
+        return [
+            util.Base64WSEncode(c) for c in self.encrypt_raw_many(cleartexts)
+        ]
+
+    def decrypt_many(self, ciphertexts):
+        return self.decrypt_raw_many(
+            [util.Base64WSDecode(c) for c in ciphertexts]
+        )
+
+    def ciphertext_length(self, cleartext_length, binary=False):
+        length = HEADER_SIZE + self.master.ciphertext_length(
+            cleartext_length, binary=True
+        )
+        return length if binary else base64_length(length)
+
+    def encrypt_raw_many(self, cleartexts):
+        if not cleartexts:
+            return []
+        key_id, key = self.current_data_key(current_tenant())
+        header = ENVELOPE_FORMAT + KEY_ID.pack(key_id)
+        return [header + key.Encrypt(c) for c in cleartexts]
+
+    def decrypt_raw_many(self, ciphertexts):
+        key_ids = set()
+        legacy = []
+        for data in ciphertexts:
+            if data[:1] != ENVELOPE_FORMAT:
+                legacy.append(data)
+            elif len(data) < HEADER_SIZE:
+                raise keyczar.errors.ShortCiphertextError(len(data))
+            else:
+                key_ids.add(KEY_ID.unpack(data[1:HEADER_SIZE])[0])
+
+        # One lookup for all the data keys of the batch.
+        data_keys = self.data_keys(key_ids)
+        legacy = iter(self.master.decrypt_raw_many(legacy))
+        cleartexts = []
+        for data in ciphertexts:
+            if data[:1] != ENVELOPE_FORMAT:
+                cleartexts.append(next(legacy))
+                continue
+            key_id = KEY_ID.unpack(data[1:HEADER_SIZE])[0]
+            cleartexts.append(data_keys[key_id].Decrypt(data[HEADER_SIZE:]))
+        return cleartexts
+
+    def encrypted_with_primary(self, ciphertext):
+        """
+        Whether `ciphertext` is an envelope value. Those stay valid when the
+        master keyset rotates, only their data keys need rewrapping.
+        """
+        try:
+            return util.Base64WSDecode(ciphertext[:8])[:1] == ENVELOPE_FORMAT
+        except DECRYPT_ERRORS:
+            return False
+
+    def rewrap_data_keys(self, using=None):
+        """
+        Re-encrypt the data keys that are not wrapped with the current
+        primary key of the master keyset. Returns how many were rewrapped.
+        """
+        rows = self.key_rows(using)
+        rewrapped = 0
+        for pk, wrapped_key in rows.values_list('pk', 'wrapped_key'):
+            if self.master.encrypted_with_primary(wrapped_key):
+                continue
+            rows.filter(pk=pk).update(
+                wrapped_key=self.master.encrypt(
+                    self.master.decrypt(wrapped_key)
+                )
+            )
+            rewrapped += 1
+        return rewrapped
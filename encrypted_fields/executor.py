@@ -0,0 +1,59 @@
+"""
+Executor that encryption work can be offloaded to, so that event-loop
+based servers (Tornado, Twisted, gevent) are not blocked by it.
+
+The `*_async` functions and methods submit work here and return an
+AsyncResult: call `.get()` for the result, or pass `callback` to be called
+with it from the executor thread once it is ready.
+"""
+import threading
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+DEFAULT_WORKERS = 4
+
+_lock = threading.Lock()
+_executor = None
+
+
+def get_executor():
+    """
+    The shared executor: whatever the factory named by the setting
+    ENCRYPTED_FIELDS_EXECUTOR (a dotted path) returns, or a ThreadPool of
+    ENCRYPTED_FIELDS_EXECUTOR_WORKERS threads. Anything with a
+    multiprocessing style `apply_async` that runs callables in this
+    process will do.
+    """
+    global _executor
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                factory = getattr(settings, 'ENCRYPTED_FIELDS_EXECUTOR', None)
+                if factory:
+                    _executor = import_string(factory)()
+                else:
+                    _executor = ThreadPool(getattr(
+                        settings, 'ENCRYPTED_FIELDS_EXECUTOR_WORKERS',
+                        DEFAULT_WORKERS
+                    ))
+    return _executor
+
+
+def set_executor(executor):
+    """
+    Use `executor` from now on. The previous one is not shut down.
+    """
+    global _executor
+    with _lock:
+        _executor = executor
+
+
+def submit(func, args=(), kwargs=None, callback=None, executor=None):
+    """
+    Run `func(*args, **kwargs)` on `executor` (by default the shared one).
+    """
+    executor = executor or get_executor()
+    return executor.apply_async(func, args, kwargs or {}, callback)
@@ -1,30 +1,134 @@
 
+import binascii
+import contextlib
+import copy
+import json
 import os
+import threading
+import timeit
 import types
 
-import django
-from django.db import models
+from django.db import models, router
 from django.conf import settings
-from django.core.exceptions import ImproperlyConfigured
-from django.utils.functional import cached_property
+from django.core import checks
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.db.models.signals import post_init, post_save
+from django.utils.functional import SimpleLazyObject, cached_property, empty
+from django.utils.module_loading import import_string
 
 try:
     from django.utils.encoding import smart_text
 except ImportError:
     from django.utils.encoding import smart_str as smart_text
 
-from keyczar import keyczar
+from keyczar import keyczar, util
+
+from . import (
+    buckets,
+    compression,
+    executor,
+    instrumentation,
+    keysources,
+    serializers,
+)
+from .cache import MISSING, cache_key, data_key_cache, plaintext_cache
+from .lookups import (
+    BLIND_INDEX_LOOKUPS,
+    DETERMINISTIC_LOOKUPS,
+    ENCRYPTED_FIELD_LOOKUPS,
+    RANGE_INDEX_LOOKUPS,
+)
 
 
 class EncryptedFieldException(Exception):
     pass
 
 
+# The ciphertext behind the value each field returned most recently from
+# from_db_value, keyed by id(field), so remember_loaded_ciphertexts can pick
+# it up once Model.__init__ has assigned that value.
+_last_loaded = threading.local()
+
+# Instance attribute holding {attname: (cleartext, ciphertext)} for the
+# encrypted values an instance was loaded with.
+LOADED_CIPHERTEXTS = '_encrypted_fields_loaded'
+
+# Depth of the raw_ciphertext() blocks the current thread is in.
+_raw = threading.local()
+
+
+@contextlib.contextmanager
+def raw_ciphertext():
+    """
+    Inside the block, encrypted fields in this thread pass their stored
+    values through untouched: loaded instances hold the ciphertext rather
+    than the cleartext, serializers write it out (binary ciphertext as
+    web-safe base64) and saving writes it back as it is. For dumpdata,
+    loaddata and copies between databases, which would otherwise decrypt
+    and re-encrypt every value.
+    """
+    _raw.depth = getattr(_raw, 'depth', 0) + 1
+    try:
+        yield
+    finally:
+        _raw.depth -= 1
+
+
+def in_raw_mode():
+    return getattr(_raw, 'depth', 0) > 0
+
+
+# Errors that mean "this value is not ciphertext we can read" when decrypting.
+DECRYPT_ERRORS = (
+    keyczar.errors.KeyczarError,
+    UnicodeEncodeError,
+    binascii.Error,
+)
+
+
+# Types database drivers use for the contents of binary columns.
+try:
+    BINARY_TYPES = (bytearray, memoryview, buffer)
+except NameError:
+    BINARY_TYPES = (bytearray, memoryview)
+
+
+# Layout of Keyczar AES ciphertexts: header | IV | padded data | HMAC-SHA1
+AES_BLOCK_SIZE = 16
+HMAC_SIZE = 20
+
+
+def base64_length(length):
+    """
+    Length of the unpadded web-safe base64 of `length` bytes.
+    """
+    return (length * 4 + 2) // 3
+
+
+def encoded_headers(headers):
+    """
+    The first six characters of the web-safe base64 of ciphertexts starting
+    with each of `headers`. They encode the format byte and the leading 28
+    bits of the key hash.
+    """
+    return frozenset(
+        util.Base64WSEncode(header + '\x00')[:6] for header in headers
+    )
+
+
 # Simple wrapper around keyczar to standardize the initialization
 # of the crypter object and allow for others to extend as needed.
 class KeyczarWrapper(object):
     def __init__(self, keyname, *args, **kwargs):
-        self.crypter = keyczar.Crypter.Read(keyname)
+        self.crypter = keyczar.Crypter(keysources.reader(keyname))
+
+        # Headers (version byte and key hash) of every key version, for
+        # telling ciphertext from cleartext without trying to decrypt it.
+        self.headers = frozenset(
+            self.crypter.GetKey(version).Header()
+            for version in self.crypter.versions
+        )
+        self.encoded_headers = encoded_headers(self.headers)
 
     def encrypt(self, cleartext):
         return self.crypter.Encrypt(cleartext)
@@ -32,6 +136,336 @@ class KeyczarWrapper(object):
     def decrypt(self, ciphertext):
         return self.crypter.Decrypt(ciphertext)
 
+    def encrypt_many(self, cleartexts):
+        return [
+            util.Base64WSEncode(c) for c in self.encrypt_raw_many(cleartexts)
+        ]
+
+    def decrypt_many(self, ciphertexts):
+        return self.decrypt_raw_many(
+            [util.Base64WSDecode(c) for c in ciphertexts]
+        )
+
+    def ciphertext_length(self, cleartext_length, binary=False):
+        """
+        Exact length of the ciphertext of `cleartext_length` bytes, as raw
+        bytes with `binary` or web-safe base64 otherwise.
+        """
+        padded = (cleartext_length // AES_BLOCK_SIZE + 1) * AES_BLOCK_SIZE
+        length = keyczar.HEADER_SIZE + AES_BLOCK_SIZE + padded + HMAC_SIZE
+        return length if binary else base64_length(length)
+
+    def encrypt_raw_many(self, cleartexts):
+        # Resolve the primary key once for the whole batch instead of
+        # once per value.
+        key = self.crypter.primary_key
+        if key is None:
+            raise keyczar.errors.NoPrimaryKeyError()
+        return [key.Encrypt(c) for c in cleartexts]
+
+    def decrypt_raw_many(self, ciphertexts):
+        # Values in a batch are almost always written with the same key, so
+        # only parse each distinct header once.
+        keys = {}
+        cleartexts = []
+        for data in ciphertexts:
+            if len(data) < keyczar.HEADER_SIZE:
+                raise keyczar.errors.ShortCiphertextError(len(data))
+            header = data[:keyczar.HEADER_SIZE]
+            key = keys.get(header)
+            if key is None:
+                key = keys[header] = self.crypter._ParseHeader(header)
+            cleartexts.append(key.Decrypt(data))
+        return cleartexts
+
+    def encrypted_with_primary(self, ciphertext):
+        """
+        Whether `ciphertext` was written with the current primary key, going
+        by the key hash in its header. Used to skip values during rotation.
+        """
+        try:
+            header = util.Base64WSDecode(ciphertext[:8])[:keyczar.HEADER_SIZE]
+        except DECRYPT_ERRORS:
+            return False
+        return header == self.crypter.primary_key.Header()
+
+
+class KeyczarHmacWrapper(object):
+    """
+    Keyed hash for blind indexes, using the primary key of a Keyczar
+    HMAC_SHA1 keyset (purpose sign).
+    """
+
+    def __init__(self, keyname, *args, **kwargs):
+        self.signer = keyczar.Signer(keysources.reader(keyname))
+
+    def digest(self, data):
+        return util.Base64WSEncode(self.signer.primary_key.Sign(data))
+
+
+def encrypt_many(crypter, cleartexts, binary=False):
+    """
+    Encrypt a batch of values with `crypter`, falling back to one `encrypt`
+    call per value for crypters that do not implement `encrypt_many`.
+
+    With `binary` the raw ciphertext bytes are returned rather than their
+    web-safe base64, from `encrypt_raw_many` if the crypter has it.
+    """
+    if binary:
+        if hasattr(crypter, 'encrypt_raw_many'):
+            return crypter.encrypt_raw_many(cleartexts)
+        return [
+            util.Base64WSDecode(ciphertext)
+            for ciphertext in encrypt_many(crypter, cleartexts)
+        ]
+    if hasattr(crypter, 'encrypt_many'):
+        return crypter.encrypt_many(cleartexts)
+    return [crypter.encrypt(cleartext) for cleartext in cleartexts]
+
+
+def decrypt_many(crypter, ciphertexts, binary=False):
+    """
+    Decrypt a batch of values with `crypter`, falling back to one `decrypt`
+    call per value for crypters that do not implement `decrypt_many`.
+
+    With `binary` the ciphertexts are raw bytes rather than web-safe base64.
+    """
+    if binary:
+        if hasattr(crypter, 'decrypt_raw_many'):
+            return crypter.decrypt_raw_many(ciphertexts)
+        ciphertexts = [util.Base64WSEncode(c) for c in ciphertexts]
+    if hasattr(crypter, 'decrypt_many'):
+        return crypter.decrypt_many(ciphertexts)
+    return [crypter.decrypt(ciphertext) for ciphertext in ciphertexts]
+
+
+def encrypt_many_async(crypter, cleartexts, binary=False, callback=None):
+    """
+    `encrypt_many` run on the executor; returns an AsyncResult.
+    """
+    return executor.submit(
+        encrypt_many, (crypter, cleartexts), {'binary': binary}, callback
+    )
+
+
+def decrypt_many_async(crypter, ciphertexts, binary=False, callback=None):
+    """
+    `decrypt_many` run on the executor; returns an AsyncResult.
+    """
+    return executor.submit(
+        decrypt_many, (crypter, ciphertexts), {'binary': binary}, callback
+    )
+
+
+def binary_bytes(value):
+    """
+    The bytes of a value read from a binary column, which database drivers
+    return as buffer, memoryview or bytearray.
+    """
+    if isinstance(value, memoryview):
+        return value.tobytes()
+    if isinstance(value, BINARY_TYPES):
+        return bytes(value)
+    return value
+
+
+def keydir_for(keyname=None):
+    """
+    The key directory of the encryption keyset named `keyname`, in
+    DEFAULT_KEY_DIRECTORY, or else settings.ENCRYPTED_FIELDS_KEYDIR.
+    """
+    # If settings.DEFAULT_KEY_DIRECTORY, then the key
+    # is located in DEFAULT_KEY_DIRECTORY/keyname
+    if keyname:
+        if hasattr(settings, 'DEFAULT_KEY_DIRECTORY'):
+            return os.path.join(settings.DEFAULT_KEY_DIRECTORY, keyname)
+        raise ImproperlyConfigured(
+            'You must set settings.DEFAULT_KEY_DIRECTORY'
+            'when using the keyname kwarg'
+        )
+
+    # If the keyname is not defined on a per-field
+    # basis, then check for the global data encryption key.
+    keydir = getattr(settings, 'ENCRYPTED_FIELDS_KEYDIR', None)
+    if not keydir:
+        raise ImproperlyConfigured(
+            'You must set settings.ENCRYPTED_FIELDS_KEYDIR '
+            'or name a key with kwarg `keyname`'
+        )
+    return keydir
+
+
+def index_keydir(keyname, kwarg, setting_names):
+    """
+    The key directory of the HMAC keyset of an index: `keyname` in
+    DEFAULT_KEY_DIRECTORY, or else the first of `setting_names` that is set.
+    """
+    if keyname:
+        if not hasattr(settings, 'DEFAULT_KEY_DIRECTORY'):
+            raise ImproperlyConfigured(
+                'You must set settings.DEFAULT_KEY_DIRECTORY '
+                'when using the {0} kwarg'.format(kwarg)
+            )
+        return os.path.join(settings.DEFAULT_KEY_DIRECTORY, keyname)
+
+    for name in setting_names:
+        keydir = getattr(settings, name, None)
+        if keydir:
+            return keydir
+    raise ImproperlyConfigured(
+        'You must set settings.{0} or name a key with kwarg `{1}`'.format(
+            setting_names[0], kwarg
+        )
+    )
+
+
+def default_crypter_klass():
+    path = getattr(settings, 'ENCRYPTED_FIELDS_CRYPTER', None)
+    if path:
+        return import_string(path)
+    return KeyczarWrapper
+
+
+class CrypterRegistry(object):
+    """
+    Process-wide cache of crypter objects keyed by (crypter_klass, keydir).
+
+    Every field pointing at the same key directory shares one crypter, so a
+    keyset is read and parsed once per process rather than once per field.
+    Crypters are created lazily on first use. Call `invalidate` or `reload`
+    after rotating key material so the new keyset is picked up.
+
+    `load_times` holds how many seconds creating each crypter took.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._crypters = {}
+        self.load_times = {}
+
+    def _load(self, key):
+        start = timeit.default_timer()
+        crypter = key[0](key[1])
+        self.load_times[key] = timeit.default_timer() - start
+        return crypter
+
+    def get(self, crypter_klass, keydir):
+        key = (crypter_klass, keydir)
+        try:
+            return self._crypters[key]
+        except KeyError:
+            pass
+
+        with self._lock:
+            # Another thread may have loaded it while we waited on the lock.
+            crypter = self._crypters.get(key)
+            if crypter is None:
+                crypter = self._load(key)
+                self._crypters[key] = crypter
+            return crypter
+
+    def _matching(self, keydir, crypter_klass):
+        return [
+            key for key in self._crypters
+            if (crypter_klass is None or key[0] is crypter_klass) and
+            (keydir is None or key[1] == keydir)
+        ]
+
+    def invalidate(self, keydir=None, crypter_klass=None):
+        """
+        Drop cached crypters so they are read again on next use. With no
+        arguments every crypter is dropped.
+        """
+        with self._lock:
+            for key in self._matching(keydir, crypter_klass):
+                del self._crypters[key]
+                self.load_times.pop(key, None)
+        keysources.clear()
+        plaintext_cache.clear()
+        data_key_cache.clear()
+
+    def reload(self, keydir=None, crypter_klass=None):
+        """
+        Eagerly re-read the key material of cached crypters. The old crypter
+        keeps serving other threads until its replacement is ready.
+        """
+        with self._lock:
+            keys = self._matching(keydir, crypter_klass)
+        keysources.clear()
+        fresh = dict((key, self._load(key)) for key in keys)
+        with self._lock:
+            self._crypters.update(fresh)
+        plaintext_cache.clear()
+        data_key_cache.clear()
+
+
+crypters = CrypterRegistry()
+
+
+class LazyCleartext(SimpleLazyObject):
+    """
+    Stand-in for the value of a `lazy` field as loaded from the database. It
+    holds the ciphertext and only decrypts it when first used.
+    """
+
+    def __init__(self, field, ciphertext, cleartext=empty):
+        self.__dict__['ciphertext'] = ciphertext
+        super(LazyCleartext, self).__init__(
+            lambda: field.to_python(ciphertext)
+        )
+        if cleartext is not empty:
+            self._wrapped = cleartext
+
+    def resolve(self):
+        if self._wrapped is empty:
+            self._setup()
+        return self._wrapped
+
+
+class DecryptingAttribute(object):
+    """
+    Model attribute for `lazy` encrypted fields. Decrypts the ciphertext
+    they are loaded with on first access and caches the cleartext on the
+    instance.
+    """
+
+    def __init__(self, field):
+        self.field = field
+
+    def __get__(self, instance, cls=None):
+        if instance is None:
+            return self
+        attname = self.field.attname
+        if attname not in instance.__dict__:
+            # Deferred, e.g. by only(); load it like Django's own attribute.
+            instance.refresh_from_db(fields=[attname])
+        value = instance.__dict__[attname]
+        if isinstance(value, LazyCleartext):
+            lazy = value
+            value = instance.__dict__[attname] = lazy.resolve()
+            self.field.remember_ciphertext(instance, value, lazy.ciphertext)
+        return value
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.field.attname] = value
+
+
+def remember_loaded_ciphertexts(sender, instance, **kwargs):
+    """
+    post_init receiver remembering the ciphertext each encrypted value of an
+    instance loaded from the database was decrypted from, so an unchanged
+    value does not need to be encrypted again on save.
+    """
+    for field in sender._meta.concrete_fields:
+        if not isinstance(field, EncryptedFieldMixin):
+            continue
+        loaded = _last_loaded.__dict__.pop(id(field), None)
+        value = instance.__dict__.get(field.attname)
+        if isinstance(value, LazyCleartext):
+            field.remember_ciphertext(instance, value, value.ciphertext)
+        elif loaded is not None and loaded[0] is value:
+            field.remember_ciphertext(instance, value, loaded[1])
+
 
 class EncryptedFieldMixin(object):
     """
@@ -65,6 +499,24 @@ class EncryptedFieldMixin(object):
     kwarg 'decrypt_only' to specify this behavior and the model will not
     encrypt the data inbound and only attempt to decrypt outbound.
 
+    Wide models often load encrypted columns that a given code path never
+    reads. With the kwarg 'lazy' the field keeps the ciphertext it loaded
+    and only decrypts it the first time the attribute is accessed. Note that
+    values()/values_list() return LazyCleartext proxies for such fields.
+
+    Encrypted values cannot be compared in SQL. With the kwarg 'blind_index'
+    the field maintains a companion column holding a keyed hash (HMAC) of
+    the cleartext, and 'exact'/'in' lookups are answered from that indexed
+    column. The HMAC key is a separate Keyczar keyset: either
+    DEFAULT_KEY_DIRECTORY/<blind_index_keyname> or the setting
+    ENCRYPTED_FIELDS_BLIND_INDEX_KEYDIR. Equal values have equal hashes, so
+    the index reveals which rows share a value.
+
+    Likewise, with the kwarg 'range_index' a date, datetime or number field
+    keeps a keyed hash of a coarse bucket of its value, which
+    EncryptedQuerySet.in_range uses to prune rows in the database before
+    checking gt/gte/lt/lte and range lookups on the decrypted values.
+
     Encrypting data will significantly change the size of the data being stored
     and this may cause issues with your database column size. Before storing
     any encrypted data in your database, ensure that you have the proper
@@ -79,50 +531,79 @@ class EncryptedFieldMixin(object):
     prefix if specified) is greater than the max_length of the field.
     """
 
-    if django.VERSION < (1, 8):
-        __metaclass__ = models.SubfieldBase
+    # Serializers tried in turn to encode values before encrypting them;
+    # values none of them handles are written as text.
+    cleartext_serializers = ()
 
     def __init__(self, *args, **kwargs):
         """
         Initialize the EncryptedFieldMixin with the following
         optional settings:
         * keyname: The name of the keyczar key
-        * crypter_klass: A custom class that is extended from Keyczar.
+        * crypter_klass: A custom class that is extended from Keyczar, or
+                         another crypter such as AESGCMWrapper. Defaults to
+                         settings.ENCRYPTED_FIELDS_CRYPTER or KeyczarWrapper.
         * prefix: A static string prepended to all encrypted data
         * decrypt_only: Boolean whether to only attempt to decrypt data coming
                         from the database and not attempt to encrypt the data
                         being written to the database.
+        * lazy: Boolean whether to defer decryption of loaded values until
+                the attribute is first accessed.
+        * binary: Boolean whether to store the raw ciphertext bytes in a
+                  binary column instead of base64 text.
+        * compress: True or the name of a compressor ('zlib', 'bz2' or
+                    'lzma') to compress values before encrypting them.
+        * compress_min_length: Only compress values at least this long.
+        * cache: Boolean whether to keep decrypted values in the shared
+                 in-process plaintext cache.
+        * blind_index: True, or the name of the companion column, to keep a
+                       keyed hash of the value for exact/in lookups.
+        * blind_index_keyname: The name of the keyczar HMAC key used for the
+                               blind index.
+        * deterministic: Boolean whether equal values encrypt to equal
+                         ciphertexts, for unique constraints and lookups.
+        * range_index: For date fields 'year', 'month' (or True), 'week' or
+                       'day', for number fields the width of a bucket, to
+                       keep a keyed hash of the value's bucket for
+                       in_range.
+        * range_index_bounds: (low, high) that open ended range lookups run
+                              to.
+        * range_index_keyname: The name of the keyczar HMAC key used for the
+                               range index.
         """
-        # Allow for custom class extensions of Keyczar.
-        self._crypter_klass = kwargs.pop('crypter_klass', KeyczarWrapper)
+        # Allow for custom class extensions of Keyczar, or another crypter
+        # such as encrypted_fields.aead.AESGCMWrapper, either per field or
+        # for all fields with settings.ENCRYPTED_FIELDS_CRYPTER.
+        self.deterministic = kwargs.pop('deterministic', False)
+        if self.deterministic and not isinstance(
+            self, (models.CharField, models.TextField)
+        ):
+            # Few distinct values, e.g. booleans, would be plain to see.
+            raise ImproperlyConfigured(
+                'Only text fields can use deterministic encryption'
+            )
+        self._crypter_klass = kwargs.pop('crypter_klass', None)
+        if self._crypter_klass is None and self.deterministic:
+            from .deterministic import DeterministicWrapper
+            self._crypter_klass = DeterministicWrapper
+        if self._crypter_klass is None:
+            self._crypter_klass = default_crypter_klass()
 
         self.keyname = kwargs.pop('keyname', None)
 
-        # If settings.DEFAULT_KEY_DIRECTORY, then the key
-        # is located in DEFAULT_KEY_DIRECTORY/keyname
-        if self.keyname:
-            if hasattr(settings, 'DEFAULT_KEY_DIRECTORY'):
-                self.keydir = os.path.join(
-                    settings.DEFAULT_KEY_DIRECTORY,
-                    self.keyname
-                )
-            else:
+        # Deterministic fields use a keyset of their own.
+        if not self.keyname and self.deterministic:
+            self.keydir = getattr(
+                settings, 'ENCRYPTED_FIELDS_DETERMINISTIC_KEYDIR', None
+            )
+            if not self.keydir:
                 raise ImproperlyConfigured(
-                    'You must set settings.DEFAULT_KEY_DIRECTORY'
-                    'when using the keyname kwarg'
+                    'You must set '
+                    'settings.ENCRYPTED_FIELDS_DETERMINISTIC_KEYDIR or name '
+                    'a key with kwarg `keyname`'
                 )
-
-        # If the keyname is not defined on a per-field
-        # basis, then check for the global data encryption key.
-        if not self.keyname and hasattr(settings, 'ENCRYPTED_FIELDS_KEYDIR'):
-            self.keydir = settings.ENCRYPTED_FIELDS_KEYDIR
-
-        # If we still do not have a keydir, then raise an exception
-        if not self.keydir:
-            raise ImproperlyConfigured(
-                'You must set settings.ENCRYPTED_FIELDS_KEYDIR '
-                'or name a key with kwarg `keyname`'
-            )
+        else:
+            self.keydir = keydir_for(self.keyname)
 
         # The name of the keyczar key without path for logging purposes.
         self.keyname = os.path.dirname(self.keydir)
@@ -136,7 +617,80 @@ class EncryptedFieldMixin(object):
         # to be encrypted.
         self.decrypt_only = kwargs.pop('decrypt_only', False)
 
-        self.load_crypter()
+        # Defer decryption of loaded values until they are first read.
+        self.lazy = kwargs.pop('lazy', False)
+
+        # Compress large values before encrypting them; ciphertext does
+        # not compress.
+        self.compress = kwargs.pop('compress', None)
+        if self.compress is True:
+            self.compress = compression.DEFAULT_COMPRESSOR
+        if self.compress and self.compress not in compression.COMPRESSORS:
+            raise ImproperlyConfigured(
+                'Unknown compressor {0!r}, expected one of {1}'.format(
+                    self.compress, ', '.join(sorted(compression.COMPRESSORS))
+                )
+            )
+        self.compress_min_length = kwargs.pop('compress_min_length', 256)
+
+        # Keep decrypted values of frequently read rows in memory.
+        self.cache = kwargs.pop('cache', False)
+
+        # Store raw ciphertext in a binary column rather than base64 text.
+        self.binary = kwargs.pop('binary', False)
+        if self.binary and self.decrypt_only:
+            raise ImproperlyConfigured(
+                'decrypt_only fields cannot use binary storage'
+            )
+
+        # Keep a keyed hash of the cleartext in a companion column so that
+        # exact lookups can use a database index.
+        self.blind_index = kwargs.pop('blind_index', False)
+        self.blind_index_keyname = kwargs.pop('blind_index_keyname', None)
+        self.blind_index_keydir = None
+        if self.blind_index:
+            self.blind_index_keydir = index_keydir(
+                self.blind_index_keyname,
+                'blind_index_keyname',
+                ['ENCRYPTED_FIELDS_BLIND_INDEX_KEYDIR'],
+            )
+
+        # Keep a keyed hash of a coarse bucket of the value in a companion
+        # column so that range lookups can prune rows in the database.
+        self.range_index = kwargs.pop('range_index', None)
+        self.range_index_bounds = kwargs.pop('range_index_bounds', None)
+        self.range_index_keyname = kwargs.pop('range_index_keyname', None)
+        self.range_index_keydir = None
+        if self.range_index:
+            if isinstance(self, models.DateField):
+                if self.range_index is True:
+                    self.range_index = buckets.DEFAULT_DATE_BUCKET
+                if self.range_index not in buckets.DATE_BUCKETS:
+                    raise ImproperlyConfigured(
+                        'range_index of a date field must be one of '
+                        '{0}'.format(', '.join(sorted(buckets.DATE_BUCKETS)))
+                    )
+            elif isinstance(self, (models.IntegerField, models.FloatField)):
+                if (
+                    isinstance(self.range_index, bool) or
+                    not isinstance(self.range_index, (int, long, float)) or
+                    self.range_index <= 0
+                ):
+                    raise ImproperlyConfigured(
+                        'range_index of a number field must be the positive '
+                        'width of its buckets'
+                    )
+            else:
+                raise ImproperlyConfigured(
+                    'Only date, datetime and number fields can have a '
+                    'range_index'
+                )
+            self.range_index_keydir = index_keydir(
+                self.range_index_keyname,
+                'range_index_keyname',
+                ['ENCRYPTED_FIELDS_RANGE_INDEX_KEYDIR',
+                 'ENCRYPTED_FIELDS_BLIND_INDEX_KEYDIR'],
+            )
 
         # Ensure the encrypted data does not exceed the max_length
         # of the database. Data truncation is a possibility otherwise.
@@ -151,49 +705,704 @@ class EncryptedFieldMixin(object):
         super(EncryptedFieldMixin, self).__init__(*args, **kwargs)
 
     def crypter(self):
-        return self._crypter
+        # The keyset is only read the first time any field using this
+        # key directory actually encrypts or decrypts something.
+        return crypters.get(self._crypter_klass, self.keydir)
 
     def get_internal_type(self):
+        if self.binary:
+            return 'BinaryField'
         return 'TextField'
 
+    def deconstruct(self):
+        name, path, args, kwargs = super(
+            EncryptedFieldMixin, self
+        ).deconstruct()
+        if self.binary:
+            kwargs['binary'] = True
+        return name, path, args, kwargs
+
+    def storage_field(self):
+        """
+        A plain field of the column type, for reading or writing stored
+        ciphertext without decrypting or encrypting it.
+        """
+        if self.binary:
+            return models.BinaryField()
+        return models.TextField()
+
     def load_crypter(self):
-        self._crypter = self._crypter_klass(self.keydir)
+        return self.crypter()
+
+    def contribute_to_class(self, cls, name, *args, **kwargs):
+        super(EncryptedFieldMixin, self).contribute_to_class(
+            cls, name, *args, **kwargs
+        )
+        if self.lazy:
+            setattr(cls, self.attname, DecryptingAttribute(self))
+        if not cls._meta.abstract:
+            post_init.connect(
+                remember_loaded_ciphertexts, sender=cls, weak=False,
+                dispatch_uid='encrypted_fields.remember_loaded_ciphertexts',
+            )
+
+        if self.blind_index and not cls._meta.abstract:
+            index_name = self.blind_index_name
+            if index_name not in [f.name for f in cls._meta.local_fields]:
+                cls.add_to_class(index_name, BlindIndexField(source=name))
+
+        if self.range_index and not cls._meta.abstract:
+            index_name = self.range_index_name
+            if index_name not in [f.name for f in cls._meta.local_fields]:
+                cls.add_to_class(index_name, RangeIndexField(source=name))
+
+        if (self.blind_index or self.range_index) and not cls._meta.abstract:
+            post_save.connect(
+                save_stale_indexes, sender=cls, weak=False,
+                dispatch_uid='encrypted_fields.save_stale_indexes',
+            )
+
+    def index_fields(self):
+        """
+        The blind and range index columns kept for this field.
+        """
+        return [
+            field for field in self.model._meta.concrete_fields
+            if isinstance(field, BlindIndexField) and
+            field.source == self.name
+        ]
+
+    @property
+    def blind_index_name(self):
+        if self.blind_index is True:
+            return '{0}_blind_index'.format(self.name)
+        return self.blind_index
+
+    @property
+    def blind_index_field(self):
+        return self.model._meta.get_field(self.blind_index_name)
+
+    def blind_index_value(self, value):
+        """
+        The keyed hash stored in the blind index column for `value`.
+        """
+        value = super(EncryptedFieldMixin, self).get_prep_value(value)
+        if value is None:
+            return None
+        hasher = crypters.get(KeyczarHmacWrapper, self.blind_index_keydir)
+        # Keep hashing the legacy encoding, so existing indexes stay valid.
+        return hasher.digest(serializers.legacy_dumps(value))
+
+    @property
+    def range_index_name(self):
+        return '{0}_range_index'.format(self.name)
+
+    @property
+    def range_index_field(self):
+        return self.model._meta.get_field(self.range_index_name)
+
+    def range_value(self, value):
+        """
+        `value`, as looked up or as held by an instance, in the form its
+        range is checked in.
+        """
+        value = super(EncryptedFieldMixin, self).to_python(value)
+        return super(EncryptedFieldMixin, self).get_prep_value(value)
+
+    def range_index_digest(self, bucket):
+        hasher = crypters.get(KeyczarHmacWrapper, self.range_index_keydir)
+        return hasher.digest('{0}:{1}'.format(self.range_index, bucket))
+
+    def range_index_value(self, value):
+        """
+        The keyed hash of the bucket of `value` stored in the range index
+        column.
+        """
+        value = super(EncryptedFieldMixin, self).get_prep_value(value)
+        if value is None:
+            return None
+        bounds = self.range_index_bounds
+        if bounds is not None:
+            low, high = [self.range_value(bound) for bound in bounds]
+            if not low <= value <= high:
+                # Open ended lookups only cover the buckets within bounds,
+                # so they would never find this row.
+                raise ValueError(
+                    '{0!r} is outside the range_index_bounds of {1}'.format(
+                        value, self.name
+                    )
+                )
+        return self.range_index_digest(
+            buckets.bucket(value, self.range_index)
+        )
+
+    def range_index_digests(self, low, high):
+        """
+        The range index values of every bucket holding values from `low` to
+        `high` (either may be None for an open end).
+        """
+        bounds = self.range_index_bounds
+        if bounds is not None:
+            bounds = [self.range_value(bound) for bound in bounds]
+        return [
+            self.range_index_digest(bucket)
+            for bucket in buckets.buckets(
+                None if low is None else self.range_value(low),
+                None if high is None else self.range_value(high),
+                self.range_index,
+                bounds,
+            )
+        ]
+
+    def get_lookup(self, lookup_name):
+        if self.range_index and lookup_name in RANGE_INDEX_LOOKUPS:
+            return RANGE_INDEX_LOOKUPS[lookup_name]
+        if self.blind_index and lookup_name in BLIND_INDEX_LOOKUPS:
+            return BLIND_INDEX_LOOKUPS[lookup_name]
+        if self.deterministic and lookup_name in DETERMINISTIC_LOOKUPS:
+            return DETERMINISTIC_LOOKUPS[lookup_name]
+        if lookup_name in ENCRYPTED_FIELD_LOOKUPS:
+            return ENCRYPTED_FIELD_LOOKUPS[lookup_name]
+        return super(EncryptedFieldMixin, self).get_lookup(lookup_name)
+
+    def ciphertext_heads(self):
+        """
+        Strings every stored ciphertext of this field starts with (and that
+        cleartext normally does not): the prefix, or else the start of the
+        base64 of each key's header.
+        """
+        if self.binary:
+            raise ValueError(
+                '{0} uses binary storage, which holds no cleartext'.format(
+                    self.name
+                )
+            )
+        if self.prefix:
+            return [self.prefix]
+        heads = getattr(self.crypter(), 'encoded_headers', None)
+        if not heads:
+            raise ValueError(
+                'Cannot tell ciphertext of {0} from cleartext: set a prefix '
+                'or use a crypter with encoded_headers'.format(self.name)
+            )
+        return sorted(heads)
 
     def from_db_value(self, value, expression, connection, context):
-        return self.to_python(value)
+        if value is None:
+            return value
+        if self.binary:
+            value = binary_bytes(value)
+        if in_raw_mode():
+            _last_loaded.__dict__[id(self)] = (value, value)
+            return value
+        if self.lazy:
+            return LazyCleartext(self, value)
+
+        cleartext = self.to_python(value)
+        _last_loaded.__dict__[id(self)] = (cleartext, value)
+        return cleartext
+
+    def remember_ciphertext(self, instance, cleartext, ciphertext):
+        """
+        Record that `cleartext` was loaded into `instance` from `ciphertext`.
+        """
+        loaded = instance.__dict__.setdefault(LOADED_CIPHERTEXTS, {})
+        loaded[self.attname] = (cleartext, ciphertext)
+
+    def loaded_ciphertext(self, instance, value):
+        """
+        The ciphertext `instance` was loaded with, if its cleartext is still
+        equal to `value`; None otherwise.
+        """
+        loaded = instance.__dict__.get(LOADED_CIPHERTEXTS, {}).get(
+            self.attname
+        )
+        if loaded is None:
+            return None
+
+        cleartext, ciphertext = loaded
+        if value is cleartext:
+            return ciphertext
+        try:
+            if value == cleartext:
+                return ciphertext
+        except TypeError:
+            # e.g. comparing naive and aware datetimes
+            pass
+        return None
+
+    def clean(self, value, model_instance):
+        if (
+            model_instance is not None and
+            self.loaded_ciphertext(model_instance, value) is not None
+        ):
+            # The value was decrypted when the instance was loaded; don't
+            # send it through to_python to be decrypted again.
+            self.validate(value, model_instance)
+            self.run_validators(value)
+            return value
+        return super(EncryptedFieldMixin, self).clean(value, model_instance)
+
+    def pre_save(self, model_instance, add):
+        value = super(EncryptedFieldMixin, self).pre_save(model_instance, add)
+        ciphertext = self.loaded_ciphertext(model_instance, value)
+        if ciphertext is not None:
+            # Write back the ciphertext the value was loaded from rather than
+            # spending an encryption (and a fresh IV) on an unchanged value.
+            return LazyCleartext(self, ciphertext, value)
+        if in_raw_mode() and value is not None:
+            # Only values loaded or deserialized as stored can be written
+            # back as they are; anything else may be cleartext.
+            raise EncryptedFieldException(
+                '{0} was changed inside raw_ciphertext()'.format(self.name)
+            )
+        return value
+
+    def strip_prefix(self, value):
+        if self.prefix and value.startswith(self.prefix):
+            return value[len(self.prefix):]
+        return value
+
+    def may_be_ciphertext(self, value):
+        """
+        Whether `value` has the type of a stored ciphertext: bytes for binary
+        fields, any string otherwise.
+        """
+        if self.binary:
+            return isinstance(value, bytes)
+        return isinstance(value, types.StringTypes)
+
+    def looks_encrypted(self, value):
+        """
+        Cheap structural check of whether the string `value` can be a
+        ciphertext of this field: its header must name one of the crypter's
+        keys. Crypters that do not publish their `headers` fall back to the
+        field's prefix, if it has one, and otherwise to trying to decrypt.
+        """
+        crypter = self.crypter()
+        if self.binary:
+            headers = getattr(crypter, 'headers', None)
+            head_size = keyczar.HEADER_SIZE
+        else:
+            headers = getattr(crypter, 'encoded_headers', None)
+            head_size = 6
+
+        if headers is None:
+            return not self.prefix or value.startswith(self.prefix)
+        return self.strip_prefix(value)[:head_size] in headers
 
     def to_python(self, value):
+        if in_raw_mode():
+            return self.raw_to_python(value)
+        if self.binary:
+            value = binary_bytes(value)
         if value is None or not isinstance(value, types.StringTypes):
             return value
 
-        if self.prefix and value.startswith(self.prefix):
-            value = value[len(self.prefix):]
+        if self.may_be_ciphertext(value) and self.looks_encrypted(value):
+            value = self.decrypt_ciphertext(self.strip_prefix(value))
+
+        return super(EncryptedFieldMixin, self).to_python(value)
+
+    def decrypt_ciphertext(self, ciphertext):
+        """
+        The cleartext string behind a stored ciphertext without its prefix,
+        or the ciphertext itself if it cannot be decrypted.
+        """
+        if self.cache:
+            key = cache_key(self, ciphertext)
+            value = plaintext_cache.get(key)
+            if value is not MISSING:
+                return value
 
         try:
-            value = self.crypter().decrypt(value)
-            value = value.decode('unicode_escape')
-        except keyczar.errors.KeyczarError:
-            pass
-        except UnicodeEncodeError:
-            pass
-        except binascii.Error:
-            pass        
+            value = self.run_crypter(
+                'decrypt', self.decrypt_values, [ciphertext]
+            )[0]
+            value = self.decode_cleartext(value)
+        except DECRYPT_ERRORS:
+            return ciphertext
+
+        if self.cache:
+            plaintext_cache.set(key, value)
+        return value
 
-        return super(EncryptedFieldMixin, self).to_python(value)
+    def encrypt_values(self, cleartexts):
+        """
+        Encrypt a list of encoded cleartexts with the crypter, in one call.
+        """
+        crypter = self.crypter()
+        if len(cleartexts) == 1 and not self.binary:
+            return [crypter.encrypt(cleartexts[0])]
+        return encrypt_many(crypter, cleartexts, binary=self.binary)
+
+    def decrypt_values(self, ciphertexts):
+        """
+        Decrypt a list of ciphertexts without prefix with the crypter, in
+        one call. Returns the raw cleartexts.
+        """
+        crypter = self.crypter()
+        if len(ciphertexts) == 1 and not self.binary:
+            return [crypter.decrypt(ciphertexts[0])]
+        return decrypt_many(crypter, ciphertexts, binary=self.binary)
+
+    def run_crypter(self, operation, func, data):
+        """
+        `func(data)` for a list of values, reported to the instrumentation
+        observers if there are any.
+        """
+        if instrumentation.observers and data:
+            return instrumentation.record(self, operation, func, data)
+        return func(data)
+
+    def ciphertexts_for_decrypt_many(self, values):
+        """
+        The ciphertexts `decrypt_many` hands to the crypter for `values`.
+        """
+        if self.binary:
+            values = [binary_bytes(value) for value in values]
+        return [
+            self.strip_prefix(value) for value in values
+            if self.may_be_ciphertext(value) and self.looks_encrypted(value)
+        ]
+
+    def decrypt_many(self, values, decrypt=None):
+        """
+        Bulk counterpart of `to_python`: decrypt a list of database values
+        with a single crypter call. `decrypt` may replace that call, taking
+        the list from `ciphertexts_for_decrypt_many` and returning the raw
+        cleartexts, e.g. to do the work in another process.
+        """
+        values = list(values)
+        if self.binary:
+            values = [binary_bytes(value) for value in values]
+        indexes = [
+            i for i, value in enumerate(values)
+            if self.may_be_ciphertext(value) and self.looks_encrypted(value)
+        ]
+        # The same list as ciphertexts_for_decrypt_many(values).
+        ciphertexts = [self.strip_prefix(values[i]) for i in indexes]
+
+        cached = {}
+        if decrypt is None:
+            decrypt = self.decrypt_values
+            if self.cache:
+                for i, ciphertext in zip(indexes, ciphertexts):
+                    value = plaintext_cache.get(cache_key(self, ciphertext))
+                    if value is not MISSING:
+                        cached[i] = value
+                pending = [
+                    (i, ciphertext)
+                    for i, ciphertext in zip(indexes, ciphertexts)
+                    if i not in cached
+                ]
+                indexes = [i for i, ciphertext in pending]
+                ciphertexts = [ciphertext for i, ciphertext in pending]
+
+        try:
+            cleartexts = self.run_crypter('decrypt', decrypt, ciphertexts)
+            cleartexts = [self.decode_cleartext(c) for c in cleartexts]
+        except DECRYPT_ERRORS:
+            # Some of the values only look like ciphertext; sort them out one
+            # at a time.
+            return [self.to_python(value) for value in values]
+
+        if self.cache:
+            for ciphertext, cleartext in zip(ciphertexts, cleartexts):
+                plaintext_cache.set(cache_key(self, ciphertext), cleartext)
+
+        # Strings that are not ciphertext, e.g. cleartext rows in a
+        # decrypt_only column, are converted like to_python does.
+        cleartexts = dict(zip(indexes, cleartexts))
+        cleartexts.update(cached)
+        parent_to_python = super(EncryptedFieldMixin, self).to_python
+        for i, value in enumerate(values):
+            if i in cleartexts:
+                values[i] = parent_to_python(cleartexts[i])
+            elif isinstance(value, types.StringTypes):
+                values[i] = parent_to_python(value)
+        return values
+
+    def encode_cleartext(self, value):
+        """
+        Turn a prepared python value into the bytes handed to the crypter,
+        with the field's `cleartext_serializers`.
+        """
+        return serializers.dumps(value, self.cleartext_serializers)
+
+    def pack_cleartext(self, value):
+        """
+        `encode_cleartext`, compressed if the field compresses values.
+        """
+        value = self.encode_cleartext(value)
+        if self.compress:
+            value = compression.compress(
+                value, self.compress, self.compress_min_length
+            )
+        return value
+
+    def decode_cleartext(self, value):
+        """
+        Reverse `pack_cleartext` on the output of the crypter. Compressed
+        values are recognized by their marker whatever `compress` is set to,
+        and serialized values by their tag whatever the field's serializers.
+        """
+        return serializers.loads(compression.decompress(value))
 
     def get_prep_value(self, value):
+        if isinstance(value, LazyCleartext):
+            return value.ciphertext
+        if in_raw_mode():
+            return self.raw_prep_value(value)
+
         value = super(EncryptedFieldMixin, self).get_prep_value(value)
 
         if value is None or value == '' or self.decrypt_only:
             return value
 
-        if isinstance(value, types.StringTypes):
-            value = value.encode('unicode_escape')
-            value = value.encode('ascii')
-        else:
-            value = str(value)
+        value = self.pack_cleartext(value)
+        if self.enforce_max_length:
+            self.check_ciphertext_length(len(value))
+        return self.prefix + self.run_crypter(
+            'encrypt', self.encrypt_values, [value]
+        )[0]
+
+    def raw_to_python(self, value):
+        """
+        `to_python` inside raw_ciphertext(): the stored value, as written
+        out by `value_to_string`.
+        """
+        if self.binary and isinstance(value, types.StringTypes):
+            return util.Base64WSDecode(value)
+        return binary_bytes(value)
+
+    def raw_prep_value(self, value):
+        """
+        `get_prep_value` inside raw_ciphertext(): the stored value as is.
+        """
+        if value is not None and not self.is_stored_value(value):
+            # A cleartext value, e.g. set on an instance loaded outside the
+            # block or read from a plain fixture; it must not be written
+            # unencrypted.
+            raise EncryptedFieldException(
+                '{0} holds a value that is not ciphertext inside '
+                'raw_ciphertext()'.format(self.name)
+            )
+        return value
+
+    def is_stored_value(self, value):
+        """
+        Whether `value` may be written as it is inside raw_ciphertext(): a
+        ciphertext of this field going by `looks_encrypted`, or a value
+        stored unencrypted anyway (empty, or of a `decrypt_only` field).
+        """
+        if not self.may_be_ciphertext(value):
+            return False
+        if self.decrypt_only or value == '':
+            return True
+        return self.looks_encrypted(value)
+
+    def value_to_string(self, obj):
+        if not in_raw_mode():
+            return super(EncryptedFieldMixin, self).value_to_string(obj)
+        value = self.value_from_object(obj)
+        if isinstance(value, LazyCleartext):
+            value = value.ciphertext
+        if self.binary and value is not None:
+            return util.Base64WSEncode(value)
+        return value
+
+    def deterministic_ciphertexts(self, values):
+        """
+        The stored values of a deterministic field that `values` may have,
+        one per key version of the field's keyset, for exact lookups.
+        """
+        crypter = self.crypter()
+        parent_get_prep_value = super(EncryptedFieldMixin, self).get_prep_value
+        ciphertexts = []
+        for value in values:
+            value = parent_get_prep_value(value)
+            if value is None or value == '' or self.decrypt_only:
+                ciphertexts.append(value)
+                continue
+            for ciphertext in crypter.encrypt_raw_all_versions(
+                self.pack_cleartext(value)
+            ):
+                if not self.binary:
+                    ciphertext = util.Base64WSEncode(ciphertext)
+                ciphertexts.append(self.prefix + ciphertext)
+        return ciphertexts
+
+    def encrypt_many(self, values):
+        """
+        Bulk counterpart of `get_prep_value`: encrypt a list of python values
+        with a single crypter call.
+        """
+        parent_get_prep_value = super(EncryptedFieldMixin, self).get_prep_value
+        values = [parent_get_prep_value(value) for value in values]
+        if self.decrypt_only:
+            return values
+
+        indexes = [
+            i for i, value in enumerate(values)
+            if value is not None and value != ''
+        ]
+        cleartexts = [self.pack_cleartext(values[i]) for i in indexes]
+        if self.enforce_max_length:
+            for cleartext in cleartexts:
+                self.check_ciphertext_length(len(cleartext))
+        ciphertexts = self.run_crypter(
+            'encrypt', self.encrypt_values, cleartexts
+        )
+        for i, ciphertext in zip(indexes, ciphertexts):
+            values[i] = self.prefix + ciphertext
+        return values
 
-        return self.prefix + self.crypter().encrypt(value)
+    def encrypt_async(self, value, callback=None):
+        """
+        `get_prep_value` run on the executor; returns an AsyncResult.
+        """
+        return executor.submit(self.get_prep_value, (value,), None, callback)
+
+    def decrypt_async(self, value, callback=None):
+        """
+        `to_python` run on the executor; returns an AsyncResult.
+        """
+        return executor.submit(self.to_python, (value,), None, callback)
+
+    def encrypt_many_async(self, values, callback=None):
+        """
+        `encrypt_many` run on the executor; returns an AsyncResult.
+        """
+        return executor.submit(self.encrypt_many, (values,), None, callback)
+
+    def decrypt_many_async(self, values, callback=None):
+        """
+        `decrypt_many` run on the executor; returns an AsyncResult.
+        """
+        return executor.submit(self.decrypt_many, (values,), None, callback)
+
+    def ciphertext_length(self, cleartext_length):
+        """
+        Exact length of the stored value, prefix included, for a packed
+        cleartext of `cleartext_length` bytes; None if the crypter does not
+        implement `ciphertext_length`.
+        """
+        length = getattr(self.crypter(), 'ciphertext_length', None)
+        if length is None:
+            return None
+        return len(self.prefix) + length(cleartext_length, binary=self.binary)
+
+    def max_cleartext_length(self):
+        """
+        The longest ASCII cleartext whose ciphertext fits in max_length, or
+        -1 if none does; None without a max_length or ciphertext_length.
+        Non-ASCII characters count several times (see encode_cleartext).
+        """
+        if not self.max_length or self.ciphertext_length(0) is None:
+            return None
+        overhead = self.cleartext_overhead()
+        # Ciphertext is never shorter than its cleartext.
+        low, high = -1, self.max_length
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.ciphertext_length(middle + overhead) <= self.max_length:
+                low = middle
+            else:
+                high = middle - 1
+        return low
+
+    def cleartext_overhead(self):
+        """
+        Bytes the field's serializers add to text, such as a tag.
+        """
+        return len(self.encode_cleartext(u''))
+
+    def check_ciphertext_length(self, cleartext_length):
+        """
+        Raise ValueError if encrypting a packed cleartext of this length
+        would exceed max_length, without encrypting anything.
+        """
+        if not self.max_length:
+            return
+        length = self.ciphertext_length(cleartext_length)
+        if length is not None and length > self.max_length:
+            raise ValueError(
+                'Field {0} max_length={1} encrypted_len={2}'.format(
+                    self.name,
+                    self.max_length,
+                    length,
+                )
+            )
+
+    def validate(self, value, model_instance):
+        super(EncryptedFieldMixin, self).validate(value, model_instance)
+
+        if (
+            not self.enforce_max_length or
+            self.decrypt_only or
+            value in self.empty_values
+        ):
+            return
+        cleartext = self.pack_cleartext(
+            super(EncryptedFieldMixin, self).get_prep_value(value)
+        )
+        try:
+            self.check_ciphertext_length(len(cleartext))
+        except ValueError:
+            raise ValidationError(
+                'Ensure this value has at most %(limit)d characters once '
+                'encrypted.',
+                code='max_length',
+                params={'limit': self.max_cleartext_length()},
+            )
+
+    def formfield(self, **kwargs):
+        if self.enforce_max_length and isinstance(
+            self, (models.CharField, models.TextField)
+        ):
+            limit = self.max_cleartext_length()
+            if limit is not None:
+                kwargs.setdefault('max_length', max(limit, 0))
+        return super(EncryptedFieldMixin, self).formfield(**kwargs)
+
+    def check(self, **kwargs):
+        errors = super(EncryptedFieldMixin, self).check(**kwargs)
+        errors.extend(self._check_enforce_max_length())
+        return errors
+
+    def _check_enforce_max_length(self):
+        if not self.enforce_max_length or not self.max_length:
+            return []
+        try:
+            limit = self.max_cleartext_length()
+        except (keyczar.errors.KeyczarError, IOError, OSError):
+            # Missing or unreadable keys show up as soon as they are used.
+            return []
+
+        if limit is None:
+            return [
+                checks.Warning(
+                    'enforce_max_length can only check the length of values '
+                    'after encrypting them.',
+                    hint='The crypter does not implement ciphertext_length.',
+                    obj=self,
+                    id='encrypted_fields.W001',
+                )
+            ]
+        if limit < 1:
+            return [
+                checks.Warning(
+                    'max_length={0} is too small for any encrypted '
+                    'value.'.format(self.max_length),
+                    hint='Use max_length={0} or more.'.format(
+                        self.ciphertext_length(1 + self.cleartext_overhead())
+                    ),
+                    obj=self,
+                    id='encrypted_fields.W002',
+                )
+            ]
+        return []
 
     def get_db_prep_value(self, value, connection, prepared=False):
         if not prepared:
@@ -212,22 +1421,173 @@ class EncryptedFieldMixin(object):
                             len(value),
                         )
                     )
+        if self.binary and isinstance(value, bytes):
+            value = connection.Database.Binary(value)
         return value
 
 
+class BlindIndexField(models.CharField):
+    """
+    Companion column added next to encrypted fields declared with
+    `blind_index`. Its value is recomputed from the source field on save.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.source = kwargs.pop('source')
+        kwargs.setdefault('max_length', 64)
+        kwargs.setdefault('null', True)
+        kwargs.setdefault('db_index', True)
+        kwargs.setdefault('editable', False)
+        super(BlindIndexField, self).__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super(BlindIndexField, self).deconstruct()
+        kwargs['source'] = self.source
+        return name, path, args, kwargs
+
+    def pre_save(self, model_instance, add):
+        source = self.model._meta.get_field(self.source)
+        data = model_instance.__dict__
+        current = data.get(self.attname)
+
+        if in_raw_mode():
+            # The source holds ciphertext; the index was copied along with it.
+            return current
+
+        if source.attname not in data:
+            # The source value was deferred and is not being saved.
+            return current
+
+        if (
+            current is not None and
+            source.loaded_ciphertext(model_instance, data[source.attname])
+        ):
+            # The source is unchanged since it was loaded, and so is its hash.
+            return current
+
+        value = self.index_value(
+            source, getattr(model_instance, source.attname)
+        )
+        setattr(model_instance, self.attname, value)
+        return value
+
+    def index_value(self, source, value):
+        return source.blind_index_value(value)
+
+
+class RangeIndexField(BlindIndexField):
+    """
+    Companion column added next to encrypted fields declared with
+    `range_index`. It holds a keyed hash of the bucket of the source value.
+    """
+
+    def index_value(self, source, value):
+        return source.range_index_value(value)
+
+
+def save_stale_indexes(sender, instance, raw, using, update_fields,
+                       **kwargs):
+    """
+    post_save receiver writing the index columns of the encrypted fields
+    saved with an `update_fields` that leaves their index out, which would
+    otherwise keep matching the old value.
+    """
+    if raw or update_fields is None or in_raw_mode():
+        return
+
+    values = []
+    for field in sender._meta.concrete_fields:
+        if (
+            not isinstance(field, BlindIndexField) or
+            field.name in update_fields or
+            field.attname in update_fields
+        ):
+            continue
+        source = sender._meta.get_field(field.source)
+        if source.name in update_fields or source.attname in update_fields:
+            values.append((field, None, field.pre_save(instance, False)))
+
+    if values:
+        sender._base_manager.using(using).filter(pk=instance.pk)._update(
+            values
+        )
+
+
+def unchanged_encrypted_fields(instance):
+    """
+    Names of the encrypted fields of `instance` whose value is unchanged
+    since it was loaded from the database.
+    """
+    names = set()
+    for field in instance._meta.concrete_fields:
+        if (
+            isinstance(field, EncryptedFieldMixin) and
+            field.attname in instance.__dict__ and
+            field.loaded_ciphertext(
+                instance, instance.__dict__[field.attname]
+            ) is not None
+        ):
+            names.add(field.name)
+            names.add(field.attname)
+    return names
+
+
+class SkipUnchangedEncryptedFieldsMixin(object):
+    """
+    Model mixin that leaves encrypted fields whose value has not changed
+    since it was loaded out of the UPDATE issued by `save()`. If that leaves
+    nothing to save, `save()` is a no-op just as with an empty
+    `update_fields` (no query is run and no signals are sent).
+    """
+
+    def save(self, force_insert=False, force_update=False, using=None,
+             update_fields=None):
+        db = using or router.db_for_write(self.__class__, instance=self)
+
+        if (
+            not force_insert and
+            not self._state.adding and
+            db == self._state.db
+        ):
+            unchanged = unchanged_encrypted_fields(self)
+            if unchanged:
+                if update_fields is None:
+                    deferred = self.get_deferred_fields()
+                    update_fields = [
+                        field.attname for field in self._meta.concrete_fields
+                        if not field.primary_key and
+                        field.attname not in deferred
+                    ]
+                update_fields = [
+                    name for name in update_fields if name not in unchanged
+                ]
+
+        return super(SkipUnchangedEncryptedFieldsMixin, self).save(
+            force_insert=force_insert,
+            force_update=force_update,
+            using=using,
+            update_fields=update_fields,
+        )
+
+
 class EncryptedCharField(EncryptedFieldMixin, models.CharField):
-    pass
+    cleartext_serializers = (serializers.TEXT,)
 
 
 class EncryptedTextField(EncryptedFieldMixin, models.TextField):
-    pass
+    cleartext_serializers = (serializers.TEXT,)
 
 
 class EncryptedDateTimeField(EncryptedFieldMixin, models.DateTimeField):
-    pass
+    cleartext_serializers = (
+        serializers.NAIVE_DATETIME,
+        serializers.AWARE_DATETIME,
+    )
 
 
 class EncryptedIntegerField(EncryptedFieldMixin, models.IntegerField):
+    cleartext_serializers = (serializers.INTEGER,)
+
     @cached_property
     def validators(self):
         """
@@ -240,19 +1600,338 @@ class EncryptedIntegerField(EncryptedFieldMixin, models.IntegerField):
 
 
 class EncryptedDateField(EncryptedFieldMixin, models.DateField):
-    pass
+    cleartext_serializers = (serializers.DATE,)
 
 
 class EncryptedFloatField(EncryptedFieldMixin, models.FloatField):
-    pass
+    cleartext_serializers = (serializers.FLOAT,)
 
 
 class EncryptedEmailField(EncryptedFieldMixin, models.EmailField):
-    pass
+    cleartext_serializers = (serializers.TEXT,)
 
 
 class EncryptedBooleanField(EncryptedFieldMixin, models.BooleanField):
-    pass
+    cleartext_serializers = (serializers.BOOLEAN,)
+
+
+# Compact JSON, for documents and the values encrypted in them.
+JSON_SEPARATORS = (',', ':')
+
+
+def json_path(path):
+    """
+    The keys of a dotted key path ('patient.ssn'); a tuple is kept as is.
+    """
+    if isinstance(path, types.StringTypes):
+        return tuple(path.split('.'))
+    return tuple(path)
+
+
+def paths_overlap(one, other):
+    return all(
+        a == b or '*' in (a, b) for a, b in zip(one, other)
+    )
+
+
+def json_children(container, key):
+    """
+    The keys of `container` that the path key `key` names: every key or
+    index for '*', else `key` itself if it is there.
+    """
+    if isinstance(container, dict):
+        if key == '*':
+            return list(container)
+        return [key] if key in container else []
+    if isinstance(container, list):
+        if key == '*':
+            return list(range(len(container)))
+        if str(key).isdigit() and int(key) < len(container):
+            return [int(key)]
+    return []
+
+
+class EncryptedJSONField(EncryptedFieldMixin, models.TextField):
+    """
+    JSON document of which only the values at `encrypted_paths` are
+    encrypted; the rest stays plain JSON, so the database's JSON functions
+    and indexes can use it (see JSONKeyText). The column is jsonb on
+    PostgreSQL, json on MySQL and text elsewhere.
+
+    Paths are dotted keys, e.g. 'patient.ssn'. A '*' key matches every key
+    of an object or item of a list, e.g. 'contacts.*.phone'. Each value at
+    a path, whatever its type, is stored as a ciphertext string; the
+    values of a document are encrypted and decrypted with one crypter call.
+    """
+    cleartext_serializers = (serializers.TEXT,)
+
+    def __init__(self, *args, **kwargs):
+        self.encrypted_paths = [
+            json_path(path) for path in kwargs.pop('encrypted_paths', ())
+        ]
+        super(EncryptedJSONField, self).__init__(*args, **kwargs)
+
+        if not self.encrypted_paths:
+            raise ImproperlyConfigured(
+                'EncryptedJSONField needs the paths of the values to '
+                'encrypt in kwarg `encrypted_paths`'
+            )
+        for i, path in enumerate(self.encrypted_paths):
+            for other in self.encrypted_paths[i + 1:]:
+                if paths_overlap(path, other):
+                    raise ImproperlyConfigured(
+                        'Encrypted paths {0} and {1} overlap'.format(
+                            '.'.join(path), '.'.join(other)
+                        )
+                    )
+        for option in (
+            'binary', 'deterministic', 'blind_index', 'range_index', 'cache'
+        ):
+            if getattr(self, option):
+                raise ImproperlyConfigured(
+                    'EncryptedJSONField does not support {0}'.format(option)
+                )
+
+    def deconstruct(self):
+        name, path, args, kwargs = super(
+            EncryptedJSONField, self
+        ).deconstruct()
+        kwargs['encrypted_paths'] = [
+            keys if any('.' in key for key in keys) else '.'.join(keys)
+            for keys in self.encrypted_paths
+        ]
+        return name, path, args, kwargs
+
+    def db_type(self, connection):
+        if connection.vendor == 'postgresql':
+            return 'jsonb'
+        if connection.vendor == 'mysql':
+            return 'json'
+        return super(EncryptedJSONField, self).db_type(connection)
+
+    def parse(self, value):
+        """
+        The document behind a stored value: JSON text, or already parsed by
+        the database driver.
+        """
+        if not isinstance(value, types.StringTypes):
+            return value
+        try:
+            return json.loads(value)
+        except ValueError:
+            raise ValidationError(
+                'Value must be valid JSON.', code='invalid'
+            )
+
+    def slots(self, document):
+        """
+        (container, key) of every value at the encrypted paths of
+        `document`.
+        """
+        slots = []
+        for path in self.encrypted_paths:
+            containers = [document]
+            for key in path[:-1]:
+                containers = [
+                    container[child]
+                    for container in containers
+                    for child in json_children(container, key)
+                ]
+            slots.extend(
+                (container, child)
+                for container in containers
+                for child in json_children(container, path[-1])
+            )
+        return slots
+
+    def encrypted_slots(self, documents):
+        """
+        (container, key) of the stored ciphertexts in parsed `documents`.
+        """
+        return [
+            (container, key)
+            for document in documents if document is not None
+            for container, key in self.slots(document)
+            if self.may_be_ciphertext(container[key]) and
+            self.looks_encrypted(container[key])
+        ]
+
+    def ciphertexts_for_decrypt_many(self, values):
+        documents = [self.parse(value) for value in values]
+        return [
+            self.strip_prefix(container[key])
+            for container, key in self.encrypted_slots(documents)
+        ]
+
+    def decrypt_many(self, values, decrypt=None):
+        """
+        The documents behind a list of stored values, with the encrypted
+        values of all of them decrypted in one crypter call.
+        """
+        documents = [self.parse(value) for value in values]
+        slots = self.encrypted_slots(documents)
+        ciphertexts = [
+            self.strip_prefix(container[key]) for container, key in slots
+        ]
+        try:
+            cleartexts = self.run_crypter(
+                'decrypt', decrypt or self.decrypt_values, ciphertexts
+            )
+        except DECRYPT_ERRORS:
+            # Some of the values only look like ciphertext; sort them out one
+            # at a time, keeping those as they are.
+            cleartexts = []
+            for ciphertext in ciphertexts:
+                try:
+                    cleartexts.append(self.run_crypter(
+                        'decrypt', self.decrypt_values, [ciphertext]
+                    )[0])
+                except DECRYPT_ERRORS:
+                    cleartexts.append(None)
+
+        for (container, key), cleartext in zip(slots, cleartexts):
+            if cleartext is not None:
+                container[key] = json.loads(self.decode_cleartext(cleartext))
+        return documents
+
+    def to_python(self, value):
+        if in_raw_mode():
+            return self.raw_to_python(value)
+        return self.decrypt_many([value])[0]
+
+    def encrypt_many(self, values):
+        """
+        The stored values of a list of documents, with the values at the
+        encrypted paths of all of them encrypted in one crypter call.
+        """
+        documents = [copy.deepcopy(value) for value in values]
+        slots = [
+            slot
+            for document in documents if document is not None
+            for slot in self.slots(document)
+        ]
+        if slots and not self.decrypt_only:
+            cleartexts = [
+                self.pack_cleartext(
+                    json.dumps(container[key], separators=JSON_SEPARATORS)
+                )
+                for container, key in slots
+            ]
+            ciphertexts = self.run_crypter(
+                'encrypt', self.encrypt_values, cleartexts
+            )
+            for (container, key), ciphertext in zip(slots, ciphertexts):
+                container[key] = self.prefix + ciphertext
+        return [
+            None if document is None
+            else json.dumps(document, separators=JSON_SEPARATORS)
+            for document in documents
+        ]
+
+    def get_prep_value(self, value):
+        if isinstance(value, LazyCleartext):
+            return value.ciphertext
+        if in_raw_mode():
+            return self.raw_prep_value(value)
+        return self.encrypt_many([value])[0]
+
+    def raw_prep_value(self, value):
+        if value is not None and not isinstance(value, types.StringTypes):
+            # Parsed by a driver that reads JSON columns as documents.
+            value = json.dumps(value, separators=JSON_SEPARATORS)
+        return super(EncryptedJSONField, self).raw_prep_value(value)
+
+    def ciphertext_heads(self):
+        # Only values inside the documents are encrypted, so a column value
+        # cannot be told to be ciphertext or cleartext by how it starts.
+        raise ValueError(
+            '{0} holds JSON documents, which are not ciphertext as a '
+            'whole'.format(self.name)
+        )
+
+    def is_stored_value(self, value):
+        if not isinstance(value, types.StringTypes):
+            return False
+        if self.decrypt_only:
+            return True
+        try:
+            document = self.parse(value)
+        except ValidationError:
+            return False
+        return document is None or all(
+            self.may_be_ciphertext(container[key]) and
+            self.looks_encrypted(container[key])
+            for container, key in self.slots(document)
+        )
+
+    def value_to_string(self, obj):
+        if in_raw_mode():
+            return super(EncryptedJSONField, self).value_to_string(obj)
+        return json.dumps(self.value_from_object(obj))
+
+    def snapshot(self, document):
+        return json.dumps(document, sort_keys=True)
+
+    def remember_ciphertext(self, instance, cleartext, ciphertext):
+        # Documents are changed in place, so remember what the loaded one
+        # looked like rather than the object itself.
+        if not isinstance(cleartext, LazyCleartext):
+            cleartext = self.snapshot(cleartext)
+        super(EncryptedJSONField, self).remember_ciphertext(
+            instance, cleartext, ciphertext
+        )
+
+    def loaded_ciphertext(self, instance, value):
+        loaded = instance.__dict__.get(LOADED_CIPHERTEXTS, {}).get(
+            self.attname
+        )
+        if loaded is None:
+            return None
+
+        snapshot, ciphertext = loaded
+        if isinstance(snapshot, LazyCleartext):
+            if value is snapshot:
+                return ciphertext
+            snapshot = self.snapshot(self.to_python(ciphertext))
+        if self.snapshot(value) == snapshot:
+            return ciphertext
+        return None
+
+
+class JSONKeyText(models.Func):
+    """
+    The value at `path` (dotted keys) of a JSON column as SQL, e.g. to
+    filter on the unencrypted keys of an EncryptedJSONField:
+
+        Order.objects.annotate(
+            status=JSONKeyText('document', 'shipping.status')
+        ).filter(status='sent')
+
+    or to build an expression index on.
+    """
+
+    def __init__(self, expression, path, **extra):
+        super(JSONKeyText, self).__init__(
+            expression, output_field=models.TextField(), **extra
+        )
+        self.path = json_path(path)
+
+    def sql_path(self):
+        return '$' + ''.join('."{0}"'.format(key) for key in self.path)
+
+    def as_sql(self, compiler, connection):
+        sql, params = compiler.compile(self.source_expressions[0])
+        return 'JSON_EXTRACT({0}, %s)'.format(sql), params + [
+            self.sql_path()
+        ]
+
+    def as_mysql(self, compiler, connection):
+        sql, params = self.as_sql(compiler, connection)
+        return 'JSON_UNQUOTE({0})'.format(sql), params
+
+    def as_postgresql(self, compiler, connection):
+        sql, params = compiler.compile(self.source_expressions[0])
+        return '({0}::jsonb #>> %s)'.format(sql), params + [list(self.path)]
 
 
 try:
@@ -0,0 +1,211 @@
+"""
+Reporting of the encryption work done by encrypted fields.
+
+Every batch of values a field hands to its crypter is reported to the
+callables in `observers` as a CryptoEvent. With no observers registered
+the only cost is checking that the list is empty.
+
+    from encrypted_fields.instrumentation import crypto_stats
+
+    with crypto_stats() as stats:
+        response = view(request)
+    logger.debug(stats.summary())
+"""
+import collections
+import os
+import threading
+import timeit
+
+from keyczar import keyczar, util
+
+
+observers = []
+
+_lock = threading.Lock()
+
+
+def observe(callback):
+    """
+    Call `callback(event)` with a CryptoEvent for every crypter call.
+    """
+    with _lock:
+        observers.append(callback)
+
+
+def unobserve(callback):
+    with _lock:
+        if callback in observers:
+            observers.remove(callback)
+
+
+class CryptoEvent(object):
+    """
+    One batch of values encrypted or decrypted by `field`.
+
+    `keys` counts the values per key hash (web-safe base64, as in Keyczar
+    errors) going by the ciphertext headers, where they can be read.
+    """
+    __slots__ = (
+        'field', 'operation', 'values', 'bytes', 'seconds', 'failed', 'keys',
+    )
+
+    def __init__(self, field, operation, values, bytes, seconds, failed,
+                 keys):
+        self.field = field
+        self.operation = operation
+        self.values = values
+        self.bytes = bytes
+        self.seconds = seconds
+        self.failed = failed
+        self.keys = keys
+
+    @property
+    def keyname(self):
+        """
+        The name of the keyset: the last component of its key directory.
+        """
+        return os.path.basename(os.path.normpath(self.field.keydir))
+
+
+def key_hash(field, ciphertext):
+    """
+    The key hash in the header of a stored ciphertext without its prefix,
+    or None if it does not have a Keyczar style header.
+    """
+    try:
+        if field.binary:
+            header = ciphertext[:keyczar.HEADER_SIZE]
+        else:
+            header = util.Base64WSDecode(ciphertext[:8])[:keyczar.HEADER_SIZE]
+    except (keyczar.errors.KeyczarError, TypeError, ValueError):
+        return None
+    if len(header) < keyczar.HEADER_SIZE:
+        return None
+    return util.Base64WSEncode(header[1:])
+
+
+def record(field, operation, func, data):
+    """
+    Run `func(data)` for a list of values and report it to the observers.
+    """
+    failed = False
+    start = timeit.default_timer()
+    try:
+        result = func(data)
+    except Exception:
+        failed = True
+        raise
+    finally:
+        seconds = timeit.default_timer() - start
+        if failed:
+            ciphertexts = data if operation == 'decrypt' else []
+        else:
+            ciphertexts = result if operation == 'encrypt' else data
+
+        keys = collections.Counter(
+            key_hash(field, ciphertext) for ciphertext in ciphertexts
+        )
+        keys.pop(None, None)
+        event = CryptoEvent(
+            field=field,
+            operation=operation,
+            values=len(data),
+            bytes=sum(len(value) for value in data),
+            seconds=seconds,
+            failed=failed,
+            keys=dict(keys),
+        )
+        for observer in list(observers):
+            observer(event)
+    return result
+
+
+def field_label(field):
+    model = getattr(field, 'model', None)
+    if model is None:
+        return field.name or field.__class__.__name__
+    return '{0}.{1}'.format(model._meta.label, field.name)
+
+
+def percentile(sorted_samples, fraction):
+    if not sorted_samples:
+        return 0.0
+    index = int(round(fraction * (len(sorted_samples) - 1)))
+    return sorted_samples[index]
+
+
+class OperationStats(object):
+    def __init__(self):
+        self.calls = 0
+        self.values = 0
+        self.bytes = 0
+        self.failures = 0
+        self.timings = []
+        self.keys = collections.Counter()
+
+    def add(self, event):
+        self.calls += 1
+        self.values += event.values
+        self.bytes += event.bytes
+        self.failures += event.failed
+        self.timings.append(event.seconds)
+        self.keys.update(event.keys)
+
+    @property
+    def seconds(self):
+        return sum(self.timings)
+
+    def percentile(self, fraction):
+        return percentile(sorted(self.timings), fraction)
+
+
+class crypto_stats(object):
+    """
+    Context manager collecting the crypto work done by the current thread
+    while it is active, per (field, keyname, operation).
+    """
+
+    def __init__(self):
+        self.operations = collections.defaultdict(OperationStats)
+        self.thread = None
+
+    def __enter__(self):
+        self.thread = threading.current_thread()
+        observe(self.add)
+        return self
+
+    def __exit__(self, *exc_info):
+        unobserve(self.add)
+
+    def add(self, event):
+        if threading.current_thread() is not self.thread:
+            return
+        key = (field_label(event.field), event.keyname, event.operation)
+        self.operations[key].add(event)
+
+    @property
+    def seconds(self):
+        return sum(stats.seconds for stats in self.operations.values())
+
+    def summary(self):
+        lines = [
+            'encrypted fields: {0:.2f}ms in {1} crypter calls'.format(
+                self.seconds * 1e3,
+                sum(stats.calls for stats in self.operations.values()),
+            )
+        ]
+        for key in sorted(self.operations):
+            label, keyname, operation = key
+            stats = self.operations[key]
+            lines.append(
+                '  {0} {1} ({2}): {3} values, {4} bytes, {5} calls, '
+                '{6:.2f}ms total, p50 {7:.3f}ms, p95 {8:.3f}ms, '
+                '{9} failed'.format(
+                    label, operation, keyname, stats.values, stats.bytes,
+                    stats.calls, stats.seconds * 1e3,
+                    stats.percentile(0.5) * 1e3,
+                    stats.percentile(0.95) * 1e3,
+                    stats.failures,
+                )
+            )
+        return '\n'.join(lines)
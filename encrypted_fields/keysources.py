@@ -0,0 +1,283 @@
+"""
+Where crypters read their Keyczar keysets from.
+
+By default every keyset is read from its key directory: a meta file and a
+file per key version. The setting ENCRYPTED_FIELDS_KEY_SOURCE names (as a
+dotted path) another source to use instead:
+
+* PackedKeySource reads every keyset from the single file named by
+  ENCRYPTED_FIELDS_KEYSTORE, as written by the pack_keys command.
+* EnvironmentKeySource reads the same format from the environment
+  variable named by ENCRYPTED_FIELDS_KEYSTORE_ENV (by default
+  ENCRYPTED_FIELDS_KEYSTORE).
+
+`set_key_source(MemoryKeySource(packed))` serves a keystore the
+application already holds as a string.
+
+Packed keysets are looked up by the absolute path of their key directory,
+as the settings and `keyname`s resolve it; those not in the store are still
+read from their directory, unless the store holds a keyset of the same
+name from another directory, which is refused as a likely mistake.
+
+Call `preload()` before forking worker processes (e.g. from wsgi.py with
+gunicorn's preload_app) so that they share the parsed keys.
+"""
+import json
+import os
+import threading
+
+from django.apps import apps
+from django.conf import settings
+from django.utils.module_loading import import_string
+from keyczar import errors, readers, util
+
+
+PACKED_FORMAT = 1
+
+_lock = threading.Lock()
+_key_source = None
+
+
+def keyset_path(keydir):
+    return os.path.abspath(keydir)
+
+
+def read_keydir(keydir):
+    """
+    The keyset in `keydir` in packed form: its metadata and the key of
+    every version, as the JSON strings Keyczar stores them as.
+    """
+    reader = readers.FileReader(keydir)
+    meta = reader.GetMetadata()
+    return {
+        'meta': meta,
+        'keys': dict(
+            (str(version['versionNumber']),
+             reader.GetKey(version['versionNumber']))
+            for version in json.loads(meta)['versions']
+        ),
+    }
+
+
+def pack(keydirs):
+    """
+    The packed keystore, as a JSON string, holding the keysets in
+    `keydirs`.
+    """
+    keysets = {}
+    for keydir in keydirs:
+        path = keyset_path(keydir)
+        if path in keysets:
+            raise ValueError('{0} is packed twice'.format(path))
+        keysets[path] = read_keydir(keydir)
+    return json.dumps(
+        {'format': PACKED_FORMAT, 'keysets': keysets}, sort_keys=True
+    )
+
+
+class MemoryReader(readers.Reader):
+    """
+    Keyczar reader serving a keyset held in memory in packed form.
+    """
+
+    def __init__(self, keyset):
+        self.keyset = keyset
+
+    def GetMetadata(self):
+        return self.keyset['meta']
+
+    def GetKey(self, version_number):
+        try:
+            return self.keyset['keys'][str(version_number)]
+        except KeyError:
+            raise errors.KeyczarError(
+                'Key version {0} is missing'.format(version_number)
+            )
+
+    def Close(self):
+        return
+
+    @classmethod
+    def CreateReader(cls, location):
+        # Only ever created by a key source, never for a location.
+        return None
+
+
+class FileKeySource(object):
+    """
+    Reads each keyset from its key directory.
+    """
+
+    def reader(self, keydir):
+        return readers.CreateReader(keydir)
+
+    def clear(self):
+        pass
+
+
+class MemoryKeySource(FileKeySource):
+    """
+    Serves the keysets of the packed keystore `packed` (a JSON string, e.g.
+    fetched from a secrets manager) from memory, and the others from their
+    key directories. Subclasses read the keystore elsewhere by overriding
+    `load`.
+    """
+
+    def __init__(self, packed=None):
+        self.packed = packed
+        self._keysets = None
+
+    def load(self):
+        if self.packed is None:
+            raise errors.KeyczarError('No packed keystore was given')
+        return self.packed
+
+    @property
+    def keysets(self):
+        keysets = self._keysets
+        if keysets is None:
+            with _lock:
+                if self._keysets is None:
+                    self._keysets = self.parse(self.load())
+                keysets = self._keysets
+        return keysets
+
+    def parse(self, packed):
+        data = json.loads(packed)
+        if data.get('format') != PACKED_FORMAT:
+            raise errors.KeyczarError(
+                'Unsupported keystore format {0!r}'.format(data.get('format'))
+            )
+        return data['keysets']
+
+    def reader(self, keydir):
+        path = keyset_path(keydir)
+        keyset = self.keysets.get(path)
+        if keyset is not None:
+            return MemoryReader(keyset)
+
+        name = os.path.basename(path)
+        others = sorted(
+            other for other in self.keysets
+            if os.path.basename(other) == name
+        )
+        if others:
+            # Probably the same keyset, packed from where it used to be;
+            # never guess which key material is meant.
+            raise errors.KeyczarError(
+                'The keystore has no keyset for {0}, only for {1}; pack the '
+                'key directories the settings name'.format(
+                    path, ', '.join(others)
+                )
+            )
+        return super(MemoryKeySource, self).reader(keydir)
+
+    def clear(self):
+        # Read the keystore again on next use, e.g. after a key rotation.
+        with _lock:
+            self._keysets = None
+
+
+class PackedKeySource(MemoryKeySource):
+    def __init__(self, path=None):
+        super(PackedKeySource, self).__init__()
+        self.path = path or settings.ENCRYPTED_FIELDS_KEYSTORE
+
+    def load(self):
+        return util.ReadFile(self.path)
+
+
+class EnvironmentKeySource(MemoryKeySource):
+    def __init__(self, variable=None):
+        super(EnvironmentKeySource, self).__init__()
+        self.variable = variable or getattr(
+            settings, 'ENCRYPTED_FIELDS_KEYSTORE_ENV',
+            'ENCRYPTED_FIELDS_KEYSTORE'
+        )
+
+    def load(self):
+        try:
+            return os.environ[self.variable]
+        except KeyError:
+            raise errors.KeyczarError(
+                'The environment variable {0} is not set'.format(
+                    self.variable
+                )
+            )
+
+
+def get_key_source():
+    """
+    The key source: whatever the factory named by the setting
+    ENCRYPTED_FIELDS_KEY_SOURCE (a dotted path) returns, or a
+    FileKeySource.
+    """
+    global _key_source
+    if _key_source is None:
+        with _lock:
+            if _key_source is None:
+                factory = getattr(
+                    settings, 'ENCRYPTED_FIELDS_KEY_SOURCE', None
+                )
+                _key_source = (
+                    import_string(factory)() if factory else FileKeySource()
+                )
+    return _key_source
+
+
+def set_key_source(key_source):
+    """
+    Use `key_source` from now on. Crypters already loaded are kept; call
+    crypters.invalidate() to load them from it.
+    """
+    global _key_source
+    with _lock:
+        _key_source = key_source
+
+
+def reader(keydir):
+    """
+    A Keyczar reader for the keyset of `keydir`.
+    """
+    return get_key_source().reader(keydir)
+
+
+def clear():
+    """
+    Forget keysets the key source holds in memory.
+    """
+    if _key_source is not None:
+        _key_source.clear()
+
+
+def preload():
+    """
+    Load the keysets of every encrypted field, blind and range index and
+    encrypted file field of the installed models into the shared crypter
+    registry. Returns the seconds each load took, by (crypter class name,
+    key directory), for the crypters that were not loaded yet.
+    """
+    from .fields import KeyczarHmacWrapper, crypters
+    from .query import encrypted_fields
+    from .storage import EncryptedStorage
+
+    loaded = set(crypters.load_times)
+    for model in apps.get_models():
+        for field in encrypted_fields(model):
+            field.crypter()
+            for keydir in (
+                getattr(field, 'blind_index_keydir', None),
+                getattr(field, 'range_index_keydir', None),
+            ):
+                if keydir:
+                    crypters.get(KeyczarHmacWrapper, keydir)
+        for field in model._meta.concrete_fields:
+            storage = getattr(field, 'storage', None)
+            if isinstance(storage, EncryptedStorage):
+                storage.crypter()
+
+    return dict(
+        ((klass.__name__, keydir), seconds)
+        for (klass, keydir), seconds in crypters.load_times.items()
+        if (klass, keydir) not in loaded
+    )
@@ -0,0 +1,198 @@
+from django.db.models.expressions import Col
+from django.db.models.lookups import (
+    BuiltinLookup,
+    Exact,
+    GreaterThan,
+    GreaterThanOrEqual,
+    In,
+    LessThan,
+    LessThanOrEqual,
+    Lookup,
+    Range,
+)
+
+try:
+    from django.core.exceptions import EmptyResultSet
+except ImportError:
+    from django.db.models.sql.datastructures import EmptyResultSet
+
+
+class BlindIndexLookupMixin(object):
+    """
+    Compare the blind index column of an encrypted field against the keyed
+    hash of the looked up value(s) instead of comparing ciphertexts, which
+    never match because every encryption uses a fresh IV.
+    """
+    prepare_rhs = False
+
+    def get_prep_lookup(self):
+        if not self.rhs_is_direct_value() or hasattr(self.rhs, '_prepare'):
+            raise ValueError(
+                'Lookups on the blind index of {0} only support literal '
+                'values.'.format(self.lhs.output_field.name)
+            )
+        return self.rhs
+
+    def process_lhs(self, compiler, connection, lhs=None):
+        lhs = lhs or self.lhs
+        field = lhs.output_field
+        return compiler.compile(Col(lhs.alias, field.blind_index_field))
+
+    def get_db_prep_lookup(self, value, connection):
+        field = self.lhs.output_field
+        if self.get_db_prep_lookup_value_is_iterable:
+            return '%s', [field.blind_index_value(v) for v in value]
+        return '%s', [field.blind_index_value(value)]
+
+
+class BlindIndexExact(BlindIndexLookupMixin, Exact):
+    pass
+
+
+class BlindIndexIn(BlindIndexLookupMixin, In):
+    pass
+
+
+BLIND_INDEX_LOOKUPS = {
+    BlindIndexExact.lookup_name: BlindIndexExact,
+    BlindIndexIn.lookup_name: BlindIndexIn,
+}
+
+
+class DeterministicLookupMixin(object):
+    """
+    Compare the ciphertexts of a deterministic field against the looked up
+    value(s) encrypted with every version of its keyset, so that rows
+    written before a key rotation still match.
+    """
+    prepare_rhs = False
+
+    def get_prep_lookup(self):
+        if not self.rhs_is_direct_value() or hasattr(self.rhs, '_prepare'):
+            raise ValueError(
+                'Lookups on the deterministic field {0} only support literal '
+                'values.'.format(self.lhs.output_field.name)
+            )
+        return self.rhs
+
+    def process_rhs(self, compiler, connection):
+        field = self.lhs.output_field
+        ciphertexts = field.deterministic_ciphertexts(
+            [value for value in self.rhs_values() if value is not None]
+        )
+        if not ciphertexts:
+            raise EmptyResultSet
+        if field.binary:
+            ciphertexts = [connection.Database.Binary(c) for c in ciphertexts]
+        return (
+            '({0})'.format(', '.join(['%s'] * len(ciphertexts))),
+            ciphertexts,
+        )
+
+    def get_rhs_op(self, connection, rhs):
+        return 'IN %s' % rhs
+
+    def as_sql(self, compiler, connection):
+        return BuiltinLookup.as_sql(self, compiler, connection)
+
+
+class DeterministicExact(DeterministicLookupMixin, Exact):
+    def rhs_values(self):
+        return [self.rhs]
+
+
+class DeterministicIn(DeterministicLookupMixin, In):
+    def rhs_values(self):
+        return list(self.rhs)
+
+
+DETERMINISTIC_LOOKUPS = {
+    DeterministicExact.lookup_name: DeterministicExact,
+    DeterministicIn.lookup_name: DeterministicIn,
+}
+
+
+class RangeIndexLookupMixin(object):
+    """
+    Range lookups on an encrypted field with a range index. The index can
+    only narrow a range down to the rows in the buckets it covers, a
+    superset that filter(), count(), exclude() or a subquery would use as
+    is, so these lookups are refused; EncryptedQuerySet.in_range prunes to
+    those buckets and checks the candidates after decrypting them.
+    """
+    prepare_rhs = False
+
+    def get_prep_lookup(self):
+        raise ValueError(
+            'Range lookups on {0} only match whole buckets of its range '
+            'index; use in_range(), which checks the decrypted '
+            'values.'.format(self.lhs.output_field.name)
+        )
+
+
+class RangeIndexGreaterThan(RangeIndexLookupMixin, GreaterThan):
+    pass
+
+
+class RangeIndexGreaterThanOrEqual(RangeIndexLookupMixin, GreaterThanOrEqual):
+    pass
+
+
+class RangeIndexLessThan(RangeIndexLookupMixin, LessThan):
+    pass
+
+
+class RangeIndexLessThanOrEqual(RangeIndexLookupMixin, LessThanOrEqual):
+    pass
+
+
+class RangeIndexRange(RangeIndexLookupMixin, Range):
+    pass
+
+
+RANGE_INDEX_LOOKUPS = dict(
+    (lookup.lookup_name, lookup)
+    for lookup in (
+        RangeIndexGreaterThan,
+        RangeIndexGreaterThanOrEqual,
+        RangeIndexLessThan,
+        RangeIndexLessThanOrEqual,
+        RangeIndexRange,
+    )
+)
+
+
+class IsEncrypted(Lookup):
+    """
+    `field__is_encrypted=True` matches rows whose value starts with the
+    field's prefix or, for fields without one, with the header of one of
+    its keys; both compile to indexable `LIKE 'head%'` predicates.
+    `field__is_encrypted=False` matches the other non-empty values, i.e.
+    cleartext that still needs encrypting.
+    """
+    lookup_name = 'is_encrypted'
+    prepare_rhs = False
+
+    def as_sql(self, compiler, connection):
+        lhs_sql, lhs_params = self.process_lhs(compiler, connection)
+        field = self.lhs.output_field
+        heads = field.ciphertext_heads()
+
+        like = '{0} {1}'.format(
+            lhs_sql, connection.operators['startswith'] % '%s'
+        )
+        sql = '({0})'.format(' OR '.join([like] * len(heads)))
+        params = []
+        for head in heads:
+            params.extend(lhs_params)
+            params.append(connection.ops.prep_for_like_query(head) + '%')
+
+        if not self.rhs:
+            sql = "NOT {0} AND {1} <> ''".format(sql, lhs_sql)
+            params.extend(lhs_params)
+        return sql, params
+
+
+ENCRYPTED_FIELD_LOOKUPS = {
+    IsEncrypted.lookup_name: IsEncrypted,
+}
@@ -0,0 +1,15 @@
+from django.core.management.commands import dumpdata
+
+from encrypted_fields.fields import raw_ciphertext
+
+
+class Command(dumpdata.Command):
+    help = (
+        'Like dumpdata, but writes encrypted fields out as their stored '
+        'ciphertext instead of decrypting them. Load the output with '
+        'loaddata_raw.'
+    )
+
+    def handle(self, *app_labels, **options):
+        with raw_ciphertext():
+            return super(Command, self).handle(*app_labels, **options)
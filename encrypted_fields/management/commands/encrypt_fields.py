@@ -0,0 +1,149 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, models, transaction
+
+from encrypted_fields.query import cleartext_fields, unencrypted_q
+
+from .reencrypt_fields import RAW_ALIAS, Progress, get_models
+
+
+def encrypt(field, values):
+    """
+    Encrypt the cleartext among a batch of stored values of `field`. Returns
+    a list holding the new stored value, or None for values that are empty
+    or already encrypted.
+    """
+    heads = tuple(field.ciphertext_heads())
+    indexes = [
+        i for i, value in enumerate(values)
+        if value and not value.startswith(heads)
+    ]
+    results = [None] * len(values)
+    ciphertexts = field.run_crypter(
+        'encrypt',
+        field.encrypt_values,
+        [field.pack_cleartext(values[i]) for i in indexes]
+    )
+    for i, ciphertext in zip(indexes, ciphertexts):
+        results[i] = field.prefix + ciphertext
+    return results
+
+
+class Command(BaseCommand):
+    help = (
+        'Encrypts the cleartext values held by encrypted fields, such as '
+        'rows written while a field was decrypt_only.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'args', metavar='app_label[.ModelName]', nargs='*',
+            help='Restricts encryption to the given apps or models.',
+        )
+        parser.add_argument(
+            '--batch-size', action='store', dest='batch_size', type=int,
+            default=500,
+            help='Number of rows read and written per transaction.',
+        )
+        parser.add_argument(
+            '--database', action='store', dest='database',
+            default=DEFAULT_DB_ALIAS,
+            help='Nominates a database. Defaults to the "default" database.',
+        )
+
+    def handle(self, *labels, **options):
+        self.database = options['database']
+        self.batch_size = options['batch_size']
+        self.verbosity = options['verbosity']
+
+        if self.batch_size < 1:
+            raise CommandError('--batch-size must be positive.')
+
+        for model in get_models(labels):
+            fields = []
+            for field in cleartext_fields(model):
+                try:
+                    field.ciphertext_heads()
+                except ValueError as e:
+                    if self.verbosity >= 1:
+                        self.stderr.write('Skipping {0}: {1}'.format(
+                            model._meta.label, e
+                        ))
+                    continue
+                fields.append(field)
+            if fields:
+                self.encrypt_model(model, fields)
+
+    def encrypt_model(self, model, fields):
+        progress = Progress(action='encrypted')
+        last_pk = None
+        while True:
+            last_pk = self.encrypt_batch(model, fields, last_pk, progress)
+            if last_pk is None:
+                break
+            if self.verbosity >= 2:
+                self.stdout.write('{0} pk<={1}: {2}'.format(
+                    model._meta.label, last_pk, progress.report()
+                ))
+
+        if self.verbosity >= 1:
+            self.stdout.write(
+                '{0}: {1}'.format(model._meta.label, progress.report())
+            )
+
+    def encrypt_batch(self, model, fields, last_pk, progress):
+        """
+        Encrypt the cleartext in the next batch of rows after `last_pk` that
+        hold any. Returns the primary key of the last row processed, or None
+        when done.
+        """
+        queryset = model._base_manager.using(self.database).filter(
+            unencrypted_q(fields)
+        )
+        if last_pk is not None:
+            queryset = queryset.filter(pk__gt=last_pk)
+
+        aliases = [RAW_ALIAS.format(field.attname) for field in fields]
+        queryset = queryset.annotate(**{
+            alias: models.ExpressionWrapper(
+                models.F(field.name),
+                output_field=field.storage_field(),
+            )
+            for alias, field in zip(aliases, fields)
+        }).order_by('pk')
+
+        with transaction.atomic(using=self.database):
+            rows = list(
+                queryset.select_for_update()
+                .values_list('pk', *aliases)[:self.batch_size]
+                .iterator()
+            )
+            if not rows:
+                return None
+
+            pks = [row[0] for row in rows]
+            updates = {}
+            values = 0
+            for column, field in enumerate(fields, 1):
+                results = encrypt(field, [row[column] for row in rows])
+                whens = [
+                    models.When(pk=pk, then=models.Value(
+                        result, output_field=field.storage_field()
+                    ))
+                    for pk, result in zip(pks, results)
+                    if result is not None
+                ]
+                if whens:
+                    values += len(whens)
+                    updates[field.name] = models.Case(
+                        *whens,
+                        default=models.F(field.name),
+                        output_field=field.storage_field()
+                    )
+
+            if updates:
+                model._base_manager.using(self.database).filter(
+                    pk__in=pks
+                ).update(**updates)
+
+        progress.add(len(rows), values, 0)
+        return pks[-1]
@@ -0,0 +1,14 @@
+from django.core.management.commands import loaddata
+
+from encrypted_fields.fields import raw_ciphertext
+
+
+class Command(loaddata.Command):
+    help = (
+        'Like loaddata, but stores the values of encrypted fields as they '
+        'are in the fixture, which must have been written by dumpdata_raw.'
+    )
+
+    def handle(self, *fixture_labels, **options):
+        with raw_ciphertext():
+            return super(Command, self).handle(*fixture_labels, **options)
@@ -0,0 +1,37 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from encrypted_fields.keysources import pack
+
+
+class Command(BaseCommand):
+    help = (
+        'Packs Keyczar key directories into a single keystore file for '
+        'PackedKeySource or EnvironmentKeySource.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help='The keystore file to write.')
+        parser.add_argument(
+            'keydirs', metavar='keydir', nargs='+',
+            help='Key directories to pack, as the settings name them. '
+                 'Keysets are looked up by the absolute path of their '
+                 'directory.',
+        )
+
+    def handle(self, output, *args, **options):
+        keydirs = options['keydirs']
+        try:
+            packed = pack(keydirs)
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        # The keystore holds every key in cleartext; keep it private.
+        fd = os.open(output, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(packed)
+        if options['verbosity'] >= 1:
+            self.stdout.write('{0}: {1} keysets packed'.format(
+                output, len(keydirs)
+            ))
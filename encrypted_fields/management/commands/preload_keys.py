@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from encrypted_fields.keysources import preload
+
+
+class Command(BaseCommand):
+    help = (
+        'Loads the keysets of every encrypted field and reports how long '
+        'each one took to load.'
+    )
+
+    def handle(self, *args, **options):
+        load_times = preload()
+        if options['verbosity'] >= 1:
+            for (klass, keydir), seconds in sorted(load_times.items()):
+                self.stdout.write('{0} {1}: {2:.1f} ms'.format(
+                    klass, keydir, seconds * 1000
+                ))
+            self.stdout.write('{0} keysets loaded in {1:.1f} ms'.format(
+                len(load_times), sum(load_times.values()) * 1000
+            ))
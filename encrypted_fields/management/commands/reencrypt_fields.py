@@ -0,0 +1,417 @@
+import json
+import os
+import threading
+import time
+
+from django.apps import apps
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections, models, transaction
+from django.utils import six
+from keyczar import util
+
+from encrypted_fields.fields import (
+    DECRYPT_ERRORS,
+    EncryptedFieldMixin,
+    EncryptedJSONField,
+    JSON_SEPARATORS,
+    binary_bytes,
+    crypters,
+    decrypt_many,
+    encrypt_many,
+)
+
+
+RAW_ALIAS = '_reencrypt_{0}'
+
+
+def reencryptable_fields(model):
+    return [
+        field for field in model._meta.local_concrete_fields
+        if isinstance(field, EncryptedFieldMixin) and not field.decrypt_only
+    ]
+
+
+def reencrypt(field, ciphertexts):
+    """
+    Re-encrypt a batch of stored values of `field` with the current primary
+    key. Returns a list holding the new stored value, or None for values
+    that are already current, and the number of values that could not be
+    decrypted (those are left untouched).
+    """
+    if isinstance(field, EncryptedJSONField):
+        return reencrypt_documents(field, ciphertexts)
+    return reencrypt_values(field, ciphertexts)
+
+
+def reencrypt_values(field, ciphertexts):
+    """
+    `reencrypt` for fields storing each value as one ciphertext.
+    """
+    crypter = field.crypter()
+    is_current = getattr(crypter, 'encrypted_with_primary', None)
+    if field.binary:
+        ciphertexts = [binary_bytes(c) for c in ciphertexts]
+
+    indexes = []
+    for i, ciphertext in enumerate(ciphertexts):
+        if not ciphertext:
+            continue
+        if field.prefix and not ciphertext.startswith(field.prefix):
+            continue
+        if is_current:
+            head = field.strip_prefix(ciphertext)
+            if field.binary:
+                # encrypted_with_primary reads the header from base64
+                head = util.Base64WSEncode(head[:6])
+            if is_current(head):
+                continue
+        indexes.append(i)
+
+    results = [None] * len(ciphertexts)
+    stripped = [field.strip_prefix(ciphertexts[i]) for i in indexes]
+    try:
+        cleartexts = decrypt_many(crypter, stripped, binary=field.binary)
+    except DECRYPT_ERRORS:
+        cleartexts = []
+        for ciphertext in stripped:
+            try:
+                cleartexts.append(decrypt_many(
+                    crypter, [ciphertext], binary=field.binary
+                )[0])
+            except DECRYPT_ERRORS:
+                cleartexts.append(None)
+
+    failures = 0
+    readable = []
+    for i, cleartext in zip(indexes, cleartexts):
+        if cleartext is None:
+            failures += 1
+        else:
+            readable.append((i, cleartext))
+
+    fresh = encrypt_many(
+        crypter,
+        [cleartext for i, cleartext in readable],
+        binary=field.binary
+    )
+    for (i, cleartext), ciphertext in zip(readable, fresh):
+        results[i] = field.prefix + ciphertext
+    return results, failures
+
+
+def reencrypt_documents(field, values):
+    """
+    `reencrypt` for the stored JSON documents of an EncryptedJSONField: the
+    values at its encrypted paths are re-encrypted, the rest is kept.
+    """
+    documents = []
+    for value in values:
+        try:
+            documents.append(field.parse(value) if value else None)
+        except ValidationError:
+            documents.append(None)
+    slots = [
+        (index, container, key)
+        for index, document in enumerate(documents)
+        for container, key in field.encrypted_slots([document])
+    ]
+    results, failures = reencrypt_values(
+        field, [container[key] for index, container, key in slots]
+    )
+
+    changed = set()
+    for (index, container, key), result in zip(slots, results):
+        if result is not None:
+            container[key] = result
+            changed.add(index)
+    return [
+        json.dumps(document, separators=JSON_SEPARATORS)
+        if index in changed else None
+        for index, document in enumerate(documents)
+    ], failures
+
+
+def get_models(labels):
+    """
+    The concrete models named by `app_label[.ModelName]` labels, or all
+    of them.
+    """
+    if not labels:
+        return [
+            model for model in apps.get_models()
+            if not model._meta.proxy
+        ]
+
+    models_ = []
+    for label in labels:
+        try:
+            if '.' in label:
+                models_.append(apps.get_model(label))
+            else:
+                models_.extend(apps.get_app_config(label).get_models())
+        except LookupError as e:
+            raise CommandError(str(e))
+    return [model for model in models_ if not model._meta.proxy]
+
+
+class Checkpoint(object):
+    """
+    JSON file recording, per model, the primary key ranges being processed
+    and how far each has got, so an interrupted run can pick up again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.state = {}
+        if path and os.path.exists(path):
+            with open(path) as checkpoint_file:
+                self.state = json.load(checkpoint_file)
+
+    def ranges(self, label):
+        return self.state.get(label)
+
+    def start(self, label, ranges):
+        with self.lock:
+            self.state[label] = [list(pk_range) for pk_range in ranges]
+            self.save()
+
+    def advance(self, label, index, last_pk):
+        with self.lock:
+            self.state[label][index][0] = last_pk
+            self.save()
+
+    def save(self):
+        if not self.path:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as checkpoint_file:
+            json.dump(self.state, checkpoint_file)
+        os.rename(tmp_path, self.path)
+
+
+class Progress(object):
+    def __init__(self, action='re-encrypted'):
+        self.action = action
+        self.lock = threading.Lock()
+        self.rows = 0
+        self.values = 0
+        self.failures = 0
+        self.started = time.time()
+
+    def add(self, rows, values, failures):
+        with self.lock:
+            self.rows += rows
+            self.values += values
+            self.failures += failures
+
+    def report(self):
+        elapsed = max(time.time() - self.started, 1e-6)
+        return (
+            '{0} rows scanned, {1} values {2}, {3} unreadable '
+            'in {4:.1f}s ({5:.0f} rows/s)'.format(
+                self.rows, self.values, self.action, self.failures,
+                elapsed, self.rows / elapsed,
+            )
+        )
+
+
+class Command(BaseCommand):
+    help = (
+        'Re-encrypts the values of encrypted fields with the current primary '
+        'key of their keyset, e.g. after promoting a new key.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'args', metavar='app_label[.ModelName]', nargs='*',
+            help='Restricts re-encryption to the given apps or models.',
+        )
+        parser.add_argument(
+            '--batch-size', action='store', dest='batch_size', type=int,
+            default=500,
+            help='Number of rows read and written per transaction.',
+        )
+        parser.add_argument(
+            '--checkpoint', action='store', dest='checkpoint', default=None,
+            help='JSON file to record progress in and resume from.',
+        )
+        parser.add_argument(
+            '--workers', action='store', dest='workers', type=int, default=1,
+            help='Number of threads, each handling a primary key range.',
+        )
+        parser.add_argument(
+            '--database', action='store', dest='database',
+            default=DEFAULT_DB_ALIAS,
+            help='Nominates a database. Defaults to the "default" database.',
+        )
+
+    def handle(self, *labels, **options):
+        self.database = options['database']
+        self.batch_size = options['batch_size']
+        self.workers = options['workers']
+        self.verbosity = options['verbosity']
+        self.checkpoint = Checkpoint(options['checkpoint'])
+
+        if self.batch_size < 1 or self.workers < 1:
+            raise CommandError('--batch-size and --workers must be positive.')
+
+        # Make sure we encrypt with the primary key as it is on disk now.
+        crypters.reload()
+
+        for model in self.get_models(labels):
+            fields = reencryptable_fields(model)
+            if fields:
+                self.reencrypt_model(model, fields)
+
+    def get_models(self, labels):
+        return get_models(labels)
+
+    def plan_ranges(self, model):
+        """
+        Split the primary keys of `model` into `workers` contiguous ranges of
+        [last processed pk, last pk of range]. Rows created after the plan is
+        made are written with the current key and need no processing.
+        """
+        queryset = model._base_manager.using(self.database)
+        bounds = queryset.aggregate(
+            low=models.Min('pk'),
+            high=models.Max('pk'),
+        )
+        low, high = bounds['low'], bounds['high']
+        if low is None:
+            return []
+
+        if self.workers == 1 or not isinstance(high, six.integer_types):
+            return [[None, high]]
+
+        step = (high - low) // self.workers + 1
+        ranges = []
+        start = low - 1
+        while start < high:
+            end = min(start + step, high)
+            ranges.append([start, end])
+            start = end
+        return ranges
+
+    def reencrypt_model(self, model, fields):
+        label = model._meta.label
+        ranges = self.checkpoint.ranges(label)
+        if ranges is None:
+            ranges = self.plan_ranges(model)
+            self.checkpoint.start(label, ranges)
+
+        progress = Progress()
+        pending = [
+            index for index, (last_pk, high) in enumerate(ranges)
+            if last_pk is None or last_pk < high
+        ]
+        if len(pending) == 1:
+            self.reencrypt_range(model, fields, label, pending[0], progress)
+        elif pending:
+            errors = []
+            threads = [
+                threading.Thread(
+                    target=self.reencrypt_range_thread,
+                    args=(model, fields, label, index, progress, errors),
+                )
+                for index in pending
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            if errors:
+                raise CommandError(
+                    'Re-encrypting {0} failed: {1!r}'.format(label, errors[0])
+                )
+
+        if self.verbosity >= 1:
+            self.stdout.write('{0}: {1}'.format(label, progress.report()))
+
+    def reencrypt_range_thread(self, model, fields, label, index, progress,
+                               errors):
+        try:
+            self.reencrypt_range(model, fields, label, index, progress)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            connections[self.database].close()
+
+    def reencrypt_range(self, model, fields, label, index, progress):
+        last_pk, high = self.checkpoint.ranges(label)[index]
+        while True:
+            last_pk = self.reencrypt_batch(
+                model, fields, last_pk, high, progress
+            )
+            if last_pk is None:
+                self.checkpoint.advance(label, index, high)
+                return
+            self.checkpoint.advance(label, index, last_pk)
+            if self.verbosity >= 2:
+                self.stdout.write(
+                    '{0} pk<={1}: {2}'.format(
+                        label, last_pk, progress.report()
+                    )
+                )
+
+    def reencrypt_batch(self, model, fields, last_pk, high, progress):
+        """
+        Re-encrypt the next batch of rows after `last_pk`, locking them for
+        the duration so concurrent writes are not overwritten. Returns the
+        primary key of the last row processed, or None when done.
+        """
+        queryset = model._base_manager.using(self.database)
+        if last_pk is not None:
+            queryset = queryset.filter(pk__gt=last_pk)
+        queryset = queryset.filter(pk__lte=high).order_by('pk')
+
+        aliases = [RAW_ALIAS.format(field.attname) for field in fields]
+        queryset = queryset.annotate(**{
+            alias: models.ExpressionWrapper(
+                models.F(field.name),
+                output_field=field.storage_field(),
+            )
+            for alias, field in zip(aliases, fields)
+        })
+
+        with transaction.atomic(using=self.database):
+            rows = list(
+                queryset.select_for_update()
+                .values_list('pk', *aliases)[:self.batch_size]
+                .iterator()
+            )
+            if not rows:
+                return None
+
+            pks = [row[0] for row in rows]
+            updates = {}
+            values = failures = 0
+            for column, field in enumerate(fields, 1):
+                results, unreadable = reencrypt(
+                    field, [row[column] for row in rows]
+                )
+                failures += unreadable
+                whens = [
+                    models.When(pk=pk, then=models.Value(
+                        result, output_field=field.storage_field()
+                    ))
+                    for pk, result in zip(pks, results)
+                    if result is not None
+                ]
+                if whens:
+                    values += len(whens)
+                    updates[field.name] = models.Case(
+                        *whens,
+                        default=models.F(field.name),
+                        output_field=field.storage_field()
+                    )
+
+            if updates:
+                model._base_manager.using(self.database).filter(
+                    pk__in=pks
+                ).update(**updates)
+
+        progress.add(len(rows), values, failures)
+        return pks[-1]
@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+
+from encrypted_fields.envelope import EnvelopeWrapper
+from encrypted_fields.fields import crypters
+from encrypted_fields.query import encrypted_fields
+
+from .reencrypt_fields import get_models
+
+
+class Command(BaseCommand):
+    help = (
+        'Rewraps the envelope data keys of encrypted fields with the current '
+        'primary key of their master keyset, e.g. after promoting a new key.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'args', metavar='app_label[.ModelName]', nargs='*',
+            help='Restricts rewrapping to the keysets of the given apps or '
+                 'models.',
+        )
+        parser.add_argument(
+            '--database', action='store', dest='database',
+            default=DEFAULT_DB_ALIAS,
+            help='Nominates a database. Defaults to the "default" database.',
+        )
+
+    def handle(self, *labels, **options):
+        # Make sure we wrap with the primary key as it is on disk now.
+        crypters.reload()
+
+        seen = set()
+        for model in get_models(labels):
+            for field in encrypted_fields(model):
+                crypter = field.crypter()
+                if not isinstance(crypter, EnvelopeWrapper):
+                    continue
+                if crypter.keydir in seen:
+                    continue
+                seen.add(crypter.keydir)
+
+                rewrapped = crypter.rewrap_data_keys(using=options['database'])
+                if options['verbosity'] >= 1:
+                    self.stdout.write('{0}: {1} data keys rewrapped'.format(
+                        crypter.keyname, rewrapped
+                    ))
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10 on 2026-10-17 02:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DataKey',
+            fields=[
+                ('id', models.BigIntegerField(
+                    primary_key=True, serialize=False)),
+                ('keyname', models.CharField(max_length=255)),
+                ('tenant', models.CharField(blank=True, max_length=255)),
+                ('wrapped_key', models.TextField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='datakey',
+            index_together=set([('keyname', 'tenant')]),
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import models
+
+
+class DataKey(models.Model):
+    """
+    A data key for envelope encryption (encrypted_fields.envelope), stored
+    encrypted ("wrapped") with the master keyset named `keyname`.
+    """
+    id = models.BigIntegerField(primary_key=True)
+    keyname = models.CharField(max_length=255)
+    tenant = models.CharField(max_length=255, blank=True)
+    wrapped_key = models.TextField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        index_together = [('keyname', 'tenant')]
@@ -0,0 +1,113 @@
+"""
+Helpers for data migrations and copies of encrypted fields.
+"""
+import itertools
+
+from django.db import models
+from keyczar import util
+
+from .fields import binary_bytes, raw_ciphertext
+
+
+def copy_ciphertext(model, from_field, to_field, prefix='', batch_size=500):
+    """
+    A RunPython function copying the stored ciphertext of `from_field` into
+    `to_field` of `model` ('app_label.ModelName'), where one of the two
+    fields uses binary storage and the other base64 text. Values are
+    converted between the two encodings without being decrypted, so no key
+    is needed and the copy is cheap. `prefix` is the `prefix` of both
+    fields, which historical models do not know about.
+
+    To move a column to binary storage, add the binary field next to the
+    old one, copy, then remove the old field (and rename the new one):
+
+        migrations.AddField('user', 'ssn_bin', EncryptedCharField(
+            max_length=255, null=True, binary=True)),
+        migrations.RunPython(
+            copy_ciphertext('app.User', 'ssn', 'ssn_bin'),
+            copy_ciphertext('app.User', 'ssn_bin', 'ssn'),
+        ),
+        migrations.RemoveField('user', 'ssn'),
+        migrations.RenameField('user', 'ssn_bin', 'ssn'),
+    """
+    app_label, model_name = model.split('.')
+
+    def copy(apps, schema_editor):
+        model = apps.get_model(app_label, model_name)
+        source = model._meta.get_field(from_field)
+        target = model._meta.get_field(to_field)
+        if source.binary == target.binary:
+            raise ValueError(
+                'copy_ciphertext converts between a binary and a text '
+                'field; {0} and {1} are both {2}.'.format(
+                    from_field, to_field,
+                    'binary' if source.binary else 'text',
+                )
+            )
+
+        def convert(value):
+            value = binary_bytes(value)
+            if not value:
+                return value
+            if prefix and value.startswith(prefix):
+                value = value[len(prefix):]
+            if target.binary:
+                return prefix + util.Base64WSDecode(value)
+            return prefix + util.Base64WSEncode(value)
+
+        db = schema_editor.connection.alias
+        manager = model._base_manager.using(db)
+        queryset = manager.annotate(
+            _ciphertext=models.ExpressionWrapper(
+                models.F(source.name),
+                output_field=source.storage_field(),
+            )
+        ).order_by('pk')
+
+        last_pk = None
+        while True:
+            batch = queryset
+            if last_pk is not None:
+                batch = batch.filter(pk__gt=last_pk)
+            rows = list(batch.values_list('pk', '_ciphertext')[:batch_size])
+            if not rows:
+                return
+
+            whens = [
+                models.When(pk=pk, then=models.Value(
+                    convert(value), output_field=target.storage_field()
+                ))
+                for pk, value in rows
+                if value is not None
+            ]
+            if whens:
+                manager.filter(pk__in=[pk for pk, value in rows]).update(**{
+                    target.name: models.Case(
+                        *whens,
+                        default=models.F(target.name),
+                        output_field=target.storage_field()
+                    )
+                })
+            last_pk = rows[-1][0]
+
+    return copy
+
+
+def copy_rows(queryset, using, batch_size=500):
+    """
+    Copy the rows of `queryset` into the database `using`, e.g. to seed a
+    replica or move a table. Encrypted values are copied as they are stored
+    (see raw_ciphertext), so nothing is decrypted or re-encrypted and no key
+    is needed; rows are streamed over in batches of `batch_size`. Returns
+    the number of rows copied.
+    """
+    manager = queryset.model._base_manager.db_manager(using)
+    copied = 0
+    with raw_ciphertext():
+        rows = queryset.iterator()
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                return copied
+            manager.bulk_create(batch)
+            copied += len(batch)
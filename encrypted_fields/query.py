@@ -0,0 +1,342 @@
+import collections
+import functools
+import itertools
+import multiprocessing
+import operator
+
+from django.db import models
+from django.db.models.constants import LOOKUP_SEP
+
+from . import executor
+from .fields import (
+    EncryptedFieldException,
+    EncryptedFieldMixin,
+    EncryptedJSONField,
+    crypters,
+    decrypt_many,
+    in_raw_mode,
+)
+
+
+DEFAULT_CHUNK_SIZE = 100
+
+RAW_ALIAS = '_encrypted_fields_raw_{0}'
+
+RANGE_CHECKS = {
+    'gt': lambda value, rhs: value > rhs,
+    'gte': lambda value, rhs: value >= rhs,
+    'lt': lambda value, rhs: value < rhs,
+    'lte': lambda value, rhs: value <= rhs,
+    'range': lambda value, rhs: rhs[0] <= value <= rhs[1],
+}
+
+# The (low, high) bounds of each range lookup, None where it is open.
+RANGE_BOUNDS = {
+    'gt': lambda rhs: (rhs, None),
+    'gte': lambda rhs: (rhs, None),
+    'lt': lambda rhs: (None, rhs),
+    'lte': lambda rhs: (None, rhs),
+    'range': tuple,
+}
+
+
+def encrypted_fields(model):
+    return [
+        field for field in model._meta.concrete_fields
+        if isinstance(field, EncryptedFieldMixin)
+    ]
+
+
+def cleartext_fields(model, field_names=()):
+    """
+    The encrypted fields of `model` named in `field_names`, or all whose
+    column can hold cleartext: those not using binary storage and not
+    holding JSON documents, of which only some values are encrypted.
+    """
+    if field_names:
+        return [model._meta.get_field(name) for name in field_names]
+    return [
+        field for field in encrypted_fields(model)
+        if not field.binary and not isinstance(field, EncryptedJSONField)
+    ]
+
+
+def index_updates(model, values):
+    """
+    `values` for QuerySet.update(), plus the blind and range index columns
+    of the encrypted fields among them.
+    """
+    values = dict(values)
+    for name, value in list(values.items()):
+        field = model._meta.get_field(name)
+        if not isinstance(field, EncryptedFieldMixin):
+            continue
+        for index_field in field.index_fields():
+            if index_field.name in values or index_field.attname in values:
+                continue
+            if in_raw_mode() or hasattr(value, 'resolve_expression'):
+                raise EncryptedFieldException(
+                    'The index {0} of {1} cannot be computed from this '
+                    'value; pass it to update() too'.format(
+                        index_field.name, field.name
+                    )
+                )
+            values[index_field.name] = index_field.index_value(field, value)
+    return values
+
+
+def unencrypted_q(fields):
+    """
+    Q object matching rows where any of `fields` holds cleartext.
+    """
+    return functools.reduce(operator.or_, [
+        models.Q(**{field.name + '__is_encrypted': False})
+        for field in fields
+    ])
+
+
+def _loaded_encrypted_fields(queryset):
+    """
+    The encrypted fields of the queryset's model that are not deferred.
+    """
+    names, defer = queryset.query.deferred_loading
+    fields = []
+    for field in encrypted_fields(queryset.model):
+        selected = field.name in names or field.attname in names
+        if selected != defer:
+            fields.append(field)
+    return fields
+
+
+def _decrypt_task(crypter_klass, keydir, binary, ciphertexts):
+    """
+    Decrypt a chunk of one column in a pool worker, with the same crypter
+    configuration as the field. Each worker process loads the keyset once.
+    """
+    return decrypt_many(
+        crypters.get(crypter_klass, keydir), ciphertexts, binary=binary
+    )
+
+
+def _set_decrypted(chunk, field, ciphertexts, values):
+    for obj, value, ciphertext in zip(chunk, values, ciphertexts):
+        setattr(obj, field.attname, value)
+        if ciphertext is not None:
+            field.remember_ciphertext(obj, value, ciphertext)
+
+
+def _raw_queryset(queryset, fields):
+    """
+    `queryset` with `fields` deferred and their ciphertext selected through
+    an alias typed as a plain field of the column type, so the field's own
+    converters never run on it.
+    """
+    return queryset.defer(*[field.name for field in fields]).annotate(**{
+        RAW_ALIAS.format(field.attname): models.ExpressionWrapper(
+            models.F(field.name),
+            output_field=field.storage_field(),
+        )
+        for field in fields
+    })
+
+
+def _pop_raw_columns(chunk, fields):
+    return [
+        [obj.__dict__.pop(RAW_ALIAS.format(field.attname)) for obj in chunk]
+        for field in fields
+    ]
+
+
+def _decrypt_columns(chunk, fields, columns):
+    for field, ciphertexts in zip(fields, columns):
+        values = field.decrypt_many(ciphertexts)
+        _set_decrypted(chunk, field, ciphertexts, values)
+    return chunk
+
+
+def decrypt_async(queryset, callback=None):
+    """
+    Fetch the rows of `queryset` without decrypting them, then decrypt each
+    encrypted column with one `decrypt_many` call on the executor. Returns
+    an AsyncResult for the list of model instances.
+
+    The query itself runs in the calling thread, on its database connection
+    and inside its transaction; only the crypto work is offloaded.
+    """
+    fields = _loaded_encrypted_fields(queryset)
+    if fields:
+        queryset = _raw_queryset(queryset, fields)
+    chunk = list(queryset.iterator())
+    columns = _pop_raw_columns(chunk, fields)
+    return executor.submit(
+        _decrypt_columns, (chunk, fields, columns), None, callback
+    )
+
+
+def decrypting_iterator(queryset, chunk_size=DEFAULT_CHUNK_SIZE,
+                        workers=None, pool=None):
+    """
+    Iterate over model instances of `queryset`, decrypting each encrypted
+    column a chunk of rows at a time with the field's `decrypt_many`
+    instead of value by value in `from_db_value`.
+
+    With `workers` the chunks are decrypted by a multiprocessing pool of
+    that many processes while the next rows are being fetched; `pool` may
+    instead be an existing pool (e.g. a ThreadPool) to submit them to.
+    Instances are yielded in queryset order either way.
+    """
+    fields = _loaded_encrypted_fields(queryset)
+    if not fields:
+        for obj in queryset.iterator():
+            yield obj
+        return
+
+    queryset = _raw_queryset(queryset, fields)
+
+    def chunks():
+        rows = queryset.iterator()
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                return
+            yield chunk, _pop_raw_columns(chunk, fields)
+
+    if pool is None and not workers:
+        for chunk, columns in chunks():
+            _decrypt_columns(chunk, fields, columns)
+            for obj in chunk:
+                yield obj
+        return
+
+    own_pool = None
+    if pool is None:
+        pool = own_pool = multiprocessing.Pool(workers)
+    # Keep every worker busy without buffering the whole queryset.
+    max_pending = 2 * (workers or getattr(pool, '_processes', 1))
+
+    def submit(chunk, columns):
+        results = [
+            pool.apply_async(_decrypt_task, (
+                field._crypter_klass,
+                field.keydir,
+                field.binary,
+                field.ciphertexts_for_decrypt_many(ciphertexts),
+            ))
+            for field, ciphertexts in zip(fields, columns)
+        ]
+        return chunk, columns, results
+
+    def collect(chunk, columns, results):
+        for field, ciphertexts, result in zip(fields, columns, results):
+            values = field.decrypt_many(
+                ciphertexts,
+                decrypt=lambda ciphertexts, result=result: result.get()
+            )
+            _set_decrypted(chunk, field, ciphertexts, values)
+        return chunk
+
+    try:
+        pending = collections.deque()
+        for chunk, columns in chunks():
+            pending.append(submit(chunk, columns))
+            if len(pending) >= max_pending:
+                for obj in collect(*pending.popleft()):
+                    yield obj
+        while pending:
+            for obj in collect(*pending.popleft()):
+                yield obj
+    finally:
+        if own_pool is not None:
+            own_pool.terminate()
+
+
+def in_range(queryset, **lookups):
+    """
+    The model instances of `queryset` matching range `lookups` on fields
+    with a range index, e.g. `in_range(qs, birthday__gte=date)`, as a list.
+
+    The range index first prunes `queryset` to the rows in the buckets the
+    ranges cover; only those are decrypted and checked exactly.
+    """
+    prune = models.Q()
+    checks = []
+    for name, rhs in lookups.items():
+        field_name, _, lookup_name = name.rpartition(LOOKUP_SEP)
+        field = None
+        if field_name and lookup_name in RANGE_CHECKS:
+            field = queryset.model._meta.get_field(field_name)
+        if not getattr(field, 'range_index', None):
+            raise ValueError(
+                '{0} is not a range lookup on a field with a range '
+                'index.'.format(name)
+            )
+        low, high = RANGE_BOUNDS[lookup_name](rhs)
+        digests = field.range_index_digests(low, high)
+        if not digests:
+            return []
+        prune &= models.Q(**{field.range_index_name + '__in': digests})
+
+        if lookup_name == 'range':
+            rhs = tuple(field.range_value(bound) for bound in rhs)
+        else:
+            rhs = field.range_value(rhs)
+        checks.append((field, RANGE_CHECKS[lookup_name], rhs))
+
+    def matches(obj):
+        for field, check, rhs in checks:
+            value = field.range_value(getattr(obj, field.attname))
+            if value is None or not check(value, rhs):
+                return False
+        return True
+
+    return [
+        obj for obj in decrypting_iterator(queryset.filter(prune))
+        if matches(obj)
+    ]
+
+
+class EncryptedQuerySet(models.QuerySet):
+    def encrypted(self, *field_names):
+        """
+        Rows where none of the named encrypted fields (by default all of
+        them) holds cleartext, going by `is_encrypted`.
+        """
+        fields = cleartext_fields(self.model, field_names)
+        if not fields:
+            return self.all()
+        return self.exclude(unencrypted_q(fields))
+
+    def unencrypted(self, *field_names):
+        """
+        Rows where any of the named encrypted fields (by default all of
+        them) holds cleartext, e.g. left from `decrypt_only` days.
+        """
+        fields = cleartext_fields(self.model, field_names)
+        if not fields:
+            return self.none()
+        return self.filter(unencrypted_q(fields))
+
+    def update(self, **kwargs):
+        # Keep blind and range indexes in step with the values.
+        return super(EncryptedQuerySet, self).update(
+            **index_updates(self.model, kwargs)
+        )
+
+    def decrypting_iterator(self, chunk_size=DEFAULT_CHUNK_SIZE,
+                            workers=None, pool=None):
+        return decrypting_iterator(
+            self,
+            chunk_size=chunk_size,
+            workers=workers,
+            pool=pool,
+        )
+
+    def decrypt_async(self, callback=None):
+        return decrypt_async(self, callback=callback)
+
+    def in_range(self, **lookups):
+        return in_range(self, **lookups)
+
+
+class EncryptedManager(models.Manager.from_queryset(EncryptedQuerySet)):
+    pass
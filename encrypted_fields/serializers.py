@@ -0,0 +1,222 @@
+"""
+Serialization of field values into the cleartext handed to the crypter.
+
+Values used to be written as text: strings unicode_escape encoded, other
+values as str(value), parsed back by the field's to_python. The serializers
+below write a compact binary form behind a tag byte naming the format.
+Tags are above 0x7f, which the legacy ASCII cleartext never starts with,
+so untagged values are still decoded the old way. They do not overlap the
+compression markers.
+"""
+import datetime
+import struct
+import types
+
+from django.utils import timezone
+
+
+EPOCH = datetime.datetime(1970, 1, 1)
+EPOCH_ORDINAL = EPOCH.toordinal()
+
+
+def legacy_dumps(value):
+    if isinstance(value, types.StringTypes):
+        value = value.encode('unicode_escape')
+        return value.encode('ascii')
+    return str(value)
+
+
+def legacy_loads(data):
+    return data.decode('unicode_escape')
+
+
+class Serializer(object):
+    """
+    Writes values of one type behind `tag`. `dumps` returns None for values
+    it does not handle, which are then written in the legacy format.
+    """
+    tag = None
+
+    def dumps(self, value):
+        raise NotImplementedError
+
+    def loads(self, data):
+        """
+        The value behind `data`, which starts with the tag.
+        """
+        raise NotImplementedError
+
+
+class TextSerializer(Serializer):
+    tag = '\x90'
+
+    def dumps(self, value):
+        if isinstance(value, types.UnicodeType):
+            return self.tag + value.encode('utf-8')
+        if isinstance(value, types.StringType):
+            try:
+                value.decode('utf-8')
+            except UnicodeDecodeError:
+                return None
+            return self.tag + value
+        return None
+
+    def loads(self, data):
+        return data[1:].decode('utf-8')
+
+
+class StructSerializer(Serializer):
+    """
+    Writes a number in a fixed-width `struct` format.
+    """
+    format = None
+
+    def __init__(self):
+        self.struct = struct.Struct(self.format)
+
+    def accepts(self, value):
+        raise NotImplementedError
+
+    def to_number(self, value):
+        return value
+
+    def from_number(self, number):
+        return number
+
+    def dumps(self, value):
+        if not self.accepts(value):
+            return None
+        try:
+            return self.tag + self.struct.pack(self.to_number(value))
+        except (struct.error, OverflowError):
+            return None
+
+    def loads(self, data):
+        return self.from_number(self.struct.unpack(data[1:])[0])
+
+
+class IntegerSerializer(StructSerializer):
+    tag = '\x91'
+    format = '>q'
+
+    def accepts(self, value):
+        return (
+            isinstance(value, (types.IntType, types.LongType)) and
+            not isinstance(value, bool)
+        )
+
+
+class FloatSerializer(StructSerializer):
+    tag = '\x92'
+    format = '>d'
+
+    def accepts(self, value):
+        return isinstance(value, types.FloatType)
+
+
+class BooleanSerializer(StructSerializer):
+    tag = '\x93'
+    format = '?'
+
+    def accepts(self, value):
+        return isinstance(value, bool)
+
+
+class DateSerializer(StructSerializer):
+    """
+    Days since 1970-01-01.
+    """
+    tag = '\x94'
+    format = '>i'
+
+    def accepts(self, value):
+        return (
+            isinstance(value, datetime.date) and
+            not isinstance(value, datetime.datetime)
+        )
+
+    def to_number(self, value):
+        return value.toordinal() - EPOCH_ORDINAL
+
+    def from_number(self, number):
+        return datetime.date.fromordinal(number + EPOCH_ORDINAL)
+
+
+class DateTimeSerializer(StructSerializer):
+    """
+    Microseconds since 1970-01-01 00:00 of a naive datetime.
+    """
+    tag = '\x95'
+    format = '>q'
+
+    def accepts(self, value):
+        return isinstance(value, datetime.datetime) and not self.aware(value)
+
+    def aware(self, value):
+        return timezone.is_aware(value)
+
+    def to_number(self, value):
+        delta = value - EPOCH
+        return (
+            (delta.days * 86400 + delta.seconds) * 1000000 +
+            delta.microseconds
+        )
+
+    def from_number(self, number):
+        return EPOCH + datetime.timedelta(microseconds=number)
+
+
+class AwareDateTimeSerializer(DateTimeSerializer):
+    """
+    Microseconds since the epoch of an aware datetime, read back in UTC.
+    """
+    tag = '\x96'
+
+    def accepts(self, value):
+        return isinstance(value, datetime.datetime) and self.aware(value)
+
+    def to_number(self, value):
+        value = timezone.make_naive(value, timezone.utc)
+        return super(AwareDateTimeSerializer, self).to_number(value)
+
+    def from_number(self, number):
+        value = super(AwareDateTimeSerializer, self).from_number(number)
+        return value.replace(tzinfo=timezone.utc)
+
+
+TEXT = TextSerializer()
+INTEGER = IntegerSerializer()
+FLOAT = FloatSerializer()
+BOOLEAN = BooleanSerializer()
+DATE = DateSerializer()
+NAIVE_DATETIME = DateTimeSerializer()
+AWARE_DATETIME = AwareDateTimeSerializer()
+
+SERIALIZERS = dict(
+    (serializer.tag, serializer)
+    for serializer in (
+        TEXT, INTEGER, FLOAT, BOOLEAN, DATE, NAIVE_DATETIME, AWARE_DATETIME,
+    )
+)
+
+
+def dumps(value, serializers=()):
+    """
+    The cleartext for `value`, from the first of `serializers` that handles
+    it or else in the legacy format.
+    """
+    for serializer in serializers:
+        data = serializer.dumps(value)
+        if data is not None:
+            return data
+    return legacy_dumps(value)
+
+
+def loads(data):
+    """
+    The value behind a cleartext written by `dumps`.
+    """
+    serializer = SERIALIZERS.get(data[:1])
+    if serializer is None:
+        return legacy_loads(data)
+    return serializer.loads(data)
@@ -0,0 +1,347 @@
+"""
+Encrypted file storage, for documents too big to encrypt as one value.
+
+Files are encrypted as a stream of fixed-size chunks, each sealed on its
+own with the field's crypter, so neither saving nor reading holds more than
+a chunk of the file in memory, and a read at any offset only decrypts the
+chunks it covers. Stored files are
+
+    format byte | chunk size | sealed chunk size | file id (16 bytes)
+
+followed by the sealed chunks. Each chunk's cleartext starts with the file
+id, the chunk size, its index and whether it is the last chunk, so chunks
+cannot be reordered, moved between files or cut off, nor the header's chunk
+size changed, without reading failing.
+"""
+import os
+import struct
+
+from django.conf import settings
+from django.core.files.base import File
+from django.core.files.storage import FileSystemStorage, Storage
+from django.db import models
+from django.utils.deconstruct import deconstructible
+from django.utils.encoding import force_bytes
+
+from .fields import (
+    EncryptedFieldException,
+    crypters,
+    default_crypter_klass,
+    keydir_for,
+)
+
+
+FILE_FORMAT = '\x05'
+FILE_ID_SIZE = 16
+FILE_HEADER = struct.Struct('>cII{0}s'.format(FILE_ID_SIZE))
+CHUNK_META = struct.Struct('>{0}sIQ?'.format(FILE_ID_SIZE))
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+
+def read_exactly(stream, size):
+    """
+    `size` bytes from `stream`, or fewer only at its end.
+    """
+    data = stream.read(size)
+    while data and len(data) < size:
+        more = stream.read(size - len(data))
+        if not more:
+            break
+        data += more
+    return force_bytes(data)
+
+
+def sealed_chunk_size(crypter, chunk_size):
+    return crypter.ciphertext_length(CHUNK_META.size + chunk_size, binary=True)
+
+
+def encrypted_size(crypter, size, chunk_size):
+    """
+    The size of the stored file for `size` bytes of cleartext.
+    """
+    full_chunks, last = divmod(size, chunk_size)
+    if size and not last:
+        full_chunks, last = full_chunks - 1, chunk_size
+    return (
+        FILE_HEADER.size +
+        full_chunks * sealed_chunk_size(crypter, chunk_size) +
+        sealed_chunk_size(crypter, last)
+    )
+
+
+class EncryptingStream(object):
+    """
+    Read-only file-like object giving the encrypted form of `content` as it
+    is read, one chunk at a time. It can only be rewound, which restarts
+    the encryption.
+    """
+
+    def __init__(self, content, crypter, chunk_size):
+        self.content = content
+        self.crypter = crypter
+        self.chunk_size = chunk_size
+        self.sealed_size = sealed_chunk_size(crypter, chunk_size)
+        self.seek(0)
+
+    @property
+    def size(self):
+        return encrypted_size(self.crypter, self.content.size, self.chunk_size)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if (offset, whence) not in ((0, os.SEEK_SET), (0, os.SEEK_CUR)):
+            raise IOError('An EncryptingStream can only be rewound')
+        if whence == os.SEEK_CUR:
+            return
+        self.content.seek(0)
+        self.file_id = os.urandom(FILE_ID_SIZE)
+        self.index = 0
+        self.position = 0
+        self.buffer = FILE_HEADER.pack(
+            FILE_FORMAT, self.chunk_size, self.sealed_size, self.file_id
+        )
+        # Read a chunk ahead, to know which chunk is the last.
+        self.next_chunk = read_exactly(self.content, self.chunk_size)
+        self.done = False
+
+    def tell(self):
+        return self.position
+
+    def seal_next_chunk(self):
+        chunk = self.next_chunk
+        self.next_chunk = read_exactly(self.content, self.chunk_size)
+        self.done = not self.next_chunk
+        meta = CHUNK_META.pack(
+            self.file_id, self.chunk_size, self.index, self.done
+        )
+        sealed = self.crypter.encrypt_raw_many([meta + chunk])[0]
+        if not self.done and len(sealed) != self.sealed_size:
+            # Reads find chunks by offset, so they must all be the same size.
+            raise EncryptedFieldException(
+                '{0}.ciphertext_length is not exact, which encrypted files '
+                'need'.format(self.crypter.__class__.__name__)
+            )
+        self.index += 1
+        return sealed
+
+    def read(self, size=-1):
+        pieces = [self.buffer]
+        length = len(self.buffer)
+        while not self.done and (size < 0 or length < size):
+            sealed = self.seal_next_chunk()
+            pieces.append(sealed)
+            length += len(sealed)
+
+        data = b''.join(pieces)
+        if size < 0:
+            size = len(data)
+        self.buffer = data[size:]
+        self.position += min(size, len(data))
+        return data[:size]
+
+
+class DecryptedFile(File):
+    """
+    The cleartext of an encrypted file, read from the stored `file` a chunk
+    at a time. Supports seek(), so ranges of big files can be read without
+    decrypting what comes before them.
+    """
+
+    def __init__(self, file, crypter, name=None):
+        super(DecryptedFile, self).__init__(file, name)
+        self.crypter = crypter
+        header = read_exactly(file, FILE_HEADER.size)
+        if len(header) < FILE_HEADER.size or header[:1] != FILE_FORMAT:
+            raise EncryptedFieldException(
+                '{0} is not an encrypted file'.format(self.name)
+            )
+        _, self.chunk_size, self.sealed_size, self.file_id = (
+            FILE_HEADER.unpack(header)
+        )
+        if not self.chunk_size or self.sealed_size != sealed_chunk_size(
+            crypter, self.chunk_size
+        ):
+            raise EncryptedFieldException(
+                '{0} has a corrupt header'.format(self.name)
+            )
+        self.position = 0
+        self.chunk_index = None
+        self.chunk = None
+
+    def read_chunk(self, index):
+        """
+        The cleartext of chunk `index` and whether it is the last one.
+        """
+        if index == self.chunk_index:
+            return self.chunk
+        self.file.seek(FILE_HEADER.size + index * self.sealed_size)
+        sealed = read_exactly(self.file, self.sealed_size)
+        if not sealed:
+            raise EncryptedFieldException(
+                '{0} is truncated'.format(self.name)
+            )
+        cleartext = self.crypter.decrypt_raw_many([sealed])[0]
+        file_id, chunk_size, chunk_index, last = CHUNK_META.unpack(
+            cleartext[:CHUNK_META.size]
+        )
+        if file_id != self.file_id or chunk_index != index:
+            raise EncryptedFieldException(
+                'Chunk {0} of {1} is out of place'.format(index, self.name)
+            )
+        data = cleartext[CHUNK_META.size:]
+        # The header is not authenticated; only trust its chunk size once a
+        # chunk confirms it, and only the last chunk may be short.
+        if chunk_size != self.chunk_size or (
+            not last and len(data) != chunk_size
+        ):
+            raise EncryptedFieldException(
+                'Chunk {0} of {1} does not match the chunk size of the '
+                'file'.format(index, self.name)
+            )
+        self.chunk_index = index
+        self.chunk = data, last
+        return self.chunk
+
+    def _get_size(self):
+        if not hasattr(self, '_size'):
+            stored = self.file.size - FILE_HEADER.size
+            chunks = max(1, -(-stored // self.sealed_size))
+            data, last = self.read_chunk(chunks - 1)
+            if not last:
+                raise EncryptedFieldException(
+                    '{0} is truncated'.format(self.name)
+                )
+            self._size = (chunks - 1) * self.chunk_size + len(data)
+        return self._size
+
+    size = property(_get_size)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise IOError('Negative seek position {0}'.format(offset))
+        self.position = offset
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        end = self.size
+        if size >= 0:
+            end = min(end, self.position + size)
+
+        pieces = []
+        while self.position < end:
+            index, offset = divmod(self.position, self.chunk_size)
+            data = self.read_chunk(index)[0]
+            piece = data[offset:offset + end - self.position]
+            if not piece:
+                raise EncryptedFieldException(
+                    '{0} is truncated'.format(self.name)
+                )
+            pieces.append(piece)
+            self.position += len(piece)
+        return b''.join(pieces)
+
+    def open(self, mode=None):
+        self.file.open(mode)
+        self.seek(0)
+        return self
+
+
+@deconstructible
+class EncryptedStorage(Storage):
+    """
+    Storage encrypting files on their way into `storage` (by default a
+    FileSystemStorage in MEDIA_ROOT) and decrypting them on the way out.
+
+    The keyset is picked like an encrypted field's: `keyname` in
+    DEFAULT_KEY_DIRECTORY or settings.ENCRYPTED_FIELDS_KEYDIR, used with
+    `crypter_klass` (by default settings.ENCRYPTED_FIELDS_CRYPTER or
+    KeyczarWrapper). Stored files hold ciphertext, so there are no URLs or
+    paths to hand out; serve files through a view.
+    """
+
+    def __init__(self, storage=None, keyname=None, crypter_klass=None,
+                 chunk_size=None):
+        self.storage = storage or FileSystemStorage()
+        self.keyname = keyname
+        self.keydir = keydir_for(keyname)
+        self.crypter_klass = crypter_klass or default_crypter_klass()
+        self.chunk_size = chunk_size or getattr(
+            settings, 'ENCRYPTED_FIELDS_FILE_CHUNK_SIZE', DEFAULT_CHUNK_SIZE
+        )
+
+    def crypter(self):
+        return crypters.get(self.crypter_klass, self.keydir)
+
+    def _open(self, name, mode='rb'):
+        if 'w' in mode or 'a' in mode or '+' in mode:
+            raise ValueError('Encrypted files can only be opened for reading')
+        return DecryptedFile(
+            self.storage.open(name, 'rb'), self.crypter(), name
+        )
+
+    def _save(self, name, content):
+        stream = EncryptingStream(content, self.crypter(), self.chunk_size)
+        return self.storage.save(name, File(stream, name))
+
+    def get_available_name(self, name, max_length=None):
+        return self.storage.get_available_name(name, max_length=max_length)
+
+    def delete(self, name):
+        self.storage.delete(name)
+
+    def exists(self, name):
+        return self.storage.exists(name)
+
+    def listdir(self, path):
+        return self.storage.listdir(path)
+
+    def size(self, name):
+        stored = self.open(name)
+        try:
+            return stored.size
+        finally:
+            stored.close()
+
+    def get_accessed_time(self, name):
+        return self.storage.get_accessed_time(name)
+
+    def get_created_time(self, name):
+        return self.storage.get_created_time(name)
+
+    def get_modified_time(self, name):
+        return self.storage.get_modified_time(name)
+
+
+class EncryptedFileField(models.FileField):
+    """
+    FileField whose files are encrypted with EncryptedStorage. Takes the
+    `keyname`, `crypter_klass` and `chunk_size` kwargs of the storage;
+    `storage` names where the encrypted files are kept.
+    """
+
+    def __init__(self, *args, **kwargs):
+        storage = kwargs.pop('storage', None)
+        if not isinstance(storage, EncryptedStorage):
+            storage = EncryptedStorage(
+                storage=storage,
+                keyname=kwargs.pop('keyname', None),
+                crypter_klass=kwargs.pop('crypter_klass', None),
+                chunk_size=kwargs.pop('chunk_size', None),
+            )
+        kwargs['storage'] = storage
+        super(EncryptedFileField, self).__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super(
+            EncryptedFileField, self
+        ).deconstruct()
+        # Like the keyname of encrypted fields, the storage does not affect
+        # the schema.
+        kwargs.pop('storage', None)
+        return name, path, args, kwargs
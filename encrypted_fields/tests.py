@@ -1,15 +1,47 @@
 # -*- coding: utf-8 -*-
 
+import datetime
+import json
+import multiprocessing.pool
+import os
 import re
+import shutil
+import tempfile
+import threading
 import unittest
 
 import django
+from django.apps import apps
 from django.conf import settings
-from django.db import models, connection
-from django.test import TestCase
-from django.utils import timezone
-
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.core import serializers as django_serializers
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import IntegrityError, models, connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import six, timezone
+
+from . import buckets, compression, executor, keysources, serializers
+from .aead import AESGCM, AESGCMWrapper, ChaCha20Poly1305Wrapper
+from .cache import MISSING, PlaintextCache, data_key_cache, plaintext_cache
+from .derived import derive_key
+from .deterministic import DeterministicWrapper
+from .envelope import ENVELOPE_FORMAT, EnvelopeWrapper, tenant
+from .instrumentation import crypto_stats, observe, unobserve
+from .keysources import (
+    EnvironmentKeySource,
+    MemoryKeySource,
+    PackedKeySource,
+    set_key_source,
+)
 from .fields import (
+    EncryptedFieldException,
+    crypters,
+    CrypterRegistry,
+    DecryptingAttribute,
     EncryptedCharField,
     EncryptedTextField,
     EncryptedDateTimeField,
@@ -18,9 +50,36 @@ from .fields import (
     EncryptedFloatField,
     EncryptedEmailField,
     EncryptedBooleanField,
+    EncryptedJSONField,
+    JSONKeyText,
+    KeyczarHmacWrapper,
+    KeyczarWrapper,
+    LazyCleartext,
+    SkipUnchangedEncryptedFieldsMixin,
+    decrypt_many,
+    decrypt_many_async,
+    encrypt_many,
+    encrypt_many_async,
+    raw_ciphertext,
+)
+from .management.commands.reencrypt_fields import (
+    Checkpoint,
+    Command as ReencryptCommand,
+    Progress,
+    reencryptable_fields,
+)
+from .models import DataKey
+from .operations import copy_ciphertext, copy_rows
+from .query import EncryptedManager, decrypting_iterator
+from .storage import (
+    FILE_HEADER,
+    EncryptedFileField,
+    EncryptedStorage,
+    encrypted_size,
+    sealed_chunk_size,
 )
 
-from keyczar import keyczar, readers
+from keyczar import keyczar, keyczart, readers, util
 
 
 # Test class that encapsulates some Keyczar functions.
@@ -50,7 +109,7 @@ class TestModel(models.Model):
         blank=True
     )
     short_char = EncryptedCharField(
-        max_length=50, null=True, enforce_max_length=True, blank=True)
+        max_length=80, null=True, enforce_max_length=True, blank=True)
 
     text = EncryptedTextField(null=True, blank=True)
     datetime = EncryptedDateTimeField(null=True, blank=True)
@@ -59,6 +118,16 @@ class TestModel(models.Model):
     floating = EncryptedFloatField(null=True, blank=True)
     email = EncryptedEmailField(null=True, blank=True)
     boolean = EncryptedBooleanField(default=False, blank=True)
+    lazy_text = EncryptedTextField(null=True, blank=True, lazy=True)
+    indexed_email = EncryptedEmailField(
+        null=True, blank=True, blind_index=True)
+    aead_text = EncryptedTextField(
+        null=True, blank=True, crypter_klass=AESGCMWrapper)
+    binary_text = EncryptedTextField(null=True, blank=True, binary=True)
+    compressed_text = EncryptedTextField(
+        null=True, blank=True, compress=True, compress_min_length=64)
+    envelope_text = EncryptedTextField(
+        null=True, blank=True, crypter_klass=EnvelopeWrapper)
 
     char_custom_crypter = EncryptedCharField(
         max_length=255,
@@ -67,11 +136,58 @@ class TestModel(models.Model):
         blank=True
     )
 
+    objects = EncryptedManager()
+
+
+class SkipUnchangedModel(SkipUnchangedEncryptedFieldsMixin, models.Model):
+    char = EncryptedCharField(max_length=255, null=True, blank=True)
+    text = EncryptedTextField(null=True, blank=True)
+    plain = models.CharField(max_length=255, blank=True)
+
+
+class RotationModel(models.Model):
+    char = EncryptedCharField(max_length=255, null=True)
+    prefix_char = EncryptedCharField(
+        max_length=255, null=True, prefix='ENCRYPTED:::')
+    decrypt_only = EncryptedCharField(
+        max_length=255, null=True, decrypt_only=True)
+    integer = EncryptedIntegerField(null=True)
+    binary_char = EncryptedCharField(max_length=255, null=True, binary=True)
+
+
+class DeterministicModel(models.Model):
+    email = EncryptedEmailField(
+        max_length=255, unique=True, deterministic=True)
+    char = EncryptedCharField(max_length=255, null=True, deterministic=True)
+    binary_char = EncryptedCharField(
+        max_length=255, null=True, deterministic=True, binary=True)
 
-class FieldTest(TestCase):
-    IS_POSTGRES = settings.DATABASES['default']['ENGINE'] == \
-        'django.db.backends.postgresql_psycopg2'
 
+class RangeModel(models.Model):
+    day = EncryptedDateField(
+        null=True, range_index='month',
+        range_index_bounds=(datetime.date(2000, 1, 1),
+                            datetime.date(2030, 12, 31)))
+    amount = EncryptedIntegerField(
+        null=True, range_index=100, range_index_bounds=(0, 9999))
+
+    objects = EncryptedManager()
+
+
+class DocumentModel(models.Model):
+    document = EncryptedFileField(upload_to='documents', chunk_size=64)
+
+
+class JSONModel(models.Model):
+    document = EncryptedJSONField(
+        null=True, encrypted_paths=['patient.ssn', 'contacts.*.phone'])
+    lazy_document = EncryptedJSONField(
+        null=True, lazy=True, encrypted_paths=[('secret',)])
+
+    objects = EncryptedManager()
+
+
+class DbValueMixin(object):
     def get_db_value(self, field, model_id):
         cursor = connection.cursor()
         cursor.execute(
@@ -81,6 +197,11 @@ class FieldTest(TestCase):
         )
         return cursor.fetchone()[0]
 
+
+class FieldTest(DbValueMixin, TestCase):
+    IS_POSTGRES = settings.DATABASES['default']['ENGINE'] == \
+        'django.db.backends.postgresql_psycopg2'
+
     def test_char_field_encrypted_custom(self):
         plaintext = 'Oh hi, test reader!'
 
@@ -296,3 +417,2173 @@ class FieldTest(TestCase):
 
         fresh_model = TestModel.objects.get(id=obj.id)
         self.assertEqual(fresh_model.integer, plainint)
+
+
+class CountingCrypter(TestCrypter):
+    instances = 0
+
+    def __init__(self, *args, **kwargs):
+        CountingCrypter.instances += 1
+        super(CountingCrypter, self).__init__(*args, **kwargs)
+
+
+class CrypterRegistryTest(TestCase):
+    def setUp(self):
+        CountingCrypter.instances = 0
+        crypters.invalidate(crypter_klass=CountingCrypter)
+
+    def test_fields_share_crypter(self):
+        char = TestModel._meta.get_field('char')
+        text = TestModel._meta.get_field('text')
+        custom = TestModel._meta.get_field('char_custom_crypter')
+
+        self.assertTrue(char.crypter() is text.crypter())
+        self.assertFalse(char.crypter() is custom.crypter())
+
+    def test_crypter_loaded_lazily(self):
+        field = EncryptedCharField(
+            max_length=255, crypter_klass=CountingCrypter)
+        other = EncryptedTextField(crypter_klass=CountingCrypter)
+        self.assertEqual(CountingCrypter.instances, 0)
+
+        ciphertext = field.get_prep_value('Oh hi, test reader!')
+        self.assertEqual(other.to_python(ciphertext), 'Oh hi, test reader!')
+        self.assertEqual(CountingCrypter.instances, 1)
+
+    def test_invalidate_and_reload(self):
+        field = EncryptedCharField(
+            max_length=255, crypter_klass=CountingCrypter)
+        first = field.crypter()
+
+        crypters.reload(crypter_klass=CountingCrypter)
+        reloaded = field.crypter()
+        self.assertFalse(first is reloaded)
+        self.assertEqual(CountingCrypter.instances, 2)
+
+        crypters.invalidate(keydir=field.keydir)
+        self.assertFalse(reloaded is field.crypter())
+        self.assertEqual(CountingCrypter.instances, 3)
+
+    def test_registry_is_per_class_and_keydir(self):
+        registry = CrypterRegistry()
+        keydir = settings.ENCRYPTED_FIELDS_KEYDIR
+
+        crypter = registry.get(CountingCrypter, keydir)
+        self.assertTrue(registry.get(CountingCrypter, keydir) is crypter)
+        self.assertFalse(registry.get(TestCrypter, keydir) is crypter)
+
+
+class BulkCryptoTest(TestCase):
+    def test_crypter_many(self):
+        field = TestModel._meta.get_field('char')
+        crypter = field.crypter()
+        cleartexts = ['one', 'two', 'three']
+
+        ciphertexts = crypter.encrypt_many(cleartexts)
+        self.assertEqual(len(set(ciphertexts)), 3)
+        self.assertEqual([crypter.decrypt(c) for c in ciphertexts], cleartexts)
+        self.assertEqual(crypter.decrypt_many(ciphertexts), cleartexts)
+
+    def test_fallback_for_custom_crypter(self):
+        crypter = TestModel._meta.get_field('char_custom_crypter').crypter()
+        self.assertFalse(hasattr(crypter, 'decrypt_many'))
+
+        ciphertexts = encrypt_many(crypter, ['one', 'two'])
+        self.assertEqual(decrypt_many(crypter, ciphertexts), ['one', 'two'])
+
+    def test_field_many(self):
+        field = TestModel._meta.get_field('prefix_char')
+        values = [u'Oh hi, test reader! \U0001f431', None, '', 'plain']
+
+        ciphertexts = field.encrypt_many(values)
+        self.assertTrue(ciphertexts[0].startswith('ENCRYPTED:::'))
+        self.assertEqual(ciphertexts[1:3], [None, ''])
+        self.assertEqual(field.decrypt_many(ciphertexts), values)
+
+    def test_field_many_mixed_cleartext(self):
+        field = TestModel._meta.get_field('decrypt_only')
+        char = TestModel._meta.get_field('char')
+        values = [char.get_prep_value('secret'), 'I am so plain and ordinary']
+
+        self.assertEqual(
+            field.decrypt_many(values),
+            ['secret', 'I am so plain and ordinary']
+        )
+
+    def test_decrypting_iterator(self):
+        for i in range(5):
+            TestModel.objects.create(char='char %d' % i, integer=i)
+
+        objs = list(
+            TestModel.objects.order_by('id').decrypting_iterator(chunk_size=2)
+        )
+        self.assertEqual([obj.char for obj in objs],
+                         ['char %d' % i for i in range(5)])
+        self.assertEqual([obj.integer for obj in objs], list(range(5)))
+        self.assertEqual(objs[0].get_deferred_fields(), set())
+
+        objs = list(decrypting_iterator(
+            TestModel.objects.only('id', 'integer').order_by('id')
+        ))
+        self.assertEqual([obj.integer for obj in objs], list(range(5)))
+        self.assertTrue('char' in objs[0].get_deferred_fields())
+
+
+class LazyFieldTest(DbValueMixin, TestCase):
+    def test_decrypts_on_first_access(self):
+        plaintext = 'Oh hi, test reader!'
+        model = TestModel.objects.create(lazy_text=plaintext)
+
+        fresh_model = TestModel.objects.get(id=model.id)
+        loaded = fresh_model.__dict__['lazy_text']
+        self.assertTrue(isinstance(loaded, LazyCleartext))
+        self.assertEqual(loaded.ciphertext,
+                         self.get_db_value('lazy_text', model.id))
+
+        self.assertEqual(fresh_model.lazy_text, plaintext)
+        self.assertEqual(fresh_model.__dict__['lazy_text'], plaintext)
+        self.assertFalse(isinstance(fresh_model.lazy_text, LazyCleartext))
+
+    def test_save_without_access(self):
+        model = TestModel.objects.create(lazy_text='Oh hi, test reader!')
+
+        fresh_model = TestModel.objects.get(id=model.id)
+        fresh_model.char = 'changed'
+        fresh_model.save()
+
+        fresh_model = TestModel.objects.get(id=model.id)
+        self.assertEqual(fresh_model.lazy_text, 'Oh hi, test reader!')
+        self.assertEqual(fresh_model.char, 'changed')
+
+    def test_null_and_deferred(self):
+        model = TestModel.objects.create(lazy_text=None)
+        self.assertEqual(TestModel.objects.get(id=model.id).lazy_text, None)
+
+        model.lazy_text = 'deferred'
+        model.save()
+        fresh_model = TestModel.objects.defer('lazy_text').get(id=model.id)
+        self.assertEqual(fresh_model.lazy_text, 'deferred')
+
+    def test_attribute_only_for_lazy_fields(self):
+        self.assertTrue(
+            isinstance(vars(TestModel)['lazy_text'], DecryptingAttribute))
+        self.assertFalse(
+            isinstance(vars(TestModel).get('char'), DecryptingAttribute))
+
+    def test_values_list_proxies(self):
+        TestModel.objects.create(lazy_text='Oh hi, test reader!')
+        value = TestModel.objects.values_list('lazy_text', flat=True)[0]
+        self.assertEqual(value, 'Oh hi, test reader!')
+
+
+class UnchangedSaveTest(DbValueMixin, TestCase):
+    def test_unchanged_value_keeps_ciphertext(self):
+        model = TestModel.objects.create(
+            char='Oh hi, test reader!',
+            prefix_char='prefixed',
+            integer=42,
+            lazy_text='lazy',
+        )
+        fields = ('char', 'prefix_char', 'integer', 'lazy_text')
+        ciphertexts = [self.get_db_value(f, model.id) for f in fields]
+
+        fresh_model = TestModel.objects.get(id=model.id)
+        self.assertEqual(fresh_model.integer, 42)
+        fresh_model.save()
+
+        self.assertEqual(
+            [self.get_db_value(f, model.id) for f in fields],
+            ciphertexts
+        )
+
+    def test_changed_value_is_encrypted(self):
+        model = TestModel.objects.create(char='before', lazy_text='before')
+        ciphertext = self.get_db_value('char', model.id)
+
+        fresh_model = TestModel.objects.get(id=model.id)
+        fresh_model.char = 'after'
+        fresh_model.lazy_text = 'after'
+        fresh_model.save()
+
+        self.assertNotEqual(self.get_db_value('char', model.id), ciphertext)
+        fresh_model = TestModel.objects.get(id=model.id)
+        self.assertEqual(fresh_model.char, 'after')
+        self.assertEqual(fresh_model.lazy_text, 'after')
+
+    def test_decrypting_iterator_keeps_ciphertext(self):
+        model = TestModel.objects.create(char='Oh hi, test reader!')
+        ciphertext = self.get_db_value('char', model.id)
+
+        fresh_model = next(TestModel.objects.all().decrypting_iterator())
+        fresh_model.save()
+        self.assertEqual(self.get_db_value('char', model.id), ciphertext)
+
+    def test_skip_unchanged_fields(self):
+        model = SkipUnchangedModel.objects.create(char='char', text='text')
+        model = SkipUnchangedModel.objects.get(id=model.id)
+
+        with CaptureQueriesContext(connection) as queries:
+            model.save(update_fields=['char', 'text'])
+        self.assertEqual(len(queries), 0)
+
+        model.plain = 'changed'
+        with CaptureQueriesContext(connection) as queries:
+            model.save()
+        self.assertEqual(len(queries), 1)
+        self.assertTrue('"plain"' in queries[0]['sql'])
+        self.assertTrue('"char"' not in queries[0]['sql'])
+        self.assertTrue('"text"' not in queries[0]['sql'])
+
+        model.char = 'changed'
+        with CaptureQueriesContext(connection) as queries:
+            model.save(update_fields=['char', 'text'])
+        self.assertTrue('"char"' in queries[0]['sql'])
+        self.assertTrue('"text"' not in queries[0]['sql'])
+
+        model = SkipUnchangedModel.objects.get(id=model.id)
+        self.assertEqual(
+            (model.char, model.text, model.plain),
+            ('changed', 'text', 'changed')
+        )
+
+
+class BlindIndexTest(DbValueMixin, TestCase):
+    def test_index_maintained_on_save(self):
+        first = TestModel.objects.create(indexed_email='aron@example.com')
+        second = TestModel.objects.create(indexed_email='aron@example.com')
+        index = self.get_db_value('indexed_email_blind_index', first.id)
+
+        self.assertTrue(index)
+        self.assertTrue('aron' not in index)
+        self.assertEqual(
+            self.get_db_value('indexed_email_blind_index', second.id), index)
+        self.assertNotEqual(
+            self.get_db_value('indexed_email', second.id),
+            self.get_db_value('indexed_email', first.id)
+        )
+
+        second.indexed_email = 'jones@example.com'
+        second.save()
+        self.assertNotEqual(
+            self.get_db_value('indexed_email_blind_index', second.id), index)
+
+        second.indexed_email = None
+        second.save()
+        self.assertEqual(
+            self.get_db_value('indexed_email_blind_index', second.id), None)
+
+    def test_exact_and_in_lookups(self):
+        aron = TestModel.objects.create(indexed_email='aron@example.com')
+        jones = TestModel.objects.create(indexed_email='jones@example.com')
+        empty = TestModel.objects.create(indexed_email=None)
+
+        queryset = TestModel.objects.filter(indexed_email='aron@example.com')
+        self.assertTrue('indexed_email_blind_index' in str(queryset.query))
+        self.assertEqual(list(queryset), [aron])
+
+        self.assertEqual(
+            TestModel.objects.get(indexed_email='jones@example.com'), jones)
+        self.assertEqual(
+            list(TestModel.objects.filter(indexed_email=None)), [empty])
+        self.assertEqual(
+            list(TestModel.objects.filter(
+                indexed_email__in=['aron@example.com', 'jones@example.com']
+            ).order_by('id')),
+            [aron, jones]
+        )
+        self.assertEqual(
+            list(TestModel.objects.exclude(
+                indexed_email='aron@example.com'
+            ).exclude(indexed_email=None)),
+            [jones]
+        )
+
+    def test_index_kept_for_unchanged_value(self):
+        model = TestModel.objects.create(indexed_email='aron@example.com')
+        TestModel.objects.filter(id=model.id).update(
+            indexed_email_blind_index=None)
+
+        # A missing index is backfilled by saving the row.
+        fresh_model = TestModel.objects.get(id=model.id)
+        fresh_model.save()
+        self.assertEqual(
+            TestModel.objects.get(indexed_email='aron@example.com'), model)
+
+    def test_non_literal_lookup_rejected(self):
+        self.assertRaises(
+            ValueError,
+            TestModel.objects.filter,
+            indexed_email=models.F('email')
+        )
+
+    def test_index_maintained_on_update(self):
+        model = TestModel.objects.create(indexed_email='a@example.com')
+        TestModel.objects.filter(id=model.id).update(
+            indexed_email='b@example.com')
+
+        self.assertEqual(
+            TestModel.objects.get(indexed_email='b@example.com'), model)
+        self.assertFalse(
+            TestModel.objects.filter(indexed_email='a@example.com').exists())
+        self.assertRaises(
+            EncryptedFieldException,
+            TestModel.objects.filter(id=model.id).update,
+            indexed_email=models.F('email')
+        )
+
+    def test_index_maintained_with_update_fields(self):
+        model = TestModel.objects.create(indexed_email='a@example.com')
+        model.indexed_email = 'b@example.com'
+        model.save(update_fields=['indexed_email'])
+
+        self.assertEqual(
+            TestModel.objects.get(indexed_email='b@example.com'), model)
+        self.assertFalse(
+            TestModel.objects.filter(indexed_email='a@example.com').exists())
+
+        # Also when the values to save come from a deferred load.
+        model = TestModel.objects.only('indexed_email').get(id=model.id)
+        model.indexed_email = 'c@example.com'
+        model.save()
+        self.assertEqual(
+            TestModel.objects.get(indexed_email='c@example.com'), model)
+
+
+class ReencryptFieldsMixin(object):
+    """
+    Points the fields of RotationModel at a scratch copy of the test keyset
+    so a new primary key can be promoted.
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.keydir = os.path.join(self.tmpdir, 'keys')
+        shutil.copytree(settings.ENCRYPTED_FIELDS_KEYDIR, self.keydir)
+        for field in RotationModel._meta.concrete_fields[1:]:
+            field.keydir = self.keydir
+
+    def tearDown(self):
+        for field in RotationModel._meta.concrete_fields[1:]:
+            field.keydir = settings.ENCRYPTED_FIELDS_KEYDIR
+        crypters.invalidate(keydir=self.keydir)
+        shutil.rmtree(self.tmpdir)
+
+    def rotate(self):
+        keyczart.main(
+            ['addkey', '--location=' + self.keydir, '--status=primary'])
+
+    def get_db_values(self, model_id):
+        cursor = connection.cursor()
+        cursor.execute(
+            'select char, prefix_char, decrypt_only, integer '
+            'from encrypted_fields_rotationmodel '
+            'where id = {0};'.format(model_id)
+        )
+        return cursor.fetchone()
+
+    def assert_primary(self, ciphertext, prefix=''):
+        crypter = RotationModel._meta.get_field('char').crypter()
+        self.assertTrue(ciphertext.startswith(prefix))
+        self.assertTrue(
+            crypter.encrypted_with_primary(ciphertext[len(prefix):]))
+
+
+class ReencryptFieldsTest(ReencryptFieldsMixin, TestCase):
+    def test_reencrypts_with_new_primary(self):
+        models_ = [
+            RotationModel.objects.create(
+                char='char %d' % i,
+                prefix_char='prefix %d' % i,
+                decrypt_only='plain %d' % i,
+                integer=i,
+            )
+            for i in range(5)
+        ]
+        models_.append(RotationModel.objects.create())
+        before = [self.get_db_values(model.id) for model in models_]
+
+        self.rotate()
+        call_command('reencrypt_fields', 'encrypted_fields.RotationModel',
+                     batch_size=2, verbosity=0)
+
+        for model, old in zip(models_, before):
+            new = self.get_db_values(model.id)
+            if old[0] is None:
+                self.assertEqual(new, old)
+                continue
+            self.assertNotEqual(new[0], old[0])
+            self.assert_primary(new[0])
+            self.assert_primary(new[1], 'ENCRYPTED:::')
+            self.assertEqual(new[2], old[2])
+            self.assert_primary(new[3])
+
+            fresh_model = RotationModel.objects.get(id=model.id)
+            self.assertEqual(
+                (fresh_model.char, fresh_model.prefix_char,
+                 fresh_model.decrypt_only, fresh_model.integer),
+                (model.char, model.prefix_char,
+                 model.decrypt_only, model.integer)
+            )
+
+    def test_skips_current_values(self):
+        model = RotationModel.objects.create(char='char', integer=1)
+        before = self.get_db_values(model.id)
+
+        call_command('reencrypt_fields', 'encrypted_fields.RotationModel',
+                     verbosity=0)
+        self.assertEqual(self.get_db_values(model.id), before)
+
+    def test_checkpoint_resume(self):
+        models_ = [
+            RotationModel.objects.create(char='char %d' % i)
+            for i in range(4)
+        ]
+        before = [self.get_db_values(model.id) for model in models_]
+        checkpoint = os.path.join(self.tmpdir, 'checkpoint.json')
+        with open(checkpoint, 'w') as checkpoint_file:
+            json.dump({
+                'encrypted_fields.RotationModel': [
+                    [models_[1].id, models_[-1].id],
+                ],
+            }, checkpoint_file)
+
+        self.rotate()
+        call_command('reencrypt_fields', 'encrypted_fields.RotationModel',
+                     checkpoint=checkpoint, verbosity=0)
+
+        after = [self.get_db_values(model.id) for model in models_]
+        self.assertEqual(after[:2], before[:2])
+        self.assertNotEqual(after[2][0], before[2][0])
+        self.assertNotEqual(after[3][0], before[3][0])
+        with open(checkpoint) as checkpoint_file:
+            self.assertEqual(
+                json.load(checkpoint_file),
+                {'encrypted_fields.RotationModel': [
+                    [models_[-1].id, models_[-1].id],
+                ]}
+            )
+
+    def test_reencrypts_binary(self):
+        model = RotationModel.objects.create(binary_char='binary')
+        field = RotationModel._meta.get_field('binary_char')
+
+        self.rotate()
+        call_command('reencrypt_fields', 'encrypted_fields.RotationModel',
+                     verbosity=0)
+
+        cursor = connection.cursor()
+        cursor.execute(
+            'select binary_char from encrypted_fields_rotationmodel '
+            'where id = {0};'.format(model.id)
+        )
+        ciphertext = bytes(cursor.fetchone()[0])
+        self.assertEqual(
+            ciphertext[:keyczar.HEADER_SIZE],
+            field.crypter().crypter.primary_key.Header()
+        )
+        fresh_model = RotationModel.objects.get(id=model.id)
+        self.assertEqual(fresh_model.binary_char, 'binary')
+
+    def make_command(self, workers):
+        command = ReencryptCommand()
+        command.database = 'default'
+        command.workers = workers
+        command.batch_size = 2
+        command.verbosity = 0
+        command.checkpoint = Checkpoint(None)
+        return command
+
+    def test_plan_ranges(self):
+        ids = [RotationModel.objects.create().id for i in range(10)]
+
+        for workers in (2, 3, 4, 9, 10, 20):
+            ranges = self.make_command(workers).plan_ranges(RotationModel)
+            self.assertTrue(len(ranges) <= workers)
+            self.assertEqual(ranges[0][0], ids[0] - 1)
+            self.assertEqual(ranges[-1][1], ids[-1])
+            # Each range is (start, end]: together they cover every pk from
+            # the lowest to the highest exactly once.
+            for previous, pk_range in zip(ranges, ranges[1:]):
+                self.assertEqual(previous[1], pk_range[0])
+            for start, end in ranges:
+                self.assertTrue(start < end)
+
+    def test_worker_ranges(self):
+        # What each --workers thread runs, one range after the other: the
+        # test database cannot take concurrent writers.
+        models_ = [
+            RotationModel.objects.create(char='char %d' % i, integer=i)
+            for i in range(10)
+        ]
+        self.rotate()
+        crypters.invalidate(keydir=self.keydir)
+
+        command = self.make_command(3)
+        label = RotationModel._meta.label
+        ranges = command.plan_ranges(RotationModel)
+        self.assertEqual(len(ranges), 3)
+        command.checkpoint.start(label, ranges)
+
+        progress = Progress()
+        errors = []
+        for index in range(len(ranges)):
+            command.reencrypt_range_thread(
+                RotationModel, reencryptable_fields(RotationModel), label,
+                index, progress, errors
+            )
+        self.assertEqual(errors, [])
+        self.assertEqual(progress.rows, 10)
+        self.assertEqual(
+            command.checkpoint.ranges(label),
+            [[end, end] for start, end in ranges]
+        )
+        for model in models_:
+            new = self.get_db_values(model.id)
+            self.assert_primary(new[0])
+            self.assert_primary(new[3])
+            self.assertEqual(RotationModel.objects.get(id=model.id).integer,
+                             model.integer)
+
+
+class ReencryptFieldsWorkersTest(ReencryptFieldsMixin, TransactionTestCase):
+    @unittest.skipIf(
+        not connection.features.test_db_allows_multiple_connections,
+        "Worker threads need their own connections to the test database"
+    )
+    def test_workers(self):
+        models_ = [
+            RotationModel.objects.create(char='char %d' % i, integer=i)
+            for i in range(10)
+        ]
+
+        self.rotate()
+        call_command('reencrypt_fields', 'encrypted_fields.RotationModel',
+                     workers=3, batch_size=2, verbosity=0)
+
+        for model in models_:
+            new = self.get_db_values(model.id)
+            self.assert_primary(new[0])
+            self.assert_primary(new[3])
+            self.assertEqual(RotationModel.objects.get(id=model.id).integer,
+                             model.integer)
+
+
+class ParallelDecryptTest(TestCase):
+    def setUp(self):
+        self.models = [
+            TestModel.objects.create(
+                char='char %d' % i,
+                integer=i,
+                char_custom_crypter='custom %d' % i,
+                decrypt_only='plain %d' % i,
+            )
+            for i in range(12)
+        ]
+
+    def assert_hydrated(self, objs):
+        self.assertEqual([obj.id for obj in objs],
+                         [model.id for model in self.models])
+        for obj, model in zip(objs, self.models):
+            self.assertEqual(
+                (obj.char, obj.integer, obj.char_custom_crypter,
+                 obj.decrypt_only),
+                (model.char, model.integer, model.char_custom_crypter,
+                 model.decrypt_only)
+            )
+
+    def test_process_workers(self):
+        self.assert_hydrated(list(
+            TestModel.objects.order_by('id').decrypting_iterator(
+                workers=2, chunk_size=5)
+        ))
+
+    def test_existing_pool(self):
+        pool = multiprocessing.pool.ThreadPool(3)
+        try:
+            self.assert_hydrated(list(decrypting_iterator(
+                TestModel.objects.order_by('id'), chunk_size=1, pool=pool
+            )))
+        finally:
+            pool.terminate()
+
+
+@unittest.skipIf(AESGCM is None, "The cryptography package is not installed")
+class AEADCrypterTest(DbValueMixin, TestCase):
+    def test_field_round_trip(self):
+        plaintext = u'Oh hi, test reader! \U0001f431'
+        model = TestModel.objects.create(aead_text=plaintext)
+
+        ciphertext = self.get_db_value('aead_text', model.id)
+        self.assertTrue('test' not in ciphertext)
+        # format byte, key hash, nonce, serializer tag, 24 bytes of UTF-8
+        # text and tag
+        self.assertEqual(len(ciphertext), 78)
+
+        fresh_model = TestModel.objects.get(id=model.id)
+        self.assertEqual(fresh_model.aead_text, plaintext)
+
+    def test_reads_keyczar_ciphertext(self):
+        model = TestModel.objects.create(char='Oh hi, test reader!')
+        TestModel.objects.filter(id=model.id).update(
+            aead_text=models.F('char'))
+
+        fresh_model = TestModel.objects.get(id=model.id)
+        self.assertEqual(fresh_model.aead_text, 'Oh hi, test reader!')
+
+    def test_formats_share_keyset(self):
+        keydir = settings.ENCRYPTED_FIELDS_KEYDIR
+        gcm = AESGCMWrapper(keydir)
+        chacha = ChaCha20Poly1305Wrapper(keydir)
+
+        ciphertexts = gcm.encrypt_many(['one', 'two'])
+        self.assertEqual(chacha.decrypt_many(ciphertexts), ['one', 'two'])
+        self.assertEqual(gcm.decrypt(chacha.encrypt('three')), 'three')
+
+        self.assertTrue(gcm.encrypted_with_primary(ciphertexts[0]))
+        self.assertFalse(chacha.encrypted_with_primary(ciphertexts[0]))
+
+    def test_tampered_ciphertext(self):
+        gcm = AESGCMWrapper(settings.ENCRYPTED_FIELDS_KEYDIR)
+        ciphertext = gcm.encrypt('Oh hi, test reader!')
+        tampered = ciphertext[:-2] + ('A' if ciphertext[-2] != 'A' else 'B')
+        tampered += ciphertext[-1]
+
+        self.assertRaises(
+            keyczar.errors.InvalidSignatureError, gcm.decrypt, tampered)
+        self.assertRaises(
+            keyczar.errors.ShortCiphertextError, gcm.decrypt, ciphertext[:30])
+
+    def test_derive_key_is_hkdf(self):
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+        key = KeyczarWrapper(settings.ENCRYPTED_FIELDS_KEYDIR).crypter
+        key = key.primary_key
+        hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=None,
+                    info=b'info', backend=default_backend())
+        self.assertEqual(
+            derive_key(key, b'info'),
+            hkdf.derive(key.key_bytes + key.hmac_key.key_bytes)
+        )
+
+    @override_settings(
+        ENCRYPTED_FIELDS_CRYPTER='encrypted_fields.aead.AESGCMWrapper')
+    def test_default_crypter_setting(self):
+        field = EncryptedCharField(max_length=255)
+        self.assertTrue(field._crypter_klass is AESGCMWrapper)
+
+
+class BinaryStorageTest(DbValueMixin, TestCase):
+    def test_round_trip(self):
+        plaintext = u'Oh hi, test reader! \U0001f431'
+        model = TestModel.objects.create(binary_text=plaintext, text=plaintext)
+
+        ciphertext = bytes(self.get_db_value('binary_text', model.id))
+        self.assertTrue(b'test' not in ciphertext)
+        self.assertEqual(
+            len(ciphertext),
+            len(util.Base64WSDecode(self.get_db_value('text', model.id)))
+        )
+
+        fresh_model = TestModel.objects.get(id=model.id)
+        self.assertEqual(fresh_model.binary_text, plaintext)
+        self.assertEqual(
+            list(TestModel.objects.values_list('binary_text', flat=True)),
+            [plaintext]
+        )
+
+    def test_decrypting_iterator(self):
+        for i in range(3):
+            TestModel.objects.create(binary_text='binary %d' % i)
+
+        queryset = TestModel.objects.order_by('id')
+        self.assertEqual(
+            [obj.binary_text
+             for obj in queryset.decrypting_iterator(chunk_size=2)],
+            ['binary 0', 'binary 1', 'binary 2']
+        )
+
+    def test_column_type(self):
+        field = TestModel._meta.get_field('binary_text')
+        self.assertEqual(
+            field.db_type(connection),
+            models.BinaryField().db_type(connection)
+        )
+        self.assertTrue(field.deconstruct()[3]['binary'])
+        self.assertFalse(
+            'binary' in TestModel._meta.get_field('text').deconstruct()[3])
+
+        self.assertRaises(
+            ImproperlyConfigured,
+            EncryptedCharField, max_length=255, binary=True, decrypt_only=True
+        )
+
+    def test_copy_ciphertext(self):
+        model = TestModel.objects.create(char='Oh hi, test reader!')
+
+        class SchemaEditor(object):
+            pass
+        schema_editor = SchemaEditor()
+        schema_editor.connection = connection
+
+        copy_ciphertext(
+            'encrypted_fields.TestModel', 'char', 'binary_text', batch_size=1
+        )(apps, schema_editor)
+        copy_ciphertext(
+            'encrypted_fields.TestModel', 'binary_text', 'text'
+        )(apps, schema_editor)
+
+        self.assertEqual(
+            self.get_db_value('text', model.id),
+            self.get_db_value('char', model.id)
+        )
+        fresh_model = TestModel.objects.get(id=model.id)
+        self.assertEqual(fresh_model.binary_text, 'Oh hi, test reader!')
+        self.assertEqual(fresh_model.text, 'Oh hi, test reader!')
+
+        self.assertRaises(
+            ValueError,
+            copy_ciphertext('encrypted_fields.TestModel', 'char', 'text'),
+            apps, schema_editor
+        )
+
+
+class CompressionTest(DbValueMixin, TestCase):
+    def test_large_values_compressed(self):
+        plaintext = u'{"notes": "Oh hi, test reader! \U0001f431"}' * 100
+        model = TestModel.objects.create(
+            compressed_text=plaintext, text=plaintext)
+
+        compressed = self.get_db_value('compressed_text', model.id)
+        self.assertTrue(
+            len(compressed) < len(self.get_db_value('text', model.id)) / 10)
+
+        fresh_model = TestModel.objects.get(id=model.id)
+        self.assertEqual(fresh_model.compressed_text, plaintext)
+        self.assertEqual(
+            [obj.compressed_text
+             for obj in TestModel.objects.all().decrypting_iterator()],
+            [plaintext]
+        )
+
+    def test_small_values_not_compressed(self):
+        model = TestModel.objects.create(
+            compressed_text='short', text='short')
+        self.assertEqual(
+            len(self.get_db_value('compressed_text', model.id)),
+            len(self.get_db_value('text', model.id))
+        )
+
+    def test_mixed_rows(self):
+        plaintext = 'Oh hi, test reader! ' * 20
+        compressed = TestModel.objects.create(compressed_text=plaintext)
+        uncompressed = TestModel.objects.create(text=plaintext)
+        TestModel.objects.filter(id=uncompressed.id).update(
+            compressed_text=models.F('text'))
+        TestModel.objects.filter(id=compressed.id).update(
+            text=models.F('compressed_text'))
+
+        for model_id in (compressed.id, uncompressed.id):
+            fresh_model = TestModel.objects.get(id=model_id)
+            self.assertEqual(fresh_model.compressed_text, plaintext)
+            self.assertEqual(fresh_model.text, plaintext)
+
+    def test_compressors(self):
+        for method in compression.COMPRESSORS:
+            field = EncryptedTextField(compress=method, compress_min_length=0)
+            ciphertext = field.get_prep_value('x' * 1000)
+            self.assertTrue(len(ciphertext) < 300)
+            self.assertEqual(field.to_python(ciphertext), 'x' * 1000)
+
+        self.assertRaises(
+            ImproperlyConfigured, EncryptedTextField, compress='snappy')
+
+
+class DecryptCountingWrapper(KeyczarWrapper):
+    decrypts = 0
+
+    def decrypt(self, ciphertext):
+        DecryptCountingWrapper.decrypts += 1
+        return super(DecryptCountingWrapper, self).decrypt(ciphertext)
+
+    def decrypt_raw_many(self, ciphertexts):
+        DecryptCountingWrapper.decrypts += len(ciphertexts)
+        return super(DecryptCountingWrapper, self).decrypt_raw_many(
+            ciphertexts)
+
+
+class CiphertextDetectionTest(TestCase):
+    def setUp(self):
+        DecryptCountingWrapper.decrypts = 0
+        self.field = EncryptedCharField(
+            max_length=255, crypter_klass=DecryptCountingWrapper)
+
+    def test_cleartext_not_decrypted(self):
+        ciphertext = self.field.get_prep_value('Oh hi, test reader!')
+
+        self.assertEqual(self.field.to_python('cleartext'), 'cleartext')
+        self.assertEqual(self.field.to_python(ciphertext[:5]), ciphertext[:5])
+        self.assertEqual(DecryptCountingWrapper.decrypts, 0)
+
+        self.assertEqual(
+            self.field.to_python(ciphertext), 'Oh hi, test reader!')
+        self.assertEqual(DecryptCountingWrapper.decrypts, 1)
+
+    def test_decrypt_many_skips_cleartext(self):
+        ciphertext = self.field.get_prep_value('one')
+
+        self.assertEqual(
+            self.field.decrypt_many(['cleartext', ciphertext, None]),
+            ['cleartext', 'one', None]
+        )
+        self.assertEqual(DecryptCountingWrapper.decrypts, 1)
+
+    def test_other_keyset_not_decrypted(self):
+        other_keydir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, other_keydir)
+        keyczart.main(
+            ['create', '--location=' + other_keydir, '--purpose=crypt'])
+        keyczart.main(
+            ['addkey', '--location=' + other_keydir, '--status=primary'])
+        other = KeyczarWrapper(other_keydir).encrypt('other')
+
+        self.assertEqual(self.field.to_python(other), other)
+        self.assertEqual(DecryptCountingWrapper.decrypts, 0)
+
+    def test_prefix_without_headers(self):
+        field = EncryptedCharField(
+            max_length=255, prefix='ENCRYPTED:::', crypter_klass=TestCrypter)
+        ciphertext = field.get_prep_value('Oh hi, test reader!')
+
+        self.assertFalse(field.looks_encrypted('cleartext'))
+        self.assertTrue(field.looks_encrypted(ciphertext))
+        self.assertEqual(field.to_python(ciphertext), 'Oh hi, test reader!')
+
+    def test_loaded_value_not_decrypted_again(self):
+        model = TestModel.objects.create(char='Oh hi, test reader!')
+        fresh_model = TestModel.objects.get(id=model.id)
+        field = TestModel._meta.get_field('char')
+
+        def to_python(value):
+            self.fail('clean() tried to decrypt a loaded value')
+        field.to_python = to_python
+        try:
+            self.assertEqual(
+                field.clean(fresh_model.char, fresh_model),
+                'Oh hi, test reader!'
+            )
+        finally:
+            del field.to_python
+
+        fresh_model.char = 'changed'
+        self.assertEqual(field.clean(fresh_model.char, fresh_model), 'changed')
+
+
+class PlaintextCacheTest(TestCase):
+    def setUp(self):
+        DecryptCountingWrapper.decrypts = 0
+        plaintext_cache.clear()
+        plaintext_cache.reset_stats()
+        self.field = EncryptedCharField(
+            max_length=255, crypter_klass=DecryptCountingWrapper, cache=True)
+
+    def test_lru_eviction(self):
+        cache = PlaintextCache(max_entries=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+
+        self.assertTrue(cache.get('b') is MISSING)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(
+            cache.stats(),
+            {'hits': 3, 'misses': 1, 'evictions': 1, 'expirations': 0,
+             'size': 2}
+        )
+
+    def test_ttl_and_value_length(self):
+        cache = PlaintextCache(ttl=-1, max_value_length=5)
+        cache.set('a', 'short')
+        cache.set('b', 'too long')
+
+        self.assertTrue(cache.get('a') is MISSING)
+        self.assertTrue(cache.get('b') is MISSING)
+        self.assertEqual(cache.stats()['expirations'], 1)
+        self.assertEqual(len(cache), 0)
+
+    def test_field_cache(self):
+        ciphertexts = [self.field.get_prep_value(v) for v in ('one', 'two')]
+
+        self.assertEqual(self.field.to_python(ciphertexts[0]), 'one')
+        self.assertEqual(self.field.to_python(ciphertexts[0]), 'one')
+        self.assertEqual(DecryptCountingWrapper.decrypts, 1)
+
+        self.assertEqual(self.field.decrypt_many(ciphertexts), ['one', 'two'])
+        self.assertEqual(self.field.decrypt_many(ciphertexts), ['one', 'two'])
+        self.assertEqual(DecryptCountingWrapper.decrypts, 2)
+        self.assertEqual(plaintext_cache.stats()['hits'], 4)
+
+    def test_cleared_on_reload(self):
+        ciphertext = self.field.get_prep_value('one')
+        self.field.to_python(ciphertext)
+        self.assertEqual(len(plaintext_cache), 1)
+
+        crypters.reload()
+        self.assertEqual(len(plaintext_cache), 0)
+        self.assertEqual(self.field.to_python(ciphertext), 'one')
+        self.assertEqual(DecryptCountingWrapper.decrypts, 2)
+
+    def test_uncached_field(self):
+        field = EncryptedCharField(
+            max_length=255, crypter_klass=DecryptCountingWrapper)
+        ciphertext = field.get_prep_value('one')
+        field.to_python(ciphertext)
+        field.to_python(ciphertext)
+
+        self.assertEqual(DecryptCountingWrapper.decrypts, 2)
+        self.assertEqual(len(plaintext_cache), 0)
+
+
+class InstrumentationTest(TestCase):
+    def setUp(self):
+        self.events = []
+        observe(self.events.append)
+        self.addCleanup(unobserve, self.events.append)
+        self.field = TestModel._meta.get_field('char')
+        primary_key = self.field.crypter().crypter.primary_key
+        self.key_hash = util.Base64WSEncode(primary_key.Header()[1:])
+
+    def test_events(self):
+        ciphertext = self.field.get_prep_value('Oh hi, test reader!')
+        self.field.decrypt_many([ciphertext, ciphertext])
+        self.field.to_python(ciphertext[:-4] + 'AAAA')
+
+        self.assertEqual(
+            [(e.operation, e.values, e.failed, e.keys) for e in self.events],
+            [('encrypt', 1, False, {self.key_hash: 1}),
+             ('decrypt', 2, False, {self.key_hash: 2}),
+             ('decrypt', 1, True, {self.key_hash: 1})]
+        )
+        # serializer tag and text
+        self.assertEqual(
+            self.events[0].bytes, 1 + len('Oh hi, test reader!'))
+        self.assertEqual(self.events[1].bytes, 2 * len(ciphertext))
+        self.assertEqual(self.events[0].field, self.field)
+        self.assertEqual(self.events[0].keyname, 'testkey')
+
+    def test_keysets_reported_separately(self):
+        other = EncryptedCharField(max_length=255)
+        other.keydir = settings.ENCRYPTED_FIELDS_DETERMINISTIC_KEYDIR
+        with crypto_stats() as stats:
+            self.field.get_prep_value('Oh hi, test reader!')
+            other.get_prep_value('Oh hi, test reader!')
+
+        self.assertEqual(
+            sorted(keyname for _, keyname, _ in stats.operations),
+            ['testdeterministickey', 'testkey']
+        )
+
+    def test_unobserve(self):
+        unobserve(self.events.append)
+        self.field.get_prep_value('Oh hi, test reader!')
+        self.assertEqual(self.events, [])
+
+    def test_crypto_stats(self):
+        with crypto_stats() as stats:
+            model = TestModel.objects.create(char='Oh hi, test reader!')
+            TestModel.objects.get(id=model.id)
+
+            thread = threading.Thread(
+                target=self.field.get_prep_value, args=('other thread',))
+            thread.start()
+            thread.join()
+        self.field.get_prep_value('after')
+
+        encrypt = stats.operations[
+            ('encrypted_fields.TestModel.char', 'testkey', 'encrypt')]
+        decrypt = stats.operations[
+            ('encrypted_fields.TestModel.char', 'testkey', 'decrypt')]
+        self.assertEqual((encrypt.calls, encrypt.values), (1, 1))
+        self.assertEqual((decrypt.calls, decrypt.values), (1, 1))
+        self.assertEqual(dict(decrypt.keys), {self.key_hash: 1})
+        self.assertTrue(
+            'encrypted_fields.TestModel.char encrypt' in stats.summary())
+
+
+class EncryptedPartitionTest(DbValueMixin, TestCase):
+    def setUp(self):
+        self.plain = TestModel.objects.create(decrypt_only='plain')
+        self.encrypted = TestModel.objects.create(char='secret')
+        TestModel.objects.filter(id=self.encrypted.id).update(
+            decrypt_only=models.F('char'))
+        self.empty = TestModel.objects.create()
+
+    def test_is_encrypted_lookup(self):
+        ids = TestModel.objects.values_list('id', flat=True)
+        self.assertEqual(
+            list(ids.filter(decrypt_only__is_encrypted=True)),
+            [self.encrypted.id]
+        )
+        self.assertEqual(
+            list(ids.filter(decrypt_only__is_encrypted=False)),
+            [self.plain.id]
+        )
+
+        with CaptureQueriesContext(connection) as queries:
+            list(TestModel.objects.filter(decrypt_only__is_encrypted=True))
+        self.assertTrue(' LIKE ' in queries[0]['sql'])
+
+    def test_prefix(self):
+        cursor = connection.cursor()
+        cursor.execute(
+            "update encrypted_fields_testmodel set prefix_char = 'plain' "
+            "where id = {0};".format(self.plain.id)
+        )
+        TestModel.objects.filter(id=self.encrypted.id).update(
+            prefix_char='secret')
+
+        self.assertEqual(
+            list(TestModel.objects.filter(
+                prefix_char__is_encrypted=True).values_list('id', flat=True)),
+            [self.encrypted.id]
+        )
+
+    def test_queryset_methods(self):
+        self.assertEqual(
+            list(TestModel.objects.unencrypted('decrypt_only')),
+            [self.plain]
+        )
+        self.assertEqual(
+            list(TestModel.objects.encrypted('decrypt_only').order_by('id')),
+            [self.encrypted, self.empty]
+        )
+        self.assertRaises(
+            ValueError, list,
+            TestModel.objects.encrypted('binary_text')
+        )
+
+    def test_encrypt_fields_command(self):
+        call_command('encrypt_fields', 'encrypted_fields.TestModel',
+                     batch_size=1, verbosity=0)
+
+        ciphertext = self.get_db_value('decrypt_only', self.plain.id)
+        self.assertNotEqual(ciphertext, 'plain')
+        self.assertEqual(
+            TestModel.objects.get(id=self.plain.id).decrypt_only, 'plain')
+        self.assertEqual(
+            self.get_db_value('decrypt_only', self.empty.id), '')
+        self.assertFalse(
+            TestModel.objects.unencrypted('decrypt_only').exists())
+
+
+class CiphertextLengthTest(TestCase):
+    def test_crypter_lengths(self):
+        keydir = settings.ENCRYPTED_FIELDS_KEYDIR
+        klasses = [KeyczarWrapper, DeterministicWrapper]
+        if AESGCM is not None:
+            klasses.append(AESGCMWrapper)
+        for klass in klasses:
+            crypter = klass(keydir)
+            for length in (0, 1, 15, 16, 17, 100):
+                ciphertext = crypter.encrypt('x' * length)
+                self.assertEqual(
+                    crypter.ciphertext_length(length), len(ciphertext))
+                self.assertEqual(
+                    crypter.ciphertext_length(length, binary=True),
+                    len(util.Base64WSDecode(ciphertext))
+                )
+
+    def test_max_cleartext_length(self):
+        field = EncryptedCharField(max_length=100, enforce_max_length=True)
+        self.assertEqual(field.max_cleartext_length(), 30)
+        self.assertTrue(len(field.get_prep_value('x' * 30)) <= 100)
+        self.assertEqual(field.formfield().max_length, 30)
+
+        prefixed = EncryptedCharField(
+            max_length=100, enforce_max_length=True, prefix='ENCRYPTED:::')
+        self.assertEqual(prefixed.max_cleartext_length(), 14)
+
+        self.assertEqual(
+            EncryptedCharField(max_length=100).formfield().max_length, 100)
+
+    def test_rejected_before_encrypting(self):
+        events = []
+        observe(events.append)
+        self.addCleanup(unobserve, events.append)
+        field = EncryptedCharField(max_length=100, enforce_max_length=True)
+
+        self.assertRaises(ValueError, field.get_prep_value, 'x' * 31)
+        self.assertRaises(ValueError, field.encrypt_many, ['x', 'x' * 31])
+        self.assertEqual(events, [])
+
+    def test_validation(self):
+        field = EncryptedCharField(max_length=100, enforce_max_length=True)
+        field.clean('x' * 30, None)
+        self.assertRaises(ValidationError, field.clean, 'x' * 31, None)
+        # UTF-8 makes non-ASCII characters longer
+        field.clean(u'\xe9' * 15, None)
+        self.assertRaises(ValidationError, field.clean, u'\xe9' * 16, None)
+
+    def test_checks(self):
+        field = EncryptedCharField(max_length=50, enforce_max_length=True)
+        field.set_attributes_from_name('tiny')
+        errors = field._check_enforce_max_length()
+        self.assertEqual([e.id for e in errors], ['encrypted_fields.W002'])
+        self.assertEqual(errors[0].hint, 'Use max_length=76 or more.')
+
+        field = EncryptedCharField(
+            max_length=255, enforce_max_length=True, crypter_klass=TestCrypter)
+        field.set_attributes_from_name('custom')
+        self.assertEqual(
+            [e.id for e in field._check_enforce_max_length()],
+            ['encrypted_fields.W001']
+        )
+        self.assertEqual(TestModel._meta.get_field('char').check(), [])
+        self.assertEqual(
+            TestModel._meta.get_field('short_char').check(), [])
+
+
+def make_test_executor():
+    return multiprocessing.pool.ThreadPool(1)
+
+
+class AsyncCryptoTest(TestCase):
+    def setUp(self):
+        self.pool = multiprocessing.pool.ThreadPool(2)
+        executor.set_executor(self.pool)
+        self.addCleanup(self.pool.terminate)
+        self.addCleanup(executor.set_executor, None)
+
+    def test_crypter_many(self):
+        crypter = TestModel._meta.get_field('char').crypter()
+        ciphertexts = encrypt_many_async(crypter, ['one', 'two']).get()
+        self.assertEqual(
+            decrypt_many_async(crypter, ciphertexts).get(), ['one', 'two'])
+
+        ciphertexts = encrypt_many_async(crypter, ['one'], binary=True).get()
+        self.assertEqual(
+            decrypt_many_async(crypter, ciphertexts, binary=True).get(),
+            ['one'])
+
+    def test_field(self):
+        field = TestModel._meta.get_field('prefix_char')
+        ciphertext = field.encrypt_async('secret').get()
+        self.assertTrue(ciphertext.startswith('ENCRYPTED:::'))
+        self.assertEqual(field.decrypt_async(ciphertext).get(), 'secret')
+
+        done = threading.Event()
+        results = []
+
+        def callback(values):
+            results.append((values, threading.current_thread()))
+            done.set()
+
+        ciphertexts = field.encrypt_many_async(['one', None]).get()
+        field.decrypt_many_async(ciphertexts, callback=callback)
+        done.wait(5)
+        self.assertEqual(results[0][0], ['one', None])
+        self.assertNotEqual(results[0][1], threading.current_thread())
+
+    def test_queryset(self):
+        for i in range(3):
+            TestModel.objects.create(char='char %d' % i, integer=i)
+
+        with CaptureQueriesContext(connection) as queries:
+            result = TestModel.objects.order_by('id').decrypt_async()
+        self.assertEqual(len(queries), 1)
+        objs = result.get()
+        self.assertEqual([obj.char for obj in objs],
+                         ['char %d' % i for i in range(3)])
+        self.assertEqual(objs[0].get_deferred_fields(), set())
+
+        objs = TestModel.objects.only('id', 'integer').decrypt_async().get()
+        self.assertEqual(len(objs), 3)
+
+    @override_settings(
+        ENCRYPTED_FIELDS_EXECUTOR='encrypted_fields.tests.make_test_executor')
+    def test_executor_setting(self):
+        executor.set_executor(None)
+        pool = executor.get_executor()
+        self.addCleanup(pool.terminate)
+        self.assertEqual(pool._processes, 1)
+        self.assertTrue(executor.get_executor() is pool)
+
+
+class DataKeyRouter(object):
+    def db_for_read(self, model, **hints):
+        return 'other' if model is DataKey else None
+
+    db_for_write = db_for_read
+
+
+class EnvelopeEncryptionTest(DbValueMixin, TestCase):
+    multi_db = True
+
+    def setUp(self):
+        data_key_cache.clear()
+        self.field = TestModel._meta.get_field('envelope_text')
+
+    def count_unwraps(self, crypter):
+        unwraps = []
+        unwrap = crypter.unwrap
+
+        def counting_unwrap(wrapped_key):
+            unwraps.append(wrapped_key)
+            return unwrap(wrapped_key)
+        crypter.unwrap = counting_unwrap
+        self.addCleanup(delattr, crypter, 'unwrap')
+        return unwraps
+
+    def test_round_trip(self):
+        with tenant('acme'):
+            obj = TestModel.objects.create(envelope_text=u'secret \xe9')
+        self.assertEqual(
+            list(DataKey.objects.values_list('keyname', 'tenant')),
+            [('testkey', 'acme')]
+        )
+
+        stored = self.get_db_value('envelope_text', obj.id)
+        self.assertEqual(util.Base64WSDecode(stored)[:1], ENVELOPE_FORMAT)
+        self.assertEqual(
+            len(stored), self.field.ciphertext_length(len('secret \\xe9')))
+        self.assertEqual(
+            TestModel.objects.get(id=obj.id).envelope_text, u'secret \xe9')
+
+    def test_key_per_tenant(self):
+        crypter = self.field.crypter()
+        values = {}
+        for name in ('acme', 'initech', 'acme', ''):
+            with tenant(name):
+                values.setdefault(name, []).append(crypter.encrypt(name))
+        self.assertEqual(
+            sorted(DataKey.objects.values_list('tenant', flat=True)),
+            ['', 'acme', 'initech']
+        )
+        for name, ciphertexts in values.items():
+            self.assertEqual(crypter.decrypt_many(ciphertexts),
+                             [name] * len(ciphertexts))
+        acme = values['acme'][0]
+        self.assertEqual(util.Base64WSDecode(acme)[:9],
+                         util.Base64WSDecode(values['acme'][1])[:9])
+        self.assertNotEqual(util.Base64WSDecode(acme)[:9],
+                            util.Base64WSDecode(values['initech'][0])[:9])
+
+    def test_bulk_read_unwraps_once(self):
+        with tenant('acme'):
+            for i in range(5):
+                TestModel.objects.create(envelope_text='text %d' % i)
+        data_key_cache.clear()
+        unwraps = self.count_unwraps(self.field.crypter())
+
+        with CaptureQueriesContext(connection) as queries:
+            objs = list(TestModel.objects.order_by('id').decrypting_iterator())
+        self.assertEqual([obj.envelope_text for obj in objs],
+                         ['text %d' % i for i in range(5)])
+        self.assertEqual(len(unwraps), 1)
+        self.assertEqual(len(queries), 2)
+
+        list(TestModel.objects.all())
+        self.assertEqual(len(unwraps), 1)
+
+    @override_settings(
+        DATABASE_ROUTERS=['encrypted_fields.tests.DataKeyRouter'])
+    def test_data_keys_follow_the_router(self):
+        obj = TestModel.objects.create(envelope_text='secret')
+        self.assertFalse(DataKey.objects.using('default').exists())
+        self.assertEqual(
+            list(DataKey.objects.using('other').values_list('tenant')),
+            [('',)]
+        )
+        data_key_cache.clear()
+        self.assertEqual(
+            TestModel.objects.get(id=obj.id).envelope_text, 'secret')
+
+    def test_missing_data_key(self):
+        obj = TestModel.objects.create(envelope_text='secret')
+        stored = self.get_db_value('envelope_text', obj.id)
+        DataKey.objects.all().delete()
+        data_key_cache.clear()
+        self.assertEqual(self.field.to_python(stored), stored)
+
+    def test_reads_keyczar_values(self):
+        ciphertext = KeyczarWrapper(self.field.keydir).encrypt('legacy')
+        self.assertEqual(self.field.to_python(ciphertext), 'legacy')
+        crypter = self.field.crypter()
+        self.assertFalse(crypter.encrypted_with_primary(ciphertext))
+        self.assertTrue(
+            crypter.encrypted_with_primary(crypter.encrypt('new')))
+
+
+class RewrapDataKeysTest(DbValueMixin, TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.keydir = os.path.join(self.tmpdir, 'master')
+        shutil.copytree(settings.ENCRYPTED_FIELDS_KEYDIR, self.keydir)
+        self.field = TestModel._meta.get_field('envelope_text')
+        self.field.keydir = self.keydir
+
+    def tearDown(self):
+        self.field.keydir = settings.ENCRYPTED_FIELDS_KEYDIR
+        crypters.invalidate(keydir=self.keydir)
+        shutil.rmtree(self.tmpdir)
+
+    def test_rewrap(self):
+        obj = TestModel.objects.create(envelope_text='secret')
+        stored = self.get_db_value('envelope_text', obj.id)
+        wrapped_key = DataKey.objects.get(keyname='master').wrapped_key
+
+        keyczart.main(
+            ['addkey', '--location=' + self.keydir, '--status=primary'])
+        out = six.StringIO()
+        call_command('rewrap_data_keys', 'encrypted_fields.TestModel',
+                     stdout=out)
+        self.assertEqual(out.getvalue(), 'master: 1 data keys rewrapped\n')
+
+        row = DataKey.objects.get(keyname='master')
+        self.assertNotEqual(row.wrapped_key, wrapped_key)
+        crypter = self.field.crypter()
+        self.assertTrue(crypter.master.encrypted_with_primary(row.wrapped_key))
+        self.assertEqual(TestModel.objects.get(id=obj.id).envelope_text,
+                         'secret')
+        self.assertEqual(self.field.get_prep_value('x')[:12], stored[:12])
+        self.assertEqual(crypter.rewrap_data_keys(), 0)
+
+    def test_master_keysets_with_the_same_name(self):
+        crypter = self.field.crypter()
+        ciphertext = crypter.encrypt('secret')
+
+        # Another keyset in a directory also called 'master'.
+        keydir = os.path.join(self.tmpdir, 'eu', 'master')
+        os.makedirs(keydir)
+        keyczart.main(
+            ['create', '--location=' + keydir, '--purpose=crypt'])
+        keyczart.main(['addkey', '--location=' + keydir, '--status=primary'])
+        other = EnvelopeWrapper(keydir)
+        other_ciphertext = other.encrypt('other secret')
+
+        self.assertEqual(DataKey.objects.filter(keyname='master').count(), 2)
+        self.assertEqual(other.decrypt(other_ciphertext), 'other secret')
+        self.assertEqual(crypter.decrypt(ciphertext), 'secret')
+        self.assertEqual(other.rewrap_data_keys(), 0)
+
+
+class SerializerTest(DbValueMixin, TestCase):
+    def decrypt_raw(self, field_name, model_id):
+        field = TestModel._meta.get_field(field_name)
+        return field.crypter().decrypt(
+            self.get_db_value(field_name, model_id))
+
+    def test_round_trip(self):
+        values = [
+            (serializers.TEXT, u'Oh hi, test reader! \U0001f431'),
+            (serializers.TEXT, u''),
+            (serializers.INTEGER, -2 ** 62),
+            (serializers.INTEGER, 42),
+            (serializers.FLOAT, 0.1 + 0.2),
+            (serializers.BOOLEAN, True),
+            (serializers.BOOLEAN, False),
+            (serializers.DATE, datetime.date(1, 1, 1)),
+            (serializers.DATE, datetime.date(2016, 2, 29)),
+            (serializers.NAIVE_DATETIME,
+             datetime.datetime(1969, 12, 31, 23, 59, 59, 999999)),
+            (serializers.AWARE_DATETIME,
+             datetime.datetime(2016, 2, 29, 1, 2, 3, 4, timezone.utc)),
+        ]
+        for serializer, value in values:
+            data = serializer.dumps(value)
+            self.assertEqual(data[:1], serializer.tag)
+            self.assertEqual(serializers.loads(data), value)
+            self.assertEqual(type(serializers.loads(data)), type(value))
+
+    def test_fallback(self):
+        self.assertEqual(serializers.INTEGER.dumps(2 ** 64), None)
+        self.assertEqual(serializers.INTEGER.dumps(True), None)
+        self.assertEqual(serializers.TEXT.dumps('\xff'), None)
+        self.assertEqual(
+            serializers.dumps(2 ** 64, [serializers.INTEGER]), str(2 ** 64))
+        self.assertEqual(serializers.dumps(u'\xe9'), '\\xe9')
+
+    def test_fields(self):
+        model = TestModel.objects.create(
+            char=u'caf\xe9',
+            integer=42,
+            floating=0.1 + 0.2,
+            boolean=True,
+            date=datetime.date(2016, 2, 29),
+            datetime=datetime.datetime(2016, 2, 29, 1, 2, 3, 4),
+        )
+        self.assertEqual(self.decrypt_raw('char', model.id), '\x90caf\xc3\xa9')
+        self.assertEqual(len(self.decrypt_raw('integer', model.id)), 9)
+
+        fresh_model = TestModel.objects.get(id=model.id)
+        for name in ('char', 'integer', 'floating', 'boolean', 'date',
+                     'datetime'):
+            self.assertEqual(getattr(fresh_model, name), getattr(model, name))
+
+    def test_reads_legacy_values(self):
+        model = TestModel.objects.create()
+        crypter = TestModel._meta.get_field('char').crypter()
+        legacy = {
+            'char': ('caf\\xe9', u'caf\xe9'),
+            'integer': ('42', 42),
+            'floating': ('0.3', 0.3),
+            'boolean': ('True', True),
+            'date': ('2016-02-29', datetime.date(2016, 2, 29)),
+            'datetime': ('2016-02-29 01:02:03',
+                         datetime.datetime(2016, 2, 29, 1, 2, 3)),
+        }
+        TestModel.objects.filter(id=model.id).update(**dict(
+            (name, models.Value(
+                crypter.encrypt(stored), output_field=models.TextField()))
+            for name, (stored, value) in legacy.items()
+        ))
+
+        fresh_model = TestModel.objects.get(id=model.id)
+        for name, (stored, value) in legacy.items():
+            self.assertEqual(getattr(fresh_model, name), value)
+
+    def test_blind_index_unchanged(self):
+        field = TestModel._meta.get_field('indexed_email')
+        hasher = crypters.get(KeyczarHmacWrapper, field.blind_index_keydir)
+        self.assertEqual(
+            field.blind_index_value(u'caf\xe9@example.com'),
+            hasher.digest('caf\\xe9@example.com')
+        )
+
+
+class DeterministicEncryptionTest(TestCase):
+    def get_db_values(self, model_id):
+        cursor = connection.cursor()
+        cursor.execute(
+            'select email, char, binary_char '
+            'from encrypted_fields_deterministicmodel '
+            'where id = {0};'.format(model_id)
+        )
+        return cursor.fetchone()
+
+    def test_equal_values_equal_ciphertexts(self):
+        one = DeterministicModel.objects.create(
+            email='one@example.com', char='same', binary_char='same')
+        two = DeterministicModel.objects.create(
+            email='two@example.com', char='same', binary_char='same')
+
+        one_values = self.get_db_values(one.id)
+        two_values = self.get_db_values(two.id)
+        self.assertNotEqual(one_values[0], two_values[0])
+        self.assertEqual(one_values[1:], two_values[1:])
+        self.assertTrue('same' not in one_values[1])
+        self.assertEqual(
+            len(one_values[1]),
+            DeterministicModel._meta.get_field('char').ciphertext_length(5)
+        )
+
+        fresh = DeterministicModel.objects.get(id=one.id)
+        self.assertEqual(
+            (fresh.email, fresh.char, fresh.binary_char),
+            ('one@example.com', 'same', 'same')
+        )
+
+    def test_lookups(self):
+        for i in range(3):
+            DeterministicModel.objects.create(
+                email='user%d@example.com' % i, char='group %d' % (i % 2),
+                binary_char='group %d' % (i % 2))
+        objects = DeterministicModel.objects
+
+        self.assertEqual(
+            objects.get(email='user1@example.com').char, 'group 1')
+        self.assertEqual(objects.filter(char='group 0').count(), 2)
+        self.assertEqual(objects.filter(binary_char='group 0').count(), 2)
+        self.assertEqual(
+            objects.filter(char__in=['group 1', 'other', None]).count(), 1)
+        self.assertEqual(objects.filter(char__in=[]).count(), 0)
+        self.assertEqual(objects.filter(char=None).count(), 0)
+        self.assertEqual(
+            objects.values_list('char', flat=True).distinct().count(), 2)
+
+        obj, created = objects.get_or_create(email='user2@example.com')
+        self.assertFalse(created)
+        self.assertEqual(obj.char, 'group 0')
+
+    def test_unique(self):
+        DeterministicModel.objects.create(email='one@example.com')
+        with self.assertRaises(ValidationError):
+            DeterministicModel(email='one@example.com').validate_unique()
+        with self.assertRaises(IntegrityError):
+            DeterministicModel.objects.create(email='one@example.com')
+
+    def test_rotation(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        keydir = os.path.join(tmpdir, 'keys')
+        shutil.copytree(settings.ENCRYPTED_FIELDS_DETERMINISTIC_KEYDIR, keydir)
+
+        old = DeterministicWrapper(keydir)
+        ciphertext = old.encrypt('value')
+        keyczart.main(['addkey', '--location=' + keydir, '--status=primary'])
+        new = DeterministicWrapper(keydir)
+
+        self.assertNotEqual(new.encrypt('value'), ciphertext)
+        self.assertEqual(new.decrypt(ciphertext), 'value')
+        self.assertFalse(new.encrypted_with_primary(ciphertext))
+        self.assertTrue(new.encrypted_with_primary(new.encrypt('value')))
+        self.assertTrue(
+            util.Base64WSDecode(ciphertext) in
+            new.encrypt_raw_all_versions('value')
+        )
+
+    def test_authenticated(self):
+        crypter = DeterministicModel._meta.get_field('char').crypter()
+        data = util.Base64WSDecode(crypter.encrypt('value'))
+        tampered = data[:-1] + chr(ord(data[-1]) ^ 1)
+        self.assertRaises(
+            keyczar.errors.InvalidSignatureError,
+            crypter.decrypt, util.Base64WSEncode(tampered)
+        )
+
+    def test_reads_keyczar_values(self):
+        field = DeterministicModel._meta.get_field('char')
+        ciphertext = KeyczarWrapper(field.keydir).encrypt('legacy')
+        self.assertEqual(field.to_python(ciphertext), 'legacy')
+
+    def test_text_fields_only(self):
+        self.assertRaises(
+            ImproperlyConfigured, EncryptedIntegerField, deterministic=True)
+
+
+class RangeIndexTest(TestCase):
+    def setUp(self):
+        self.days = [
+            RangeModel.objects.create(
+                day=datetime.date(2016, month, 10),
+                amount=month * 50,
+            )
+            for month in (1, 2, 3, 4)
+        ]
+        self.empty = RangeModel.objects.create()
+
+    def test_index_maintained_on_save(self):
+        one, two = self.days[:2]
+        fresh = RangeModel.objects.values_list(
+            'day_range_index', 'amount_range_index').get(id=one.id)
+        self.assertTrue(all(fresh))
+        self.assertTrue('2016' not in fresh[0])
+
+        two.day = datetime.date(2016, 1, 20)
+        two.amount = 90
+        two.save()
+        self.assertEqual(
+            RangeModel.objects.values_list(
+                'day_range_index', 'amount_range_index').get(id=two.id),
+            fresh
+        )
+        self.assertEqual(
+            RangeModel.objects.values_list(
+                'day_range_index', 'amount_range_index'
+            ).get(id=self.empty.id),
+            (None, None)
+        )
+
+    def test_in_range_prunes_to_buckets(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(
+                RangeModel.objects.in_range(amount__gt=20000), [])
+            found = RangeModel.objects.in_range(
+                day__gte=datetime.date(2016, 2, 20))
+        self.assertEqual(found, self.days[2:])
+        # Nothing to look for past the bounds; otherwise only the buckets
+        # the range covers are read, so February 10th is a candidate.
+        self.assertEqual(len(queries), 1)
+        self.assertTrue('"day_range_index" IN' in queries[0]['sql'])
+
+    def test_in_range_filters_exactly(self):
+        objects = RangeModel.objects
+        self.assertEqual(
+            objects.in_range(day__gte=datetime.date(2016, 2, 20)),
+            self.days[2:]
+        )
+        self.assertEqual(
+            objects.in_range(
+                day__range=(datetime.date(2016, 2, 10),
+                            datetime.date(2016, 3, 9)),
+                amount__lte=150,
+            ),
+            self.days[1:2]
+        )
+        self.assertEqual(objects.in_range(amount__gt=150), self.days[3:])
+        self.assertEqual(
+            objects.order_by('-id').in_range(amount__lt=150),
+            self.days[1::-1]
+        )
+        self.assertRaises(ValueError, objects.in_range, amount=100)
+
+    def test_range_needs_bounds(self):
+        self.assertRaises(ValueError, buckets.buckets, None, 10, 100)
+        self.assertRaises(ValueError, buckets.buckets, 0, 10 ** 9, 100)
+
+        # Lookups are clamped to the field's bounds.
+        field = RangeModel._meta.get_field('amount')
+        self.assertEqual(len(field.range_index_digests(-50, 250)), 3)
+        self.assertEqual(len(field.range_index_digests(None, 10 ** 9)), 100)
+
+        # So values outside them could not be found and are refused.
+        self.assertRaises(ValueError, RangeModel.objects.create, amount=10000)
+        self.assertRaises(
+            ValueError, RangeModel.objects.create,
+            day=datetime.date(1999, 12, 31))
+
+    def test_direct_lookups_refused(self):
+        # They could only match whole buckets, a superset of the rows.
+        objects = RangeModel.objects
+        day = datetime.date(2016, 2, 20)
+        self.assertRaises(ValueError, objects.filter, day__gte=day)
+        self.assertRaises(ValueError, objects.exclude, amount__lt=99)
+        self.assertRaises(
+            ValueError, objects.filter,
+            models.Q(amount__lt=99) | models.Q(amount__gt=150))
+        self.assertRaises(
+            ValueError, objects.filter, amount__range=(100, 200))
+
+    def test_numbers_and_dates_only(self):
+        self.assertRaises(
+            ImproperlyConfigured, EncryptedCharField, range_index=10)
+        self.assertRaises(
+            ImproperlyConfigured, EncryptedIntegerField, range_index='month')
+        self.assertRaises(
+            ImproperlyConfigured, EncryptedDateField, range_index=10)
+
+
+class EncryptedStorageTest(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.inner = FileSystemStorage(location=self.tmpdir)
+        self.storage = EncryptedStorage(storage=self.inner, chunk_size=64)
+        self.data = b''.join(chr(i % 251) for i in range(1000))
+
+    def save(self, data, storage=None):
+        return (storage or self.storage).save('doc.bin', ContentFile(data))
+
+    def stored(self, name):
+        with open(self.inner.path(name), 'rb') as stored:
+            return stored.read()
+
+    def test_roundtrip(self):
+        for data in (self.data, self.data[:128], b'', b'x'):
+            name = self.save(data)
+            stored = self.stored(name)
+            self.assertFalse(len(data) > 16 and data[:16] in stored)
+            self.assertEqual(
+                len(stored),
+                encrypted_size(self.storage.crypter(), len(data), 64)
+            )
+            self.assertEqual(self.storage.size(name), len(data))
+            with self.storage.open(name) as decrypted:
+                self.assertEqual(decrypted.read(), data)
+                self.assertEqual(b''.join(decrypted.chunks(100)), data)
+
+    def test_seek_and_ranged_reads(self):
+        name = self.save(self.data)
+        decrypted = self.storage.open(name)
+        self.addCleanup(decrypted.close)
+
+        decrypted.seek(500)
+        self.assertEqual(decrypted.read(10), self.data[500:510])
+        self.assertEqual(decrypted.tell(), 510)
+        decrypted.seek(-70, os.SEEK_END)
+        self.assertEqual(decrypted.read(), self.data[-70:])
+        self.assertEqual(decrypted.read(), b'')
+        decrypted.seek(2000)
+        self.assertEqual(decrypted.read(10), b'')
+
+        # A ranged read only decrypts the chunks it covers.
+        calls = []
+        crypter = decrypted.crypter
+        decrypt = crypter.decrypt_raw_many
+        self.addCleanup(setattr, crypter, 'decrypt_raw_many', decrypt)
+        crypter.decrypt_raw_many = (
+            lambda ciphertexts: calls.append(1) or decrypt(ciphertexts))
+        decrypted.seek(130)
+        self.assertEqual(decrypted.read(60), self.data[130:190])
+        self.assertEqual(len(calls), 1)
+
+    def test_tampering_detected(self):
+        name = self.save(self.data)
+        stored = self.stored(name)
+        sealed = encrypted_size(self.storage.crypter(), 64, 64) - (
+            FILE_HEADER.size)
+
+        def reads(content):
+            with open(self.inner.path(name), 'wb') as tampered:
+                tampered.write(content)
+            with self.storage.open(name) as decrypted:
+                return decrypted.read()
+
+        head = stored[:FILE_HEADER.size]
+        chunks = [
+            stored[i:i + sealed]
+            for i in range(FILE_HEADER.size, len(stored), sealed)
+        ]
+        swapped = head + chunks[1] + chunks[0] + ''.join(chunks[2:])
+        truncated = head + ''.join(chunks[:-1])
+        flipped = stored[:-1] + chr(ord(stored[-1]) ^ 1)
+        # A chunk size the header claims is only trusted once the chunks
+        # confirm it, even where it gives the same sealed chunk size.
+        fmt, chunk_size, sealed_size, file_id = FILE_HEADER.unpack(head)
+        self.assertEqual(
+            sealed_chunk_size(self.storage.crypter(), 66), sealed_size)
+        resized = [
+            FILE_HEADER.pack(fmt, size, sealed_size, file_id) +
+            ''.join(chunks)
+            for size in (0, 32, 60, 66)
+        ]
+        for content in [swapped, truncated, flipped] + resized:
+            self.assertRaises(
+                (EncryptedFieldException, keyczar.errors.KeyczarError),
+                reads, content
+            )
+        self.assertEqual(reads(stored), self.data)
+
+    @unittest.skipIf(
+        AESGCM is None, "The cryptography package is not installed")
+    def test_crypter_klass(self):
+        storage = EncryptedStorage(
+            storage=self.inner, crypter_klass=AESGCMWrapper, chunk_size=100)
+        name = self.save(self.data, storage)
+        self.assertEqual(self.stored(name)[FILE_HEADER.size], '\x01')
+        with storage.open(name) as decrypted:
+            self.assertEqual(decrypted.read(), self.data)
+
+    def test_read_only(self):
+        name = self.save(self.data)
+        self.assertRaises(ValueError, self.storage.open, name, 'wb')
+        self.assertRaises(NotImplementedError, self.storage.url, name)
+
+    def test_file_field(self):
+        with override_settings(MEDIA_ROOT=self.tmpdir):
+            obj = DocumentModel()
+            obj.document.save('scan.pdf', ContentFile(self.data))
+            obj = DocumentModel.objects.get(id=obj.id)
+
+            self.assertTrue(obj.document.name.startswith('documents/'))
+            self.assertEqual(obj.document.size, len(self.data))
+            obj.document.open()
+            self.assertEqual(obj.document.read(), self.data)
+            obj.document.close()
+            with open(self.inner.path(obj.document.name), 'rb') as stored:
+                self.assertFalse(self.data[:100] in stored.read())
+
+        name, path, args, kwargs = (
+            DocumentModel._meta.get_field('document').deconstruct())
+        self.assertFalse('storage' in kwargs)
+
+
+class RawCiphertextTest(DbValueMixin, TestCase):
+    multi_db = True
+
+    columns = [
+        'char', 'prefix_char', 'integer', 'date', 'lazy_text',
+        'indexed_email', 'indexed_email_blind_index', 'binary_text',
+        'envelope_text',
+    ]
+
+    def setUp(self):
+        self.model = TestModel.objects.create(
+            char='Oh hi, test reader!',
+            prefix_char='prefixed',
+            integer=42,
+            date=datetime.date(2016, 2, 29),
+            lazy_text='lazy',
+            indexed_email='aron@example.com',
+            binary_text='binary',
+            envelope_text='envelope',
+        )
+        self.stored = self.get_db_values(self.model.id)
+        self.events = []
+        observe(self.events.append)
+        self.addCleanup(unobserve, self.events.append)
+
+    def get_db_values(self, model_id):
+        return [self.get_db_value(c, model_id) for c in self.columns]
+
+    def assert_copied(self, using='default'):
+        obj = TestModel.objects.using(using).get(
+            indexed_email='aron@example.com')
+        self.assertEqual(obj.id, self.model.id)
+        self.assertEqual(
+            (obj.char, obj.integer, obj.lazy_text, obj.binary_text),
+            ('Oh hi, test reader!', 42, 'lazy', 'binary')
+        )
+
+    def test_serializers(self):
+        with raw_ciphertext():
+            data = django_serializers.serialize(
+                'json', TestModel.objects.all())
+        self.assertEqual(self.events, [])
+        self.assertTrue(self.stored[0] in data)
+        self.assertFalse('Oh hi' in data)
+
+        TestModel.objects.all().delete()
+        with raw_ciphertext():
+            for obj in django_serializers.deserialize('json', data):
+                obj.save()
+        self.assertEqual(self.events, [])
+        self.assertEqual(self.get_db_values(self.model.id), self.stored)
+        self.assert_copied()
+
+    def test_commands(self):
+        fixture = os.path.join(tempfile.mkdtemp(), 'raw.json')
+        self.addCleanup(shutil.rmtree, os.path.dirname(fixture))
+        call_command(
+            'dumpdata_raw', 'encrypted_fields.TestModel', output=fixture)
+        TestModel.objects.all().delete()
+        call_command('loaddata_raw', fixture, verbosity=0)
+
+        self.assertEqual(self.events, [])
+        self.assertEqual(self.get_db_values(self.model.id), self.stored)
+
+    def test_copy_rows(self):
+        for i in range(4):
+            TestModel.objects.create(char='char %d' % i)
+        del self.events[:]
+        copied = copy_rows(TestModel.objects.all(), 'other', batch_size=2)
+
+        self.assertEqual(copied, 5)
+        self.assertEqual(self.events, [])
+        self.assertEqual(TestModel.objects.using('other').count(), 5)
+        self.assert_copied('other')
+
+    def test_cleartext_not_written(self):
+        self.assertFalse(any(c in (None, '') for c in self.stored))
+        with raw_ciphertext():
+            obj = TestModel.objects.get(id=self.model.id)
+            self.assertEqual(obj.char, self.stored[0])
+            obj.save()
+            for name, value in (('char', 'changed'), ('integer', 7)):
+                changed = TestModel.objects.get(id=self.model.id)
+                setattr(changed, name, value)
+                with self.assertRaises(EncryptedFieldException):
+                    with transaction.atomic():
+                        changed.save()
+        self.assertEqual(self.get_db_values(self.model.id), self.stored)
+
+        # Values loaded in the block are still known to be ciphertext.
+        obj.save()
+        self.assertEqual(self.get_db_values(self.model.id), self.stored)
+
+    def test_plain_fixture_refused(self):
+        plain = TestModel.objects.create(char='plain secret')
+        fixture = os.path.join(tempfile.mkdtemp(), 'plain.json')
+        self.addCleanup(shutil.rmtree, os.path.dirname(fixture))
+        call_command(
+            'dumpdata', 'encrypted_fields.TestModel', output=fixture)
+        TestModel.objects.filter(id=plain.id).delete()
+
+        with self.assertRaises(EncryptedFieldException):
+            call_command('loaddata_raw', fixture, verbosity=0)
+        self.assertFalse(TestModel.objects.filter(id=plain.id).exists())
+
+    def test_update_refuses_cleartext(self):
+        with raw_ciphertext():
+            with self.assertRaises(EncryptedFieldException):
+                with transaction.atomic():
+                    TestModel.objects.filter(id=self.model.id).update(
+                        char='plain via update')
+            # Stored values can still be copied from row to row.
+            TestModel.objects.filter(id=self.model.id).update(
+                char=self.stored[0], prefix_char='')
+        self.assertEqual(
+            self.get_db_value('char', self.model.id), self.stored[0])
+
+
+class EncryptedJSONFieldTest(TestCase):
+    document = {
+        'status': 'sent',
+        'patient': {'name': 'Aron', 'ssn': '123-45-6789'},
+        'contacts': [
+            {'kind': 'home', 'phone': '555-0100'},
+            {'kind': 'work', 'phone': 5550199},
+            {'kind': 'none'},
+        ],
+    }
+
+    def setUp(self):
+        self.events = []
+        observe(self.events.append)
+        self.addCleanup(unobserve, self.events.append)
+
+    def get_stored(self, model_id):
+        cursor = connection.cursor()
+        cursor.execute(
+            'select document from encrypted_fields_jsonmodel '
+            'where id = %s', [model_id])
+        return json.loads(cursor.fetchone()[0])
+
+    def test_only_paths_encrypted(self):
+        obj = JSONModel.objects.create(document=self.document)
+        stored = self.get_stored(obj.id)
+
+        self.assertEqual(stored['status'], 'sent')
+        self.assertEqual(stored['patient']['name'], 'Aron')
+        self.assertEqual(stored['contacts'][2], {'kind': 'none'})
+        field = JSONModel._meta.get_field('document')
+        for value in (
+            stored['patient']['ssn'],
+            stored['contacts'][0]['phone'],
+            stored['contacts'][1]['phone'],
+        ):
+            self.assertTrue(field.looks_encrypted(value))
+        self.assertFalse('555' in json.dumps(stored))
+
+        self.assertEqual(
+            JSONModel.objects.get(id=obj.id).document, self.document)
+        self.assertEqual(
+            [(e.operation, e.values) for e in self.events],
+            [('encrypt', 3), ('decrypt', 3)]
+        )
+
+    def test_database_json_functions(self):
+        sent = JSONModel.objects.create(document=self.document)
+        JSONModel.objects.create(document={'status': 'new'})
+        JSONModel.objects.create()
+
+        queryset = JSONModel.objects.annotate(
+            status=JSONKeyText('document', 'status')
+        ).filter(status='sent')
+        self.assertEqual(list(queryset), [sent])
+        self.assertEqual(
+            JSONModel.objects.annotate(
+                name=JSONKeyText('document', 'patient.name')
+            ).get(id=sent.id).name,
+            'Aron'
+        )
+
+    def test_changes_in_place_saved(self):
+        obj = JSONModel.objects.create(document=self.document)
+        stored = self.get_stored(obj.id)
+
+        obj = JSONModel.objects.get(id=obj.id)
+        obj.save()
+        self.assertEqual(self.get_stored(obj.id), stored)
+
+        obj.document['contacts'][0]['phone'] = '555-0111'
+        obj.save()
+        self.assertNotEqual(self.get_stored(obj.id), stored)
+        self.assertEqual(
+            JSONModel.objects.get(id=obj.id).document['contacts'][0]['phone'],
+            '555-0111'
+        )
+        self.assertEqual(self.document['contacts'][0]['phone'], '555-0100')
+
+    def test_lazy(self):
+        obj = JSONModel.objects.create(lazy_document={'secret': [1, 2]})
+        del self.events[:]
+        obj = JSONModel.objects.get(id=obj.id)
+        obj.save()
+        # Only the decryption of the document on access.
+        self.assertEqual(len(self.events), 1)
+        self.assertEqual(self.events[0].operation, 'decrypt')
+
+        obj = JSONModel.objects.get(id=obj.id)
+        obj.lazy_document['secret'].append(3)
+        obj.save()
+        self.assertEqual(
+            JSONModel.objects.get(id=obj.id).lazy_document,
+            {'secret': [1, 2, 3]}
+        )
+
+    def test_bulk_decrypt(self):
+        for i in range(3):
+            JSONModel.objects.create(document={'patient': {'ssn': i}})
+        del self.events[:]
+
+        documents = [
+            obj.document
+            for obj in JSONModel.objects.order_by('id').decrypting_iterator()
+        ]
+        self.assertEqual(
+            documents, [{'patient': {'ssn': i}} for i in range(3)])
+        self.assertEqual(
+            [(e.operation, e.values) for e in self.events], [('decrypt', 3)])
+
+    def test_commands(self):
+        obj = JSONModel.objects.create(document=self.document)
+        stored = self.get_stored(obj.id)
+        self.assertEqual(JSONModel.objects.unencrypted().count(), 0)
+        self.assertEqual(JSONModel.objects.encrypted().count(), 1)
+
+        call_command(
+            'encrypt_fields', 'encrypted_fields.JSONModel', verbosity=0)
+        self.assertEqual(self.get_stored(obj.id), stored)
+        self.assertEqual(
+            JSONModel.objects.get(id=obj.id).document, self.document)
+
+    def test_reencrypt_after_rotation(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        keydir = os.path.join(tmpdir, 'keys')
+        shutil.copytree(settings.ENCRYPTED_FIELDS_KEYDIR, keydir)
+        field = JSONModel._meta.get_field('document')
+        field.keydir = keydir
+        self.addCleanup(setattr, field, 'keydir',
+                        settings.ENCRYPTED_FIELDS_KEYDIR)
+        self.addCleanup(crypters.invalidate, keydir=keydir)
+
+        obj = JSONModel.objects.create(document=self.document)
+        empty = JSONModel.objects.create(document={'status': 'draft'})
+        before = self.get_stored(obj.id)
+
+        keyczart.main(['addkey', '--location=' + keydir, '--status=primary'])
+        out = six.StringIO()
+        call_command(
+            'reencrypt_fields', 'encrypted_fields.JSONModel', stdout=out)
+        self.assertTrue('0 unreadable' in out.getvalue())
+
+        after = self.get_stored(obj.id)
+        crypter = field.crypter()
+        self.assertNotEqual(after['patient']['ssn'], before['patient']['ssn'])
+        self.assertTrue(
+            crypter.encrypted_with_primary(after['patient']['ssn']))
+        self.assertTrue(crypter.encrypted_with_primary(
+            after['contacts'][1]['phone']))
+        self.assertEqual(after['status'], before['status'])
+        self.assertEqual(
+            JSONModel.objects.get(id=obj.id).document, self.document)
+        self.assertEqual(self.get_stored(empty.id), {'status': 'draft'})
+
+    def test_configuration(self):
+        self.assertRaises(ImproperlyConfigured, EncryptedJSONField)
+        self.assertRaises(
+            ImproperlyConfigured, EncryptedJSONField,
+            encrypted_paths=['a.*', 'a.b.c'])
+        self.assertRaises(
+            ImproperlyConfigured, EncryptedJSONField,
+            encrypted_paths=['a'], binary=True)
+
+    def test_deconstruct(self):
+        name, path, args, kwargs = (
+            JSONModel._meta.get_field('document').deconstruct())
+        self.assertEqual(path, 'encrypted_fields.fields.EncryptedJSONField')
+        self.assertEqual(
+            kwargs['encrypted_paths'], ['patient.ssn', 'contacts.*.phone'])
+        kwargs = JSONModel._meta.get_field('lazy_document').deconstruct()[3]
+        self.assertEqual(kwargs['encrypted_paths'], ['secret'])
+
+
+class KeySourceTest(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.keydir = os.path.join(self.tmpdir, 'packedkey')
+        shutil.copytree(settings.ENCRYPTED_FIELDS_KEYDIR, self.keydir)
+        self.keystore = os.path.join(self.tmpdir, 'keystore.json')
+        call_command(
+            'pack_keys', self.keystore, self.keydir,
+            settings.ENCRYPTED_FIELDS_BLIND_INDEX_KEYDIR, verbosity=0
+        )
+
+    def tearDown(self):
+        set_key_source(None)
+        crypters.invalidate()
+        os.environ.pop('ENCRYPTED_FIELDS_KEYSTORE', None)
+        shutil.rmtree(self.tmpdir)
+
+    def test_packed_keystore(self):
+        self.assertEqual(os.stat(self.keystore).st_mode & 0o777, 0o600)
+        ciphertext = KeyczarWrapper(self.keydir).encrypt('Oh hi, test reader!')
+
+        # Only the keystore is read from now on.
+        set_key_source(PackedKeySource(self.keystore))
+        shutil.rmtree(self.keydir)
+        crypter = KeyczarWrapper(self.keydir)
+        self.assertEqual(crypter.decrypt(ciphertext), 'Oh hi, test reader!')
+
+        # Keysets not in the keystore are still read from their directory.
+        KeyczarWrapper(settings.ENCRYPTED_FIELDS_KEYDIR)
+
+    def test_keysets_with_the_same_name(self):
+        other = os.path.join(self.tmpdir, 'other', 'packedkey')
+        os.makedirs(other)
+        keyczart.main(['create', '--location=' + other, '--purpose=crypt'])
+        keyczart.main(['addkey', '--location=' + other, '--status=primary'])
+        call_command(
+            'pack_keys', self.keystore, self.keydir, other, verbosity=0)
+        headers = KeyczarWrapper(self.keydir).headers
+        other_headers = KeyczarWrapper(other).headers
+
+        set_key_source(PackedKeySource(self.keystore))
+        self.assertEqual(KeyczarWrapper(self.keydir).headers, headers)
+        self.assertEqual(KeyczarWrapper(other).headers, other_headers)
+
+        # Another directory of that name is not served either keyset.
+        elsewhere = os.path.join(self.tmpdir, 'elsewhere', 'packedkey')
+        shutil.copytree(self.keydir, elsewhere)
+        self.assertRaises(
+            keyczar.errors.KeyczarError, KeyczarWrapper, elsewhere)
+
+        self.assertRaises(
+            CommandError, call_command, 'pack_keys', self.keystore,
+            self.keydir, self.keydir + os.sep, verbosity=0
+        )
+
+    def test_environment(self):
+        source = EnvironmentKeySource()
+        self.assertRaises(keyczar.errors.KeyczarError, source.reader, 'x')
+
+        with open(self.keystore) as f:
+            os.environ['ENCRYPTED_FIELDS_KEYSTORE'] = f.read()
+        source.clear()
+        keydir = settings.ENCRYPTED_FIELDS_BLIND_INDEX_KEYDIR
+        digest = KeyczarHmacWrapper(keydir).digest('secret')
+        set_key_source(source)
+        self.assertEqual(KeyczarHmacWrapper(keydir).digest('secret'), digest)
+
+    def test_memory(self):
+        source = MemoryKeySource()
+        self.assertRaises(keyczar.errors.KeyczarError, source.reader, 'x')
+
+        with open(self.keystore) as f:
+            packed = f.read()
+        self.assertEqual(json.loads(packed)['format'], 1)
+        ciphertext = KeyczarWrapper(self.keydir).encrypt('secret')
+        set_key_source(MemoryKeySource(packed))
+        shutil.rmtree(self.keydir)
+        self.assertEqual(KeyczarWrapper(self.keydir).decrypt(ciphertext),
+                         'secret')
+
+        future = json.dumps(dict(json.loads(packed), format=2))
+        self.assertRaises(
+            keyczar.errors.KeyczarError,
+            MemoryKeySource(future).reader, self.keydir)
+
+    @override_settings(
+        ENCRYPTED_FIELDS_KEY_SOURCE='encrypted_fields.keysources.'
+                                    'PackedKeySource'
+    )
+    def test_setting(self):
+        with override_settings(ENCRYPTED_FIELDS_KEYSTORE=self.keystore):
+            set_key_source(None)
+            self.assertTrue(
+                isinstance(keysources.get_key_source(), PackedKeySource))
+
+    def test_preload(self):
+        crypters.invalidate()
+        load_times = keysources.preload()
+
+        char = TestModel._meta.get_field('char')
+        self.assertIn((char._crypter_klass.__name__, char.keydir), load_times)
+        blind_index_keydir = settings.ENCRYPTED_FIELDS_BLIND_INDEX_KEYDIR
+        self.assertIn(('KeyczarHmacWrapper', blind_index_keydir), load_times)
+        self.assertTrue(all(seconds >= 0 for seconds in load_times.values()))
+        self.assertEqual(
+            crypters.load_times[(char._crypter_klass, char.keydir)],
+            load_times[(char._crypter_klass.__name__, char.keydir)]
+        )
+
+        # Everything is loaded now.
+        self.assertEqual(keysources.preload(), {})
+        out = six.StringIO()
+        call_command('preload_keys', stdout=out)
+        self.assertIn('0 keysets loaded', out.getvalue())
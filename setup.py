@@ -24,10 +24,18 @@ setup(
     license='BSD',
     author='Aron Jones',
     author_email='aron.jones@gmail.com',
-    packages=['encrypted_fields'],
+    packages=[
+        'encrypted_fields',
+        'encrypted_fields.management',
+        'encrypted_fields.management.commands',
+        'encrypted_fields.migrations',
+    ],
     version=version,
     install_requires=[
-        'Django>=1.4',
+        'Django>=1.10',
         'python-keyczar>=0.71c',
     ],
+    extras_require={
+        'aead': ['cryptography'],
+    },
 )
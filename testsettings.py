@@ -6,6 +6,11 @@ DATABASES = {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': ':memory:',
     },
+    # Target of the copies between databases in the tests.
+    'other': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+    },
 }
 
 SECRET_KEY = 'notsecure'
@@ -17,3 +22,15 @@ INSTALLED_APPS = (
 MIDDLEWARE_CLASSES = []
 
 ENCRYPTED_FIELDS_KEYDIR = os.path.join(os.path.dirname(__file__), 'testkey')
+ENCRYPTED_FIELDS_BLIND_INDEX_KEYDIR = os.path.join(
+    os.path.dirname(__file__), 'testblindindexkey'
+)
+ENCRYPTED_FIELDS_DETERMINISTIC_KEYDIR = os.path.join(
+    os.path.dirname(__file__), 'testdeterministickey'
+)
+
+# The test models live in encrypted_fields/tests.py, outside the app's
+# migrations, so create the app's tables straight from its models.
+MIGRATION_MODULES = {
+    'encrypted_fields': None,
+}